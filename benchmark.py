@@ -0,0 +1,269 @@
+#! /usr/local/bin/python3
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+
+from ccdict_index import CcdictIndex
+from chunk_directory import split_directory
+from clean_filenames import FilenameCleaner
+from itunes_playlist import iTunesLibrary
+from phase_stats import peak_rss_kb
+import sync_playlist
+
+# Syllables used for synthetic pinyin, and the code points given readings in
+# the synthetic ccdict.txt.
+SYLLABLES = ["a", "ba", "chen", "de", "fei", "guo", "hao", "jing", "li", "ma",
+             "ni", "qing", "shi", "wang", "xia", "yue", "zhong"]
+CJK_FIRST = 0x4E00
+CJK_COUNT = 4000
+
+# Pieces of names: plain ASCII, accented Latin and Cyrillic from the cleaner's
+# table, CJK with ccdict readings, and a few characters it doesn't know.
+WORDS = ["The", "Der", "Love", "Night", "Blue", "Song", "River", "Dream",
+         "Björk", "Dé", "Mötley", "Çava", "Crüe", "Sigur", "Ætt",
+         "звезда", "кино", "Ýmir", "Ōkami", "(Live)", "Pt. 2", "A:B", "Мир"]
+PHASES = ("generate", "ccdict", "parse", "parse_playlist", "compute_symlink_paths",
+          "make_symlinks", "recursive_clean", "split_directory")
+
+def random_name(rng, words=3):
+  pieces = [ ]
+  for _ in range(rng.randint(1, words)):
+    if rng.random() < 0.15:
+      pieces.append("".join(chr(CJK_FIRST + rng.randrange(CJK_COUNT))
+                            for _ in range(rng.randint(1, 4))))
+    else:
+      pieces.append(rng.choice(WORDS))
+  return " ".join(pieces)
+
+def write_ccdict(path, rng):
+  with open(path, "w", encoding="latin-1") as f:
+    f.write("# Synthetic ccdict for benchmarking\n")
+    for code in range(CJK_FIRST, CJK_FIRST + CJK_COUNT):
+      f.write("U+%X.0\tfDefinition\tsomething\n" % code)
+      f.write("U+%X.0\tfMandarin\t%s\n" % (code, rng.choice(SYLLABLES)))
+
+def generate_library(workdir, num_tracks, num_playlists, rng, make_files=True):
+  """
+  Write a synthetic Library.xml with num_tracks tracks and num_playlists
+  playlists, and a tree of empty music files for the tracks to point at.
+  Returns (library path, music folder, names of the playlists).
+  """
+  music_folder = os.path.join(workdir, "music")
+  library_path = os.path.join(workdir, "Library.xml")
+  artists = [random_name(rng, 2) for _ in range(max(1, num_tracks // 40))]
+  genres = ["Rock", "Pop", "Classical", "Jazz", "Electronic", "Folk"]
+  track_ids = [ ]
+  with open(library_path, "w", encoding="utf-8") as f:
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+            '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+            '<plist version="1.0">\n<dict>\n'
+            '\t<key>Major Version</key><integer>1</integer>\n'
+            '\t<key>Music Folder</key><string>%s</string>\n'
+            '\t<key>Tracks</key>\n\t<dict>\n' % file_url(music_folder + "/"))
+    made_dirs = set()
+    for n in range(num_tracks):
+      track_id = 1000 + n
+      artist = rng.choice(artists)
+      album = "%s %d" % (random_name(rng, 2), rng.randrange(3))
+      name = "%02d %s" % (rng.randrange(1, 20), random_name(rng))
+      path = os.path.join(music_folder, "Music", artist, album, "%s.mp3" % name)
+      genre = rng.choice(genres)
+      f.write('\t\t<key>%d</key>\n\t\t<dict>\n' % track_id)
+      for key, kind, value in (
+          ("Track ID", "integer", track_id),
+          ("Name", "string", name),
+          ("Artist", "string", artist),
+          ("Album", "string", album),
+          ("Genre", "string", genre),
+          ("Kind", "string", "MPEG audio file"),
+          ("Size", "integer", rng.randrange(2000000, 12000000)),
+          ("Total Time", "integer", rng.randrange(60000, 600000)),
+          ("Play Count", "integer", rng.randrange(50)),
+          ("Rating", "integer", rng.randrange(0, 101, 20)),
+          ("Date Added", "date", "2015-%02d-%02dT10:00:00Z" % (rng.randrange(1, 13),
+                                                              rng.randrange(1, 29))),
+          ("Persistent ID", "string", "%016X" % rng.getrandbits(64)),
+          ("Location", "string", file_url(path))):
+        f.write('\t\t\t<key>%s</key><%s>%s</%s>\n' % (key, kind, escape(str(value)), kind))
+      if rng.random() < 0.1:
+        f.write('\t\t\t<key>Compilation</key><true/>\n')
+      f.write('\t\t</dict>\n')
+      track_ids.append(track_id)
+      if make_files:
+        parent = os.path.dirname(path)
+        if parent not in made_dirs:
+          os.makedirs(parent, exist_ok=True)
+          made_dirs.add(parent)
+        open(path, "w").close()
+    f.write('\t</dict>\n\t<key>Playlists</key>\n\t<array>\n')
+    playlist_names = ["Library"] + ["Playlist %d %s" % (n, random_name(rng, 1))
+                                    for n in range(num_playlists)]
+    for n, playlist_name in enumerate(playlist_names):
+      if n == 0:
+        items = track_ids
+      else:
+        items = rng.sample(track_ids, min(len(track_ids), rng.randrange(10, 2000)))
+      f.write('\t\t<dict>\n\t\t\t<key>Name</key><string>%s</string>\n'
+              '\t\t\t<key>Playlist ID</key><integer>%d</integer>\n'
+              '\t\t\t<key>Playlist Items</key>\n\t\t\t<array>\n' % (
+                  escape(playlist_name), 100000 + n))
+      for track_id in items:
+        f.write('\t\t\t\t<dict>\n\t\t\t\t\t<key>Track ID</key>'
+                '<integer>%d</integer>\n\t\t\t\t</dict>\n' % track_id)
+      f.write('\t\t\t</array>\n\t\t</dict>\n')
+    f.write('\t</array>\n</dict>\n</plist>\n')
+  return library_path, music_folder, playlist_names
+
+def file_url(path):
+  return "file://localhost" + urllib.parse.quote(path)
+
+class PhaseTimer(object):
+  """
+  Times named phases, recording wall time, CPU time, the process's peak RSS
+  at the end of each, and how far each phase raised that peak.
+  """
+  def __init__(self):
+    self.results = { }
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    print("  %s..." % name, file=sys.stderr)
+    wall, cpu, start_peak = time.perf_counter(), time.process_time(), peak_rss_kb()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+         contextlib.redirect_stderr(devnull):
+      yield
+    peak = peak_rss_kb()
+    self.results[name] = {
+      "wall_s": round(time.perf_counter() - wall, 4),
+      "cpu_s": round(time.process_time() - cpu, 4),
+      "peak_rss_kb": peak,
+      "rss_growth_kb": peak - start_peak,
+    }
+
+def run_benchmark(workdir, num_tracks, num_playlists, seed, chunk_size):
+  rng = random.Random(seed)
+  timer = PhaseTimer()
+  with timer.phase("generate"):
+    write_ccdict(os.path.join(workdir, "ccdict.txt"), rng)
+    library_path, music_folder, playlist_names = generate_library(
+        workdir, num_tracks, num_playlists, rng)
+  with timer.phase("ccdict"):
+    CcdictIndex(workdir).build()
+  with timer.phase("parse"):
+    itunes = iTunesLibrary(library_path)
+  with timer.phase("parse_playlist"):
+    iTunesLibrary(library_path, playlist_names[-1])
+  staging = os.path.join(workdir, "staging")
+  with timer.phase("compute_symlink_paths"):
+    plan = sync_playlist.build_staging_plan(itunes.playlists["Library"], itunes.music_folder,
+                                            FilenameCleaner(ccdict_path=workdir))
+  with timer.phase("make_symlinks"):
+    sync_playlist.make_symlinks(staging, plan)
+  with timer.phase("recursive_clean"):
+    FilenameCleaner(ccdict_path=workdir, dry_run=True).recursive_clean(music_folder)
+  with timer.phase("split_directory"):
+    split_directory(os.path.join(staging, "Artists"), chunk_size, dry_run=True)
+  return timer.results
+
+def run_isolated(*args):
+  """
+  Run run_benchmark in a fresh process, so that the peak RSS of one library
+  size isn't carried over into the next.
+  """
+  with ProcessPoolExecutor(max_workers=1,
+                           mp_context=multiprocessing.get_context("spawn")) as pool:
+    return pool.submit(run_benchmark, *args).result()
+
+def compare(results, baseline, tolerance, min_seconds):
+  """Print a comparison with a baseline, returning the number of regressions."""
+  regressions = 0
+  for size, phases in sorted(results["runs"].items(), key=lambda item: int(item[0])):
+    base_phases = baseline.get("runs", { }).get(size)
+    if not base_phases:
+      print("%s tracks: no baseline" % size)
+      continue
+    for phase in PHASES:
+      if phase not in phases or phase not in base_phases:
+        continue
+      new, old = phases[phase]["wall_s"], base_phases[phase]["wall_s"]
+      ratio = new / old if old else 1.0
+      flag = ""
+      if ratio > 1 + tolerance and new - old > min_seconds:
+        flag = "  REGRESSION"
+        regressions += 1
+      print("%8s tracks %-22s %9.3fs -> %9.3fs (%5.2fx)%s" % (
+          size, phase, old, new, ratio, flag))
+  return regressions
+
+def main():
+  """Benchmark the playlist tools against synthetic libraries of various sizes"""
+
+  parser = argparse.ArgumentParser(
+      description=main.__doc__)
+  parser.add_argument("-n", "--tracks", type=int, nargs="+", default=[10000],
+      help="Library sizes to benchmark, in tracks (e.g. 10000 100000 500000).")
+  parser.add_argument("--playlists", type=int, default=50,
+      help="Number of playlists in each synthetic library.")
+  parser.add_argument("--chunk-size", type=int, default=40,
+      help="Chunk size for the split_directory phase.")
+  parser.add_argument("--seed", type=int, default=1,
+      help="Random seed for the synthetic libraries.")
+  parser.add_argument("--workdir",
+      help="Directory for the synthetic files, which are kept. "
+           "A temporary directory is used and removed if not specified.")
+  parser.add_argument("-o", "--output",
+      help="Write the results as JSON to this file.")
+  parser.add_argument("--compare",
+      help="Compare the results with a JSON file saved by an earlier run.")
+  parser.add_argument("--tolerance", type=float, default=0.2,
+      help="Fraction a phase may slow down before it is flagged as a regression.")
+  parser.add_argument("--min-seconds", type=float, default=0.05,
+      help="Ignore slowdowns smaller than this many seconds.")
+  args = parser.parse_args()
+
+  results = { "python": sys.version.split()[0], "playlists": args.playlists,
+              "seed": args.seed, "runs": { } }
+  for num_tracks in args.tracks:
+    print("Benchmarking %d tracks" % num_tracks, file=sys.stderr)
+    workdir = args.workdir and os.path.join(args.workdir, str(num_tracks))
+    if workdir:
+      if os.path.isdir(workdir):
+        shutil.rmtree(workdir)
+      os.makedirs(workdir)
+    else:
+      workdir = tempfile.mkdtemp(prefix="sync-playlist-bench-")
+    try:
+      results["runs"][str(num_tracks)] = run_isolated(
+          workdir, num_tracks, args.playlists, args.seed, args.chunk_size)
+    finally:
+      if not args.workdir:
+        shutil.rmtree(workdir)
+
+  output = json.dumps(results, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(output + "\n")
+  else:
+    print(output)
+
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    if compare(results, baseline, args.tolerance, args.min_seconds):
+      return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
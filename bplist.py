@@ -0,0 +1,103 @@
+import datetime
+import mmap
+import struct
+
+MAGIC = b'bplist00'
+APPLE_EPOCH = datetime.datetime(2001, 1, 1)
+
+def is_binary_plist(path):
+  with open(path, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+class BinaryPlist(object):
+  """
+  A lazy reader for binary property lists (bplist00). The file is memory
+  mapped and objects are decoded only when asked for by reference, so the
+  parts of a large plist that aren't needed are never touched.
+
+  Containers aren't decoded as a whole; array_refs() and dict_refs() return
+  the references of their members, which can be passed to decode().
+  """
+  TRAILER = struct.Struct('>6xBBQQQ')
+
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if self.mm[:len(MAGIC)] != MAGIC:
+      raise ValueError("Not a binary plist: %s" % path)
+    (self.offset_size, self.ref_size, self.num_objects, self.top_object,
+     self.offset_table) = self.TRAILER.unpack_from(self.mm, len(self.mm) - self.TRAILER.size)
+
+  def close(self):
+    self.mm.close()
+
+  def read_uint(self, offset, size):
+    return int.from_bytes(self.mm[offset:offset + size], 'big')
+
+  def object_offset(self, ref):
+    if not 0 <= ref < self.num_objects:
+      raise ValueError("Bad object reference %d" % ref)
+    return self.read_uint(self.offset_table + ref * self.offset_size, self.offset_size)
+
+  def header(self, ref):
+    """Return (type nibble, length, offset of the object's contents)."""
+    offset = self.object_offset(ref)
+    marker = self.mm[offset]
+    kind, info = marker >> 4, marker & 0xF
+    offset += 1
+    if kind not in (0x0, 0x1, 0x2, 0x3, 0x8) and info == 0xF:
+      size = 1 << (self.mm[offset] & 0xF)
+      info = self.read_uint(offset + 1, size)
+      offset += 1 + size
+    return kind, info, offset
+
+  def read_refs(self, offset, count):
+    size = self.ref_size
+    return [self.read_uint(offset + i * size, size) for i in range(count)]
+
+  def array_refs(self, ref):
+    kind, count, offset = self.header(ref)
+    if kind not in (0xA, 0xC):
+      raise ValueError("Object %d is not an array" % ref)
+    return self.read_refs(offset, count)
+
+  def dict_refs(self, ref):
+    """Return a list of (key ref, value ref) for a dict."""
+    kind, count, offset = self.header(ref)
+    if kind != 0xD:
+      raise ValueError("Object %d is not a dict" % ref)
+    keys = self.read_refs(offset, count)
+    values = self.read_refs(offset + count * self.ref_size, count)
+    return list(zip(keys, values))
+
+  def dict_items(self, ref):
+    """Return a list of (decoded key, value ref) for a dict."""
+    return [(self.decode(key), value) for key, value in self.dict_refs(ref)]
+
+  def decode(self, ref):
+    """Decode an object, and everything it contains."""
+    kind, info, offset = self.header(ref)
+    mm = self.mm
+    if kind == 0x0:
+      return { 0x0: None, 0x8: False, 0x9: True }.get(info)
+    if kind == 0x1:
+      size = 1 << info
+      return int.from_bytes(mm[offset:offset + size], 'big', signed=size >= 8)
+    if kind == 0x2:
+      return struct.unpack_from('>f' if info == 2 else '>d', mm, offset)[0]
+    if kind == 0x3:
+      seconds = struct.unpack_from('>d', mm, offset)[0]
+      return APPLE_EPOCH + datetime.timedelta(seconds=seconds)
+    if kind == 0x4:
+      return bytes(mm[offset:offset + info])
+    if kind == 0x5:
+      return mm[offset:offset + info].decode('ascii')
+    if kind == 0x6:
+      return mm[offset:offset + 2 * info].decode('utf-16-be')
+    if kind == 0x8:
+      return self.read_uint(offset, info + 1)
+    if kind in (0xA, 0xC):
+      return [self.decode(member) for member in self.read_refs(offset, info)]
+    if kind == 0xD:
+      return dict((self.decode(key), self.decode(value)) for key, value in self.dict_refs(ref))
+    raise ValueError("Unknown object type 0x%X at %d" % (kind, offset))
@@ -0,0 +1,140 @@
+import os
+import sys
+
+from dest_manifest import DestinationManifest
+import native_sync
+from staging_plan import StagingPlan
+
+TRIM_ORDERS = ('playlist', 'rating', 'added')
+
+def allocated(size, cluster):
+  """The space a file of size bytes takes up on disk, in whole clusters."""
+  return -(-size // cluster) * cluster
+
+def free_space(path):
+  """
+  Return (bytes free, cluster size) for the file system holding path. On
+  FAT and exFAT the block size statvfs reports is the cluster size.
+  """
+  st = os.statvfs(path)
+  return st.f_bavail * st.f_frsize, st.f_frsize or st.f_bsize
+
+def human_size(size):
+  for unit in ("bytes", "KB", "MB", "GB"):
+    if abs(size) < 1000 or unit == "GB":
+      return ("%d %s" if unit == "bytes" else "%.1f %s") % (size, unit)
+    size /= 1000.0
+
+class Preflight(object):
+  """
+  Works out, before anything is copied, whether a StagingPlan fits on a
+  destination. The space the plan's files and directories will take up, in
+  whole clusters, is compared with what the destination's manifest says is
+  there now, which the sync deletes or replaces, and with the free space.
+  The plan already has the size of every source file and the manifest of
+  every destination file, so nothing is stat'ed; a destination without a
+  manifest is scanned once.
+  """
+  def __init__(self, dest_dir, verify=False):
+    self.dest_dir = dest_dir
+    self.manifest = DestinationManifest(dest_dir)
+    native_sync.load_manifest(self.manifest, verify)
+    self.free, self.cluster = free_space(dest_dir)
+    self.in_use = (sum(allocated(entry[0], self.cluster) for entry in self.manifest.files.values())
+                   + len(self.manifest.dirs) * self.cluster)
+
+  def shortfall(self, plan):
+    """Return how many more bytes plan needs than are free, or 0 if it fits."""
+    cluster = self.cluster
+    files = self.manifest.files
+    needed = -self.in_use + len(plan.dirs()) * cluster
+    largest_copy = 0
+    for staged in plan:
+      size = allocated(staged.size, cluster)
+      needed += size
+      entry = files.get(staged.rel_path)
+      if entry is None or entry[0] != staged.size or entry[2] not in (None, staged.src_path):
+        largest_copy = max(largest_copy, size)
+    # Each copy is written next to the file it replaces before it is renamed
+    # into place, so there must be room for the largest one twice.
+    return max(0, needed + largest_copy - self.free)
+
+  def trim(self, plan, order):
+    """
+    Return plan without as few of its tracks as will make it fit, leaving
+    out first the last in the playlist, the lowest rated or the least
+    recently added, and the list of StagedFiles left out. Returns (None,
+    None) if not even one track would fit.
+
+    Leaving out more tracks never needs more space, so the fewest are found
+    by a binary search, working out each candidate's shortfall afresh so
+    that the directories emptied by leaving out whole albums count too.
+    """
+    if not self.shortfall(plan):
+      return plan, [ ]
+    rel_paths = trim_order(plan, order)
+    if self.shortfall(leave_out(plan, rel_paths[:-1])):
+      return None, None
+    low, high = 1, len(rel_paths) - 1
+    while low < high:
+      middle = (low + high) // 2
+      if self.shortfall(leave_out(plan, rel_paths[:middle])):
+        low = middle + 1
+      else:
+        high = middle
+    dropped = set(rel_paths[:low])
+    return leave_out(plan, dropped), [staged for staged in plan if staged.rel_path in dropped]
+
+def leave_out(plan, rel_paths):
+  """Return a copy of plan without the files at rel_paths."""
+  rel_paths = set(rel_paths)
+  return StagingPlan((staged for staged in plan if staged.rel_path not in rel_paths),
+                     dict((rel_path, value) for rel_path, value in plan.tracks.items()
+                          if rel_path not in rel_paths))
+
+def trim_order(plan, order):
+  """Return the relative paths of the plan's tracks, the first to be left out first."""
+  if order == 'playlist':
+    key = lambda item: -item[1][0]
+  elif order == 'rating':
+    key = lambda item: (item[1][1].rating or 0, -item[1][0])
+  elif order == 'added':
+    key = lambda item: (item[1][1].date_added or '', -item[1][0])
+  else:
+    raise ValueError("Unknown trim order %r" % order)
+  return [rel_path for rel_path, _ in sorted(plan.tracks.items(), key=key)]
+
+def preflight(plan, dest_dirs, trim=None, verify=False):
+  """
+  Check that plan fits on each of dest_dirs. If it doesn't and trim is one of
+  TRIM_ORDERS, trim it to fit them all. Returns the plan and {dest_dir:
+  DestinationManifest} of the manifests loaded for the check, for the sync to
+  plan against rather than loading them again; or, if the plan doesn't fit,
+  reports how far short it is and returns (None, None).
+  """
+  manifests = { }
+  for dest_dir in dest_dirs:
+    check = Preflight(dest_dir, verify)
+    manifests[dest_dir] = check.manifest
+    short = check.shortfall(plan)
+    if not short:
+      print("The playlist fits on %s, with %s free" % (dest_dir, human_size(check.free)),
+            file=sys.stderr)
+      continue
+    if not trim:
+      print("[Error] The playlist needs %s more than the %s free on %s; "
+            "pass --trim to leave out tracks until it fits." % (
+                human_size(short), human_size(check.free), dest_dir), file=sys.stderr)
+      return None, None
+    trimmed, dropped = check.trim(plan, trim)
+    if trimmed is None:
+      print("[Error] Nothing from the playlist fits in the %s free on %s." % (
+          human_size(check.free), dest_dir), file=sys.stderr)
+      return None, None
+    print("Leaving out %d tracks (%s) so the playlist fits on %s:" % (
+        len(dropped), human_size(sum(staged.size for staged in dropped)), dest_dir),
+          file=sys.stderr)
+    for staged in dropped:
+      print("  %s" % staged.rel_path, file=sys.stderr)
+    plan = trimmed
+  return plan, manifests
@@ -0,0 +1,130 @@
+#! /usr/local/bin/python3
+
+import argparse
+import array
+import bisect
+import hashlib
+import mmap
+import os
+import re
+import struct
+import sys
+
+from library_cache import cache_home
+from phase_stats import STATS
+
+MANDARIN_RE = re.compile(r'U\+([0-9A-F]+)\.0\tfMandarin\t([a-z]*)')
+
+def iter_ccdict(ccdict_path):
+  """Yield (code point, pinyin) for each Mandarin reading in ccdict.txt."""
+  for line in open(ccdict_path, encoding="latin-1"):
+    match = MANDARIN_RE.match(line)
+    if match:
+      yield int(match.group(1), 16), match.group(2)
+
+class CcdictIndex(object):
+  """
+  A compiled, memory mapped lookup table of the Mandarin readings in
+  ccdict.txt. The index is a sorted array of code points, an array of offsets
+  into a blob of pinyin strings, and the blob itself. It is built next to
+  ccdict.txt (or in the user cache directory if that isn't writable) the first
+  time a character is looked up, and rebuilt whenever ccdict.txt is newer.
+  """
+  MAGIC = b"CCDX"
+  VERSION = 1
+  HEADER = struct.Struct("<4sHcxI")
+
+  def __init__(self, ccdict_path):
+    if os.path.isdir(ccdict_path):
+      ccdict_path = os.path.join(ccdict_path, "ccdict.txt")
+    self.ccdict_path = ccdict_path
+    self.index_path = self.find_index_path()
+    if not os.path.isfile(ccdict_path) and not os.path.isfile(self.index_path):
+      raise FileNotFoundError("No such file: %s" % ccdict_path)
+    self.mm = None
+
+  def find_index_path(self):
+    index_path = os.path.splitext(self.ccdict_path)[0] + ".idx"
+    if os.path.isfile(index_path) or os.access(os.path.dirname(index_path) or ".", os.W_OK):
+      return index_path
+    digest = hashlib.sha1(os.path.realpath(self.ccdict_path).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_home(), "sync-playlist", "ccdict-%s.idx" % digest)
+
+  def is_stale(self):
+    if not os.path.isfile(self.index_path):
+      return True
+    if not os.path.isfile(self.ccdict_path):
+      return False
+    return os.path.getmtime(self.ccdict_path) > os.path.getmtime(self.index_path)
+
+  def build(self):
+    print("Compiling Mandarin translations from %s" % self.ccdict_path, file=sys.stderr)
+    readings = dict(iter_ccdict(self.ccdict_path))
+    codes = array.array('I', sorted(readings))
+    offsets = array.array('I', [0])
+    blob = bytearray()
+    for code in codes:
+      blob += readings[code].encode("ascii")
+      offsets.append(len(blob))
+    byteorder = b'l' if sys.byteorder == 'little' else b'b'
+    os.makedirs(os.path.dirname(self.index_path) or ".", exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (self.index_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+      f.write(self.HEADER.pack(self.MAGIC, self.VERSION, byteorder, len(codes)))
+      f.write(codes.tobytes())
+      f.write(offsets.tobytes())
+      f.write(blob)
+    os.replace(tmp_path, self.index_path)
+
+  def open(self):
+    with STATS.phase("ccdict_load"):
+      self.open_index()
+
+  def open_index(self):
+    if self.is_stale():
+      self.build()
+    with open(self.index_path, 'rb') as f:
+      mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, byteorder, count = self.HEADER.unpack_from(mm)
+    native = b'l' if sys.byteorder == 'little' else b'b'
+    if (magic, version, byteorder) != (self.MAGIC, self.VERSION, native):
+      mm.close()
+      if not os.path.isfile(self.ccdict_path):
+        raise ValueError("Unusable ccdict index: %s" % self.index_path)
+      self.build()
+      return self.open_index()
+    start = self.HEADER.size
+    view = memoryview(mm)
+    self.codes = view[start:start + 4 * count].cast('I')
+    start += 4 * count
+    self.offsets = view[start:start + 4 * (count + 1)].cast('I')
+    self.blob = view[start + 4 * (count + 1):]
+    self.mm = mm
+
+  def get(self, c):
+    """Return the pinyin for a character, or None if it has no reading."""
+    if self.mm is None:
+      self.open()
+    code = ord(c)
+    i = bisect.bisect_left(self.codes, code)
+    if i == len(self.codes) or self.codes[i] != code:
+      return None
+    return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("ascii")
+
+
+def main():
+  """Compile ccdict.txt into the binary index used to clean filenames"""
+
+  parser = argparse.ArgumentParser(
+      description=main.__doc__)
+  parser.add_argument("ccdict", nargs="?",
+      default=os.path.dirname(os.path.realpath(__file__)),
+      help="Path to ccdict.txt or the directory containing it.")
+  args = parser.parse_args()
+
+  index = CcdictIndex(args.ccdict)
+  index.build()
+  print("Wrote %s" % index.index_path)
+
+if __name__ == "__main__":
+  main()
@@ -3,13 +3,18 @@
 import argparse
 import itertools
 import os
-import shutil
 import sys
 
+TEMP_PREFIX = ".rechunk-"
+# Lists the chunks a split made, so that they can be told apart from
+# directories that just have names like chunks.
+RECORD_NAME = ".chunks"
+
 def move(src, dst, dry_run):
   print("move: %s\n   -> %s" % (src, dst))
   if not dry_run:
-    shutil.move(src, dst)
+    # Everything moves within one directory tree, so a rename will do.
+    os.rename(src, dst)
 
 def move_dirs(path, chunk_name, chunk, dry_run):
   chunk_root = os.path.join(path, chunk_name)
@@ -22,8 +27,24 @@ def move_dirs(path, chunk_name, chunk, dry_run):
     dst = os.path.join(path, chunk_name, d)
     move(src, dst, dry_run)
 
+def read_record(path):
+  """Return the set of chunk names recorded in path, or None if there's no record."""
+  try:
+    with open(os.path.join(path, RECORD_NAME), encoding="utf-8") as f:
+      return set(line.rstrip("\n") for line in f if line.strip())
+  except FileNotFoundError:
+    return None
+
+def write_record(path, chunk_names, dry_run):
+  record_path = os.path.join(path, RECORD_NAME)
+  print("record: %s" % record_path)
+  if not dry_run:
+    with open(record_path, "w", encoding="utf-8") as f:
+      for chunk_name in sorted(chunk_names):
+        f.write(chunk_name + "\n")
+
 def split_directory(path, size, dry_run=False):
-  subdirs = sorted(os.listdir(path))
+  subdirs = sorted(name for name in os.listdir(path) if name != RECORD_NAME)
   alpha_groups = itertools.groupby(subdirs, lambda item: item[0].upper())
   alpha_dict = dict()
   for alpha, items in alpha_groups:
@@ -70,11 +91,285 @@ def split_directory(path, size, dry_run=False):
     chunk_name = '-'.join(alpha_range)
     summary[chunk_name] = len(chunk)
     move_dirs(path, chunk_name, chunk, dry_run)
+  write_record(path, (read_record(path) or set()) | set(summary), dry_run)
 
   print("\nsummary:")
   for c, n in sorted(summary.items()):
     print("%s = %d items" % (c, n))
 
+def letter_groups(items, size=None, split_prefixes=False):
+  """
+  Group items by their first letter, returning a sorted list of (letter,
+  items). With split_prefixes, letters with more than size items are grouped
+  by their first two letters instead.
+  """
+  groups = dict()
+  for item in sorted(items):
+    groups.setdefault(item[0].upper(), list()).append(item)
+  result = list()
+  for key, members in sorted(groups.items()):
+    if split_prefixes and len(members) > size:
+      prefixes = dict()
+      for item in members:
+        prefixes.setdefault(key + item[1:2].lower(), list()).append(item)
+      # In the order in_range compares them.
+      result.extend(sorted(prefixes.items(), key=lambda prefix: prefix[0].upper()))
+    else:
+      result.append((key, members))
+  return result
+
+def linear_partition(weights, k):
+  """
+  Split a list of weights into at most k contiguous runs so that the largest
+  run total is as small as possible. Returns the start index of each run.
+  """
+  n = len(weights)
+  k = max(1, min(k, n))
+  prefix = [0]
+  for w in weights:
+    prefix.append(prefix[-1] + w)
+  # best[i] is the smallest largest run for the first i weights in j runs,
+  # and starts[j][i] is where the last of those runs starts.
+  best = list(prefix)
+  starts = [[0] * (n + 1)]
+  for j in range(2, k + 1):
+    new_best = [0] * (n + 1)
+    row = [0] * (n + 1)
+    m = j - 1
+    for i in range(j, n + 1):
+      # The best start of the last run never moves left as i grows, since
+      # the cost is the larger of a rising and a falling function of m.
+      m = max(m, j - 1)
+      while (m + 1 < i and max(best[m + 1], prefix[i] - prefix[m + 1]) <=
+             max(best[m], prefix[i] - prefix[m])):
+        m += 1
+      new_best[i] = max(best[m], prefix[i] - prefix[m])
+      row[i] = m
+    best = new_best
+    starts.append(row)
+  bounds = list()
+  i = n
+  for j in range(k, 0, -1):
+    i = starts[j - 1][i] if j > 1 else 0
+    bounds.append(i)
+  return sorted(set(bounds))
+
+def balanced_chunks(items, size, split_prefixes=False):
+  """
+  Plan a split of items into chunks of about size items each, keeping the
+  letters (or two letter prefixes) in order and making the largest chunk as
+  small as possible. Returns a list of (chunk name, items).
+  """
+  groups = letter_groups(items, size, split_prefixes)
+  if not groups:
+    return list()
+  total = sum(len(members) for _, members in groups)
+  bounds = linear_partition([len(members) for _, members in groups], -(-total // size))
+  chunks = list()
+  for start, end in zip(bounds, bounds[1:] + [len(groups)]):
+    keys = [key for key, _ in groups[start:end]]
+    chunk_name = keys[0] if len(keys) == 1 else "%s-%s" % (keys[0], keys[-1])
+    chunks.append((chunk_name, [item for _, members in groups[start:end] for item in members]))
+  return chunks
+
+def print_summary(chunks):
+  print("\nsummary:")
+  for c, items in sorted(chunks):
+    print("%s = %d items" % (c, len(items)))
+
+def balanced_split_directory(path, size, dry_run=False, split_prefixes=False):
+  chunks = balanced_chunks([name for name in os.listdir(path) if name != RECORD_NAME], size,
+                           split_prefixes)
+  for chunk_name, chunk in chunks:
+    move_dirs(path, chunk_name, chunk, dry_run)
+  write_record(path, (read_record(path) or set()) | set(name for name, _ in chunks), dry_run)
+  print_summary(chunks)
+
+def chunk_range(chunk_name):
+  """
+  Return the (first, last) letters or prefixes a chunk name covers, or None if
+  the name isn't one the splits give a chunk: A, A-C, Ab or Ab-Ch.
+  """
+  keys = chunk_name.split('-')
+  if len(keys) > 2 or not all(0 < len(key) <= 2 and not key[0].islower() for key in keys):
+    return None
+  return keys[0].upper(), keys[-1].upper()
+
+def in_range(item, first, last):
+  return first <= item[:len(first)].upper() and item[:len(last)].upper() <= last
+
+def read_chunks(path):
+  """
+  Return ({chunk name: [items]}, [items]) for a directory that has been split:
+  the existing chunks, and everything else at the top, such as directories
+  added since the split, which still has to be put in a chunk. Only
+  directories the split recorded making, whose items all fall in their range,
+  count as chunks. A split made before there were records has none, so then
+  any directory named like a chunk counts, unless it's empty.
+  """
+  recorded = read_record(path)
+  layout = dict()
+  loose = list()
+  for name in sorted(os.listdir(path)):
+    if name.startswith('.'):
+      continue
+    chunk_root = os.path.join(path, name)
+    keys = chunk_range(name)
+    if (keys is not None and (recorded is None or name in recorded)
+        and os.path.isdir(chunk_root) and not os.path.islink(chunk_root)):
+      items = sorted(os.listdir(chunk_root))
+      if (items or recorded is not None) and all(in_range(item, *keys) for item in items):
+        layout[name] = items
+        continue
+    loose.append(name)
+  return layout, loose
+
+def best_assignment(weights):
+  """
+  Given weights[i][j] for each row i and column j, with no more rows than
+  columns, return the column for each row, each used at most once, that makes
+  the total weight as large as possible. The Hungarian method, O(n^2 m).
+  """
+  n = len(weights)
+  m = len(weights[0]) if n else 0
+  inf = float('inf')
+  # Minimizes the negated weights, with rows and columns numbered from 1 and
+  # column 0 standing for the row being added.
+  u = [0] * (n + 1)
+  v = [0] * (m + 1)
+  row_of = [0] * (m + 1)
+  way = [0] * (m + 1)
+  for i in range(1, n + 1):
+    row_of[0] = i
+    j0 = 0
+    least = [inf] * (m + 1)
+    used = [False] * (m + 1)
+    while True:
+      used[j0] = True
+      i0 = row_of[j0]
+      delta = inf
+      j1 = 0
+      for j in range(1, m + 1):
+        if not used[j]:
+          cur = -weights[i0 - 1][j - 1] - u[i0] - v[j]
+          if cur < least[j]:
+            least[j] = cur
+            way[j] = j0
+          if least[j] < delta:
+            delta = least[j]
+            j1 = j
+      for j in range(m + 1):
+        if used[j]:
+          u[row_of[j]] += delta
+          v[j] -= delta
+        else:
+          least[j] -= delta
+      j0 = j1
+      if row_of[j0] == 0:
+        break
+    while j0:
+      j1 = way[j0]
+      row_of[j0] = row_of[j1]
+      j0 = j1
+  columns = [None] * n
+  for j in range(1, m + 1):
+    if row_of[j]:
+      columns[row_of[j] - 1] = j - 1
+  return columns
+
+def plan_rechunk(layout, chunks):
+  """
+  Match new chunks with old chunks, each at most once, so that as many items
+  as possible are already in the chunk they belong to, and those chunks can be
+  renamed rather than emptied. Items not in a chunk in layout always move.
+  Returns ({new chunk name: old chunk name or None}, [(item, old chunk name
+  or None, new chunk name)] for the items that have to move).
+  """
+  old_chunk = dict((item, chunk_name) for chunk_name, items in layout.items() for item in items)
+  old_names = sorted(layout)
+  column = dict((old_name, j) for j, old_name in enumerate(old_names))
+  # Each row can also go unmatched, to a column of its own. Shared items count
+  # double so that keeping a chunk's name only ever breaks ties.
+  weights = list()
+  for i, (new_name, items) in enumerate(chunks):
+    row = [0] * (len(old_names) + len(chunks))
+    for item in items:
+      if item in old_chunk:
+        row[column[old_chunk[item]]] += 2
+    if new_name in column:
+      row[column[new_name]] += 1
+    weights.append(row)
+  assignment = dict()
+  for (new_name, _), row, j in zip(chunks, weights, best_assignment(weights)):
+    assignment[new_name] = old_names[j] if j < len(old_names) and row[j] else None
+  moves = [(item, old_chunk.get(item), new_name) for new_name, items in chunks
+           for item in items if item not in old_chunk or old_chunk[item] != assignment[new_name]]
+  return assignment, moves
+
+def rechunk_directory(path, size, dry_run=False, split_prefixes=False):
+  """
+  Rebalance an already split directory into chunks of about size items,
+  moving as few items as possible. Chunks are renamed where their contents
+  mostly stay put, and the rest of the items are moved between chunks
+  directly rather than by flattening and splitting again. Anything else at
+  the top of path, such as directories added since it was split, is moved
+  into its chunk.
+  """
+  layout, loose = read_chunks(path)
+  items = [item for chunk in layout.values() for item in chunk] + loose
+  if len(set(items)) != len(items):
+    print("Items appear in more than one chunk, so they can't be rechunked", file=sys.stderr)
+    return 1
+  chunks = balanced_chunks(items, size, split_prefixes)
+  assignment, moves = plan_rechunk(layout, chunks)
+
+  def mkdir(dir_path):
+    print("+dir: %s" % dir_path)
+    if not dry_run:
+      os.mkdir(dir_path)
+
+  # Work under temporary names, so that new chunk names can't clash with old
+  # chunks that haven't been emptied yet.
+  work = dict()
+  for new_name, old_name in assignment.items():
+    if old_name == new_name:
+      work[new_name] = os.path.join(path, new_name)
+      continue
+    work[new_name] = os.path.join(path, TEMP_PREFIX + new_name)
+    if old_name is None:
+      mkdir(work[new_name])
+    else:
+      move(os.path.join(path, old_name), work[new_name], dry_run)
+  location = dict((old_name, os.path.join(path, old_name)) for old_name in layout)
+  location[None] = path
+  for new_name, old_name in assignment.items():
+    if old_name is not None:
+      location[old_name] = work[new_name]
+
+  batches = dict()
+  for item, old_name, new_name in moves:
+    batches.setdefault((old_name, new_name), list()).append(item)
+  for (old_name, new_name), batch in sorted(batches.items(),
+                                           key=lambda b: (b[0][0] or '', b[0][1])):
+    print("move %d items: %s -> %s" % (len(batch), old_name or "(top)", new_name))
+    for item in batch:
+      print("  %s" % item)
+      if not dry_run:
+        os.rename(os.path.join(location[old_name], item), os.path.join(work[new_name], item))
+
+  for old_name in sorted(set(layout) - set(assignment.values())):
+    print("-del: %s" % location[old_name])
+    if not dry_run:
+      os.rmdir(location[old_name])
+  for new_name, work_path in sorted(work.items()):
+    if work_path != os.path.join(path, new_name):
+      move(work_path, os.path.join(path, new_name), dry_run)
+  write_record(path, work, dry_run)
+
+  print_summary(chunks)
+  print("%d of %d items moved; flattening and splitting again would move %d" % (
+      len(moves), len(items), 2 * len(items) - len(loose)))
+
 def flatten_directory(path, dry_run=False):
   for d in sorted(os.listdir(path)):
     subdir = os.path.join(path, d)
@@ -86,6 +381,11 @@ def flatten_directory(path, dry_run=False):
       print("-del: %s" % subdir)
       if not dry_run:
         os.rmdir(subdir)
+  record_path = os.path.join(path, RECORD_NAME)
+  if os.path.isfile(record_path):
+    print("-del: %s" % record_path)
+    if not dry_run:
+      os.remove(record_path)
 
 def main():
   """Divide a directory's content into chunks of a given size, or move all subdirectories content into the parent"""
@@ -97,6 +397,14 @@ def main():
       help="Split a directory into chunks of a given number of children")
   op_group.add_argument("-j", "--join", action="store_true",
       help="Join all subdirectories content into the parent")
+  op_group.add_argument("-r", "--rechunk", type=int,
+      help="Rebalance an already split directory into chunks of a given number of children, "
+           "moving as little as possible")
+  parser.add_argument("-b", "--balanced", action="store_true",
+      help="Split into chunks as even as the letters allow, rather than greedily.")
+  parser.add_argument("--prefixes", action="store_true",
+      help="With --balanced or --rechunk, let letters with more than a chunk's worth of "
+           "children be split by their first two letters.")
   parser.add_argument("-f", "--force", action="store_true",
       help="Really move things rather than just showing what be moved.")
   parser.add_argument("dir")
@@ -109,7 +417,12 @@ def main():
   dry_run = not args.force
   if args.join:
     flatten_directory(args.dir, dry_run)
-  elif args.split > 0:
+  elif args.rechunk is not None and args.rechunk > 0:
+    if rechunk_directory(args.dir, args.rechunk, dry_run, args.prefixes):
+      return 1
+  elif args.split is not None and args.split > 0 and args.balanced:
+    balanced_split_directory(args.dir, args.split, dry_run, args.prefixes)
+  elif args.split is not None and args.split > 0:
     split_directory(args.dir, args.split, dry_run)
   else:
     print("Split must be > 0", file=sys.stderr)
@@ -119,4 +432,4 @@ def main():
     print("\nPass -f to do it for real")
 
 if __name__ == "__main__":
-  main()
+  sys.exit(main())
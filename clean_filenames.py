@@ -1,18 +1,21 @@
 #! /usr/local/bin/python3
 
 import argparse
+import functools
 import os
 import re
 import sys
 
+from ccdict_index import CcdictIndex
+import phase_stats
+from phase_stats import STATS
+from rename_plan import RenamePlanner
+
 class CharacterTranslator(object):
 
   def __init__(self, ccdict_path=None):
-    self.translations = { }
-    self.ccdict_translations = { }
-    if ccdict_path:
-      self.translations.update(self.get_ccdict_translations(ccdict_path))
-    self.translations.update({
+    self.ccdict = CcdictIndex(ccdict_path) if ccdict_path else None
+    self.translations = {
       chr(0x003A) : '_',  # colon (HFS path separator)
       chr(0x00C4) : 'AE', # umlaut A
       chr(0x00D6) : 'OE', # umlaut O
@@ -84,28 +87,65 @@ class CharacterTranslator(object):
       chr(0xFF09) : ')',  # fullwidth paren
       chr(0xFF0D) : '-',  # fullwidth dash
       chr(0xFF1A) : '_',  # fullwidth colon
-    })
+    }
+    self.table = TranslationTable(self)
+    # Pure-ASCII strings can skip the marker pass unless an ASCII character
+    # translates to something that needs a marker.
+    self.ascii_is_plain = not any(
+        ord(c) < 0x80 and (t == '' or self.is_pinyin(t))
+        for c, t in self.translations.items())
+    self.translate_component = functools.lru_cache(maxsize=self.COMPONENT_CACHE_SIZE)(
+        self.translate_component_uncached)
 
   PINYIN_SEP = '-'
 
-  def get_ccdict_translations(self, ccdict_path):
-    translations = { }
-    mandarin_re = re.compile(r'U\+([0-9A-F]+)\.0\tfMandarin\t([a-z]*)')
-    if os.path.isdir(ccdict_path):
-      ccdict_path = os.path.join(ccdict_path, "ccdict.txt")
-    print("Loading Mandarin translations from %s" % ccdict_path, file=sys.stderr)
-    for line in open(ccdict_path, encoding="latin-1"):
-      match = mandarin_re.match(line)
-      if match:
-        code = int(match.group(1), 16)
-        pinyin = match.group(2)
-        translations[chr(code)] = pinyin + self.PINYIN_SEP
-    return translations
+  # In the table-driven translation, pinyin readings are wrapped in
+  # PINYIN_START and PINYIN_END and characters that translate to nothing become
+  # EMPTY, so the separators can be fixed up on the joined string in one pass.
+  # A reading keeps its separator only if another reading or the end of the
+  # string follows it.
+  PINYIN_START = '\x02'
+  PINYIN_END = '\x00'
+  EMPTY = '\x01'
+  MARKERS_RE = re.compile('(\x00(?=\x02|\\Z))|[\x00\x01\x02]')
+
+  # Artist and album directory names repeat throughout a library, so their
+  # translations are kept in an LRU cache.
+  COMPONENT_CACHE_SIZE = 8192
 
   def is_pinyin(self, c):
     return len(c) > 1 and c[-1] == self.PINYIN_SEP
 
   def translate_str(self, s):
+    if s.isascii() and self.ascii_is_plain:
+      return s.translate(self.table)
+    if any(marker in s for marker in (self.PINYIN_START, self.PINYIN_END, self.EMPTY)):
+      return self.translate_str_by_char(s)
+    if '/' in self.translations:
+      components = [s]
+    else:
+      components = s.split('/')
+    marked = [ ]
+    for component in components:
+      translated, unknown = self.translate_component(component)
+      marked.append(translated)
+      for code in unknown:
+        self.report_unknown(code, s)
+    return self.MARKERS_RE.sub(self.resolve_marker, '/'.join(marked))
+
+  def translate_component_uncached(self, component):
+    """
+    Translate a path component with the markers left in, returning the
+    translation and the code points of any unknown characters.
+    """
+    self.table.unknown = [ ]
+    translated = component.translate(self.table)
+    return translated, tuple(self.table.unknown)
+
+  def resolve_marker(self, match):
+    return self.PINYIN_SEP if match.group(1) else ''
+
+  def translate_str_by_char(self, s):
     translated_chars = [self.translate_char(c, s) for c in s]
     prev = ''
     for i, c in enumerate(translated_chars):
@@ -115,15 +155,55 @@ class CharacterTranslator(object):
     return str.join('', translated_chars)
 
   def translate_char(self, c, s=None):
+    translation = self.lookup_char(c)
+    if translation is None:
+      code = ord(c)
+      self.report_unknown(code, s)
+      return '(%X)' % code
+    return translation
+
+  def lookup_char(self, c):
+    """Return the translation of a character, or None if it is unknown."""
     if c in self.translations:
       return self.translations[c]
-    code = ord(c)
-    if code > 0x80:
-      print("Unknown character: '%s' (0x%X)" % (chr(code), code), file=sys.stderr)
-      if s: print("in %s" % s, file=sys.stderr)
-      return '(%X)' % code
+    if self.ccdict and c > chr(0x80):
+      pinyin = self.ccdict.get(c)
+      if pinyin is not None:
+        return pinyin + self.PINYIN_SEP
+    if ord(c) > 0x80:
+      return None
     return c
 
+  def report_unknown(self, code, s=None):
+    STATS.count("unknown_characters")
+    print("Unknown character: '%s' (0x%X)" % (chr(code), code), file=sys.stderr)
+    if s: print("in %s" % s, file=sys.stderr)
+
+
+class TranslationTable(dict):
+  """
+  A str.translate table for a CharacterTranslator that fills itself in as
+  characters are seen. Unknown characters aren't cached, so that each one can
+  be reported; their code points are collected in the unknown list.
+  """
+  def __init__(self, translator):
+    dict.__init__(self)
+    self.translator = translator
+    self.unknown = [ ]
+
+  def __missing__(self, code):
+    t = self.translator
+    translation = t.lookup_char(chr(code))
+    if translation is None:
+      self.unknown.append(code)
+      return '(%X)' % code
+    if translation == '':
+      translation = t.EMPTY
+    elif t.is_pinyin(translation):
+      translation = t.PINYIN_START + translation[:-1] + t.PINYIN_END
+    self[code] = translation
+    return translation
+
 
 class FilenameCleaner(object):
   def __init__(self, ccdict_path=None, dry_run=False):
@@ -150,6 +230,7 @@ class FilenameCleaner(object):
     if basename != renamed:
       renamed = os.path.join(dirname, renamed)
       print("%srename: %s\n     -> %s" % (dry, name, renamed))
+      STATS.count("renames")
       if not self.dry_run:
         os.rename(name, renamed)
 
@@ -170,8 +251,18 @@ def main():
       description=main.__doc__)
   parser.add_argument("-f", "--force", action="store_true",
       help="Really rename things rather than just showing what be renamed.")
+  parser.add_argument("-j", "--jobs", type=int,
+      help="Scan and rename with this many threads, planning every rename first so that "
+           "names that would collide are caught before anything is touched.")
+  parser.add_argument("--ignore-case", action="store_true",
+      help="With --jobs, treat names that differ only in case as colliding, "
+           "as they do on FAT and HFS.")
+  parser.add_argument("--no-journal", action="store_true",
+      help="With --jobs, check every directory, including those unchanged since the last run.")
   parser.add_argument("dir")
+  phase_stats.add_arguments(parser)
   args = parser.parse_args()
+  phase_stats.configure(args)
 
   if not os.path.isdir(args.dir):
     print("Must be a directory: %s" % args.dir, file=sys.stderr)
@@ -180,7 +271,12 @@ def main():
   my_dir = os.path.dirname(os.path.realpath(__file__))
   dry_run = not args.force
   cleaner = FilenameCleaner(ccdict_path=my_dir, dry_run=dry_run)
-  cleaner.recursive_clean(sys.argv[1])
+  if args.jobs:
+    planner = RenamePlanner(cleaner, args.jobs, args.ignore_case, not args.no_journal)
+    with STATS.phase("recursive_clean"):
+      return 0 if planner.run(args.dir, dry_run) else 1
+  with STATS.phase("recursive_clean"):
+    cleaner.recursive_clean(args.dir)
 
 if __name__ == "__main__":
-  main()
+  sys.exit(main())
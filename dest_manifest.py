@@ -0,0 +1,61 @@
+import json
+import os
+import sys
+
+MANIFEST_NAME = ".sync-manifest.json"
+
+class DestinationManifest(object):
+  """
+  A record, kept in a hidden file at the top of a sync destination, of every
+  file and directory the last sync left there: each file's size and mtime,
+  the source file it was copied from and, when syncing with checksums, the
+  digest of its contents. Planning a sync against the manifest avoids walking
+  the destination, which on SD cards and MTP mounts can take longer than the
+  copy. Because it lives on the destination the
+  manifest travels with the card, whichever machine syncs it next.
+  """
+  VERSION = 1
+
+  def __init__(self, dest_dir):
+    self.path = os.path.join(dest_dir, MANIFEST_NAME)
+    self.files = { }
+    self.dirs = set()
+
+  def load(self):
+    """Read the manifest, returning False if it is missing or unreadable."""
+    try:
+      with open(self.path, encoding="utf-8") as f:
+        manifest = json.load(f)
+      if manifest.get("version") != self.VERSION:
+        raise ValueError("version %r" % manifest.get("version"))
+      self.files = dict((rel_path, tuple(entry[:4]) + (None,) * (4 - len(entry)))
+                        for rel_path, entry in manifest["files"].items())
+      self.dirs = set(manifest["dirs"])
+    except FileNotFoundError:
+      return False
+    except (OSError, ValueError, KeyError, TypeError) as e:
+      print("Ignoring unreadable manifest %s: %s" % (self.path, e), file=sys.stderr)
+      return False
+    return True
+
+  def sizes(self):
+    return dict((rel_path, entry[0]) for rel_path, entry in self.files.items())
+
+  def sources(self):
+    return dict((rel_path, entry[2]) for rel_path, entry in self.files.items())
+
+  def digests(self):
+    return dict((rel_path, entry[3]) for rel_path, entry in self.files.items())
+
+  def set_file(self, rel_path, size, mtime_ns, source, digest=None):
+    self.files[rel_path] = (size, mtime_ns, source, digest)
+
+  def save(self):
+    tmp_path = self.path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+      json.dump({
+        "version": self.VERSION,
+        "dirs": sorted(self.dirs),
+        "files": dict((rel_path, list(entry)) for rel_path, entry in self.files.items()),
+      }, f, separators=(",", ":"))
+    os.replace(tmp_path, self.path)
@@ -0,0 +1,251 @@
+import os
+import queue
+import shutil
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import native_sync
+from native_sync import SyncResult, describe, temp_path
+from phase_stats import STATS
+
+CHUNK_SIZE = 1024 * 1024
+BUFFER_COUNT = 64
+
+class BufferPool(object):
+  """
+  A fixed number of reusable read buffers, allocated as they are first
+  needed. get() blocks once they are all in use until one is put back, which
+  bounds how far the readers can get ahead of the slowest destination.
+  """
+  def __init__(self, count=BUFFER_COUNT, size=CHUNK_SIZE):
+    self.size = size
+    self.free = queue.Queue()
+    self.unallocated = count
+    self.lock = threading.Lock()
+
+  def get(self):
+    try:
+      return self.free.get_nowait()
+    except queue.Empty:
+      pass
+    with self.lock:
+      if self.unallocated:
+        self.unallocated -= 1
+        return bytearray(self.size)
+    return self.free.get()
+
+  def put(self, buf):
+    self.free.put(buf)
+
+
+class Chunk(object):
+  """
+  A filled buffer shared by the destinations that are writing it, which goes
+  back to the pool once they all have.
+  """
+  def __init__(self, pool, buf, length, users):
+    self.pool = pool
+    self.buf = buf
+    self.data = memoryview(buf)[:length]
+    self.users = users
+    self.lock = threading.Lock()
+
+  def release(self):
+    with self.lock:
+      self.users -= 1
+      done = self.users == 0
+    if done:
+      self.data.release()
+      self.pool.put(self.buf)
+
+
+class DestinationWriter(object):
+  """
+  Carries out one destination's part of a fan-out on its own thread: first
+  its deletions and new directories, in plan order, and then its copies as
+  the readers pass it their data. A failure, such as a full card, fails only
+  that destination's file, and the rest of the file's data is dropped rather
+  than holding up the other destinations.
+  """
+  def __init__(self, plan, on_result=None):
+    self.plan = plan
+    self.dest_dir = plan.dest_dir
+    self.on_result = on_result
+    self.queue = queue.Queue()
+    self.results = [ ]
+    self.files = { }
+    self.thread = threading.Thread(target=self.run, daemon=True,
+                                   name="fan-out %s" % self.dest_dir)
+
+  def run(self):
+    for action in self.plan.actions:
+      if action.op not in ('copy', 'replace'):
+        self.add_result(native_sync.run_action(self.dest_dir, action))
+    while True:
+      message = self.queue.get()
+      if message is None:
+        break
+      kind, action, value = message
+      if kind == 'start':
+        self.start(action)
+      elif kind == 'data':
+        try:
+          self.write(action, value.data)
+        finally:
+          value.release()
+      else:
+        self.end(action, value)
+    # Copies cut short by an interrupt; the journal has them as not done.
+    for action in list(self.files):
+      self.end(action, InterruptedError("interrupted"))
+
+  def start(self, action):
+    dest_path = os.path.join(self.dest_dir, action.rel_path)
+    try:
+      if os.path.isdir(dest_path) and not os.path.islink(dest_path):
+        shutil.rmtree(dest_path)
+      self.files[action] = open(temp_path(dest_path), 'wb')
+    except OSError as e:
+      self.files[action] = e
+
+  def write(self, action, data):
+    dest = self.files[action]
+    if isinstance(dest, OSError):
+      return
+    try:
+      dest.write(data)
+    except OSError as e:
+      self.discard(action, dest)
+      self.files[action] = e
+
+  def end(self, action, read_error):
+    dest = self.files.pop(action)
+    if isinstance(dest, OSError):
+      self.add_result(SyncResult(action, False, 0, dest))
+      return
+    if read_error is not None:
+      self.discard(action, dest)
+      self.add_result(SyncResult(action, False, 0, read_error))
+      return
+    dest_path = os.path.join(self.dest_dir, action.rel_path)
+    try:
+      copied = dest.tell()
+      dest.flush()
+      os.fsync(dest.fileno())
+      dest.close()
+      os.replace(dest.name, dest_path)
+    except OSError as e:
+      self.discard(action, dest)
+      self.add_result(SyncResult(action, False, 0, e))
+      return
+    self.add_result(SyncResult(action, True, copied, None))
+
+  def discard(self, action, dest):
+    try:
+      dest.close()
+    except OSError:
+      pass
+    if os.path.lexists(dest.name):
+      os.remove(dest.name)
+
+  def add_result(self, result):
+    if result.ok:
+      print("%s: %s" % (self.dest_dir, describe(result.action)))
+    else:
+      print("[Error] %s: %s: %s" % (self.dest_dir, describe(result.action), result.error),
+            file=sys.stderr)
+    self.results.append(result)
+    if self.on_result:
+      self.on_result(result)
+
+
+def read_source(src_path, copies, pool):
+  """
+  Read one source file into buffers from the pool and pass each of them to
+  every (writer, action) in copies. Returns the number of bytes read.
+  """
+  for writer, action in copies:
+    writer.queue.put(('start', action, None))
+  read = 0
+  error = None
+  try:
+    with open(src_path, 'rb') as src:
+      while True:
+        buf = pool.get()
+        try:
+          n = src.readinto(buf)
+        except BaseException:
+          pool.put(buf)
+          raise
+        if not n:
+          pool.put(buf)
+          break
+        read += n
+        chunk = Chunk(pool, buf, n, len(copies))
+        for writer, action in copies:
+          writer.queue.put(('data', action, chunk))
+  except OSError as e:
+    error = e
+  for writer, action in copies:
+    writer.queue.put(('end', action, error))
+  return read
+
+def run_fan_out(plans, jobs=4, pool=None):
+  """
+  Carry out the DestinationPlans of several destinations of the same source
+  tree together. Each source file is read once, by one of jobs reader
+  threads, and its data is written to every destination that needs it by
+  that destination's own writer thread. Returns a list of SyncResults for
+  each plan.
+  """
+  pool = pool or BufferPool()
+  writers = [DestinationWriter(plan, plan.journal.done) for plan in plans]
+  sources = { }
+  for writer in writers:
+    for action in writer.plan.actions:
+      if action.op in ('copy', 'replace'):
+        sources.setdefault(action.src_path, [ ]).append((writer, action))
+  for writer in writers:
+    writer.thread.start()
+  readers = ThreadPoolExecutor(max_workers=jobs)
+  try:
+    for read in readers.map(lambda src_path: read_source(src_path, sources[src_path], pool),
+                            sorted(sources)):
+      STATS.count("source_bytes_read", read)
+  finally:
+    # On an interrupt, let the files being read finish but start no more.
+    readers.shutdown(cancel_futures=True)
+    for writer in writers:
+      writer.queue.put(None)
+    for writer in writers:
+      writer.thread.join()
+  return [writer.results for writer in writers]
+
+def fan_out(src_dir, dest_dirs, dry_run=False, delete=True, jobs=4, verify=False,
+            hashes=None, resume=False, staged=None, manifests=None):
+  """
+  Make each of dest_dirs match src_dir, or the StagingPlan staged if one is
+  given, like native_sync.sync_directories,
+  but reading each source file only once however many destinations need it.
+  Every destination keeps its own manifest, plan and journal; manifests has
+  those that have already been loaded. Returns a list of SyncResults for each
+  destination.
+  """
+  manifests = manifests or { }
+  with STATS.phase("sync_plan"):
+    plans = [native_sync.prepare_sync(src_dir, dest_dir, dry_run, delete, verify, hashes, resume,
+                                      staged, manifests.get(dest_dir))
+             for dest_dir in dest_dirs]
+  if dry_run:
+    all_results = [ ]
+    for plan in plans:
+      print("Would sync to %s" % plan.dest_dir, file=sys.stderr)
+      all_results.append(native_sync.run_plan(plan.dest_dir, plan.actions, dry_run=True))
+  else:
+    with STATS.phase("sync_copy"):
+      all_results = run_fan_out(plans, jobs)
+  for plan, results in zip(plans, all_results):
+    native_sync.finish_sync(plan, results, dry_run)
+    print("%s: %s" % (plan.dest_dir, native_sync.summarize(results)), file=sys.stderr)
+  return all_results
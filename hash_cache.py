@@ -0,0 +1,101 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from library_cache import cache_home
+from phase_stats import STATS
+
+MODES = ("sample", "full")
+SAMPLE_SIZE = 64 * 1024
+READ_SIZE = 1024 * 1024
+
+def file_digest(path, mode="sample"):
+  """
+  Return a BLAKE2 digest of a file, tagged with the mode it was made in. A
+  "full" digest reads the whole file. A "sample" digest reads only the start,
+  middle and end of a large file (where tag edits land) along with its size.
+  """
+  h = hashlib.blake2b(digest_size=16)
+  with open(path, 'rb') as f:
+    size = os.fstat(f.fileno()).st_size
+    if mode == "full" or size <= 3 * SAMPLE_SIZE:
+      for block in iter(lambda: f.read(READ_SIZE), b''):
+        h.update(block)
+    else:
+      h.update(str(size).encode("ascii"))
+      for offset in (0, (size - SAMPLE_SIZE) // 2, size - SAMPLE_SIZE):
+        f.seek(offset)
+        h.update(f.read(SAMPLE_SIZE))
+  STATS.count("files_hashed")
+  return "%s:%s" % (mode, h.hexdigest())
+
+def digest_mode(digest):
+  return digest.partition(":")[0] if digest else None
+
+LOCK_TIMEOUT = 60
+
+class HashCache(object):
+  """
+  A persistent SQLite cache of file digests, keyed on path and checked
+  against each file's inode, size and mtime. A file is only read again when
+  one of those changes; the files that need hashing are hashed on a thread
+  pool. It may be used from several threads at once.
+  """
+  def __init__(self, mode="sample", cache_path=None, jobs=8):
+    if mode not in MODES:
+      raise ValueError("Unknown hash mode: %s" % mode)
+    self.mode = mode
+    self.jobs = jobs
+    if cache_path is None:
+      cache_path = os.path.join(cache_home(), "sync-playlist", "hashes.sqlite")
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # Syncs to several destinations at once each have their own connection to
+    # the cache, so wait for the others' writes rather than failing.
+    self.db = sqlite3.connect(cache_path, timeout=LOCK_TIMEOUT, check_same_thread=False)
+    self.lock = threading.Lock()
+    self.db.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, "
+                    "inode INTEGER, size INTEGER, mtime_ns INTEGER, digest TEXT)")
+
+  def close(self):
+    self.db.close()
+
+  def digests(self, paths, batch_size=500):
+    """Return {path: digest} for the given paths, hashing only changed files."""
+    digests = { }
+    stale = [ ]
+    paths = sorted(set(paths))
+    for i in range(0, len(paths), batch_size):
+      batch = paths[i:i + batch_size]
+      query = ("SELECT path, inode, size, mtime_ns, digest FROM hashes WHERE path IN (%s)" %
+               ",".join("?" * len(batch)))
+      with self.lock:
+        cached = dict((row[0], row[1:]) for row in self.db.execute(query, batch))
+      for path in batch:
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        row = cached.get(path)
+        if row and row[:3] == key and digest_mode(row[3]) == self.mode:
+          digests[path] = row[3]
+        else:
+          stale.append((path, key))
+    if stale:
+      with STATS.phase("hash"):
+        if len(stale) == 1:
+          fresh = [file_digest(stale[0][0], self.mode)]
+        else:
+          with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            fresh = list(pool.map(lambda path: file_digest(path, self.mode),
+                                  [path for path, _ in stale]))
+        rows = [ ]
+        for (path, key), digest in zip(stale, fresh):
+          digests[path] = digest
+          rows.append((path,) + key + (digest,))
+      with self.lock:
+        self.db.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)", rows)
+        self.db.commit()
+    return digests
+
+  def digest(self, path):
+    return self.digests([path])[path]
@@ -2,13 +2,26 @@
 # Copyright 2008, Tom Bridgwater
 
 import argparse
+import datetime
 import os
+from array import array
 import sys
 import re
 import urllib.request, urllib.parse, urllib.error
 from collections import UserDict
+import xml.parsers.expat
 import xml.sax.handler
 
+from bplist import BinaryPlist, is_binary_plist
+from library_cache import LibraryCache
+import library_export
+from library_export import RecordWriter
+from library_query import LibraryIndex, QueryError
+import phase_stats
+from phase_stats import STATS
+
+DEFAULT_LIBRARY_XML = "%s/Music/Music/Library.xml" % os.getenv('HOME')
+
 class PListHandler(xml.sax.handler.ContentHandler):
   """A SAX handler to transform an Apple plist into nested lists and dicts"""
   def __init__(self):
@@ -60,21 +73,379 @@ class PListHandler(xml.sax.handler.ContentHandler):
       scope.append(value)
 
 
+class LibraryHandler(PListHandler):
+  """
+  A PListHandler for an iTunes library. Tracks are stored as compact
+  iTunesTrack records keyed by integer Track ID, and each playlist's items as
+  an array of Track IDs, without building a dict for each one.
+  """
+  PLAYLIST_ITEM = object()
+
+  def __init__(self):
+    PListHandler.__init__(self)
+    self.track_key = None
+
+  def startElement(self, name, attrs):
+    depth = len(self.scope)
+    if name == 'dict' and depth == 2 and self.in_section('Tracks'):
+      self.track_key = self.key
+      self.scope.append({ })
+    elif name == 'dict' and depth == 4 and type(self.scope[-1]) is array:
+      self.scope.append(self.PLAYLIST_ITEM)
+    elif (name == 'array' and depth == 3 and self.key == 'Playlist Items' and
+          self.in_section('Playlists')):
+      items = array('i')
+      self.addValue(items)
+      self.scope.append(items)
+    else:
+      PListHandler.startElement(self, name, attrs)
+
+  def endElement(self, name):
+    if name == 'dict' and len(self.scope) == 3 and self.in_section('Tracks'):
+      fields = self.scope.pop()
+      self.scope[-1][int(self.track_key)] = iTunesTrack.from_dict(fields)
+    else:
+      PListHandler.endElement(self, name)
+
+  def addValue(self, value):
+    if self.scope[-1] is self.PLAYLIST_ITEM:
+      if self.key == 'Track ID':
+        self.scope[-2].append(int(value))
+    else:
+      PListHandler.addValue(self, value)
+
+  def in_section(self, key):
+    return len(self.scope) > 1 and self.data.get(key) is self.scope[1]
+
+
+class ParseComplete(Exception):
+  """Raised by a handler to stop parsing once it has everything it needs"""
+
+
+class PlaylistFilterHandler(LibraryHandler):
+  """
+  A LibraryHandler for an iTunes library that only builds the parts needed for a
+  single playlist. Subtrees that aren't wanted are skipped without building
+  any lists or dicts for them.
+
+  The library is read in two passes because the playlists come after the
+  tracks in the file. The first pass (track_ids is None) skips the whole
+  Tracks dict and keeps only the named playlist, or the last of them if
+  several have the name. The second pass keeps only the tracks whose IDs are
+  in track_ids, and stops at the end of the Tracks dict.
+  """
+  def __init__(self, playlist_name, track_ids=None):
+    LibraryHandler.__init__(self)
+    self.playlist_name = playlist_name
+    self.track_ids = track_ids
+    self.skip_depth = 0
+    self.playlist = None
+    self.playlist_wanted = True
+
+  def startElement(self, name, attrs):
+    if self.skip_depth:
+      if name in ('dict', 'array'):
+        self.skip_depth += 1
+      return
+    if name in ('dict', 'array') and self.should_skip(name):
+      self.skip_depth = 1
+      return
+    LibraryHandler.startElement(self, name, attrs)
+    if name == 'dict' and len(self.scope) == 3 and self.in_section('Playlists'):
+      self.playlist = self.scope[-1]
+      self.playlist_wanted = True
+
+  def endElement(self, name):
+    if self.skip_depth:
+      if name in ('dict', 'array'):
+        self.skip_depth -= 1
+      return
+    if name == 'dict' and self.playlist is not None and self.scope[-1] is self.playlist:
+      self.scope.pop()
+      self.playlist = None
+      if not self.playlist_wanted:
+        self.scope[-1].pop()
+      else:
+        # Like the name to playlist dict of a whole library, the last of
+        # several playlists with the same name wins.
+        del self.scope[-1][:-1]
+      return
+    if name == 'dict' and len(self.scope) == 2 and self.in_section('Tracks'):
+      self.scope.pop()
+      if self.track_ids is not None:
+        raise ParseComplete()
+      return
+    LibraryHandler.endElement(self, name)
+
+  def should_skip(self, name):
+    depth = len(self.scope)
+    if depth == 1 and self.key == 'Tracks' and self.track_ids is None:
+      # First pass: record an empty Tracks dict without reading any tracks.
+      self.addValue({ })
+      return True
+    if depth == 2 and self.in_section('Tracks'):
+      return int(self.key) not in self.track_ids
+    if self.playlist is not None and not self.playlist_wanted:
+      return True
+    return False
+
+  def addValue(self, value):
+    LibraryHandler.addValue(self, value)
+    if (self.playlist is not None and self.scope[-1] is self.playlist and
+        self.key == 'Name'):
+      self.playlist_wanted = (value == self.playlist_name)
+
+
+class TrackStreamHandler(LibraryHandler):
+  """
+  A LibraryHandler that passes each track to on_track as soon as its dict has
+  been read, rather than keeping it, and stops at the end of the Tracks dict.
+  """
+  def __init__(self, on_track):
+    LibraryHandler.__init__(self)
+    self.on_track = on_track
+
+  def endElement(self, name):
+    if name == 'dict' and len(self.scope) == 3 and self.in_section('Tracks'):
+      self.on_track(iTunesTrack.from_dict(self.scope.pop()))
+    elif name == 'dict' and len(self.scope) == 2 and self.in_section('Tracks'):
+      raise ParseComplete()
+    else:
+      LibraryHandler.endElement(self, name)
+
+
+class PlaylistSummaryHandler(PlaylistFilterHandler):
+  """
+  A PlaylistFilterHandler that skips the Tracks dict and passes the name and
+  number of items of each playlist to on_playlist as it ends, without keeping
+  any of them.
+  """
+  def __init__(self, on_playlist):
+    PlaylistFilterHandler.__init__(self, None)
+    self.on_playlist = on_playlist
+
+  def endElement(self, name):
+    if name == 'dict' and self.playlist is not None and self.scope[-1] is self.playlist:
+      self.on_playlist(self.playlist.get('Name'), len(self.playlist.get('Playlist Items', ())))
+      self.playlist_wanted = False
+    PlaylistFilterHandler.endElement(self, name)
+
+  def addValue(self, value):
+    LibraryHandler.addValue(self, value)
+
+
+def stream_tracks(music_library_xml_path, on_track, use_cache=False):
+  """
+  Pass every track in a library to on_track as it is read, from the
+  LibraryCache if use_cache is set and it is up to date, or else from the
+  library file. Only one track is held in memory at a time.
+  """
+  if use_cache:
+    cache = LibraryCache(music_library_xml_path, make_track=iTunesTrack.from_dict)
+    if cache.stream_tracks(on_track):
+      return
+  if is_binary_plist(music_library_xml_path):
+    plist = BinaryPlist(music_library_xml_path)
+    try:
+      top = dict(plist.dict_items(plist.top_object))
+      for key, ref in plist.dict_items(top['Tracks']):
+        on_track(iTunesTrack.from_dict(dict(
+            (field, plist.decode(value)) for field, value in plist.dict_items(ref)
+            if field in iTunesTrack.ATTRIBUTES)))
+    finally:
+      plist.close()
+  else:
+    expat_parse(music_library_xml_path, TrackStreamHandler(on_track))
+
+def stream_playlists(music_library_xml_path, on_playlist, use_cache=False):
+  """
+  Pass the name and number of tracks of every playlist in a library to
+  on_playlist, in file order, without reading any tracks. Returns the
+  library's music folder.
+  """
+  if use_cache:
+    music_folder = LibraryCache(music_library_xml_path).stream_playlists(on_playlist)
+    if music_folder is not None:
+      return file_string(music_folder)
+  if is_binary_plist(music_library_xml_path):
+    plist = BinaryPlist(music_library_xml_path)
+    try:
+      top = dict(plist.dict_items(plist.top_object))
+      for ref in plist.array_refs(top['Playlists']):
+        fields = dict(plist.dict_items(ref))
+        name = plist.decode(fields['Name']) if 'Name' in fields else None
+        items = fields.get('Playlist Items')
+        on_playlist(name, len(plist.array_refs(items)) if items is not None else 0)
+      return file_string(plist.decode(top['Music Folder']))
+    finally:
+      plist.close()
+  handler = PlaylistSummaryHandler(on_playlist)
+  expat_parse(music_library_xml_path, handler)
+  return file_string(handler.data['Music Folder'])
+
+def expat_parse(music_library_xml_path, handler):
+  """Stream a library file through a handler with expat."""
+  parser = xml.parsers.expat.ParserCreate()
+  parser.SetParamEntityParsing(xml.parsers.expat.XML_PARAM_ENTITY_PARSING_NEVER)
+  parser.buffer_text = True
+  parser.StartElementHandler = handler.startElement
+  parser.EndElementHandler = handler.endElement
+  parser.CharacterDataHandler = handler.characters
+  with open(music_library_xml_path, 'rb') as xml_file:
+    try:
+      parser.ParseFile(xml_file)
+    except ParseComplete:
+      pass
+
+
 class iTunesLibrary(object):
-  def __init__(self, music_library_xml_path=None):
-    parser = self.make_xml_parser()
+  """
+  The parsed contents of an iTunes/Music Library.xml file. If playlist_name is
+  given, only that playlist and its tracks are read from the file.
+
+  With use_cache, the parsed library is kept in a LibraryCache and reloaded
+  from there until the file changes. A cache miss when loading the whole
+  library refills the cache. A miss when loading one playlist only streams
+  that playlist out of the file, as without the cache, and leaves the cache
+  to be refilled by the next whole load (such as itunes_playlist.py
+  --update-cache).
+
+  With workers > 1, the Tracks section of the file is parsed in that many
+  processes.
+  """
+  def __init__(self, music_library_xml_path=None, playlist_name=None,
+               use_cache=False, workers=None):
     if music_library_xml_path is None:
-      music_library_xml_path = "%s/Music/Music/Library.xml" % os.getenv('HOME')
-    print("Reading iTunes data from %s" % music_library_xml_path, file=sys.stderr)
+      music_library_xml_path = DEFAULT_LIBRARY_XML
     self.music_library_xml_path = music_library_xml_path
-    handler = PListHandler()
+    self.workers = workers
+    data = None
+    if use_cache:
+      cache = LibraryCache(music_library_xml_path, make_track=iTunesTrack.from_dict)
+      with STATS.phase("library_cache_load"):
+        data = cache.load(playlist_name)
+    if data is None and playlist_name is None:
+      with STATS.phase("parse_library"):
+        data = self.parse_library()
+      if use_cache:
+        with STATS.phase("library_cache_store"):
+          cache.store(data)
+    elif data is None:
+      with STATS.phase("parse_playlist"):
+        data = self.parse_playlist(playlist_name)
+    self.music_folder = file_string(data['Music Folder'])
+    self.tracks = iTunesTrackDict(data['Tracks'])
+    self.playlists = dict((pl['Name'], iTunesPlaylist(pl, self.tracks))
+                          for pl in data['Playlists'])
+    self._index = None
+
+  @property
+  def index(self):
+    """A LibraryIndex for queries, built the first time it's needed."""
+    if self._index is None:
+      self._index = LibraryIndex(self)
+    return self._index
+
+  def parse_library(self):
+    print("Reading iTunes data from %s" % self.music_library_xml_path, file=sys.stderr)
+    if is_binary_plist(self.music_library_xml_path):
+      return self.parse_binary()
+    data = self.parallel_parse()
+    if data is not None:
+      return data
+    parser = self.make_xml_parser()
+    handler = LibraryHandler()
     parser.setContentHandler(handler)
     xml_file = open(self.music_library_xml_path)
     parser.parse(xml_file)
-    self.music_folder = file_string(handler.data['Music Folder'])
-    self.tracks = iTunesTrackDict(handler.data['Tracks'])
-    self.playlists = dict((pl['Name'], iTunesPlaylist(pl, self.tracks))
-                          for pl in handler.data['Playlists'])
+    return handler.data
+
+  def parse_playlist(self, playlist_name):
+    """
+    Stream through the library with expat, keeping only the named playlist
+    and the tracks it refers to.
+    """
+    print("Reading playlist '%s' from %s" % (playlist_name, self.music_library_xml_path),
+          file=sys.stderr)
+    if is_binary_plist(self.music_library_xml_path):
+      return self.parse_binary(playlist_name)
+    data = self.parallel_parse(playlist_name)
+    if data is not None:
+      return data
+    handler = PlaylistFilterHandler(playlist_name)
+    self.stream_parse(handler)
+    data = handler.data
+    track_ids = set()
+    for playlist in data['Playlists']:
+      track_ids.update(playlist.get('Playlist Items', ()))
+    if data['Playlists']:
+      handler = PlaylistFilterHandler(playlist_name, track_ids)
+      self.stream_parse(handler)
+      data['Tracks'] = handler.data['Tracks']
+    return data
+
+  def parse_binary(self, playlist_name=None):
+    """
+    Read a binary plist library (as written by plutil -convert binary1),
+    decoding only the objects needed. With playlist_name, that means just the
+    playlist's dict and the dicts of the tracks it refers to.
+    """
+    plist = BinaryPlist(self.music_library_xml_path)
+    try:
+      top = dict(plist.dict_items(plist.top_object))
+      data = { 'Music Folder': plist.decode(top['Music Folder']), 'Playlists': [ ] }
+      for ref in plist.array_refs(top['Playlists']):
+        fields = dict(plist.dict_items(ref))
+        if playlist_name is not None:
+          if 'Name' not in fields or plist.decode(fields['Name']) != playlist_name:
+            continue
+        if playlist_name is not None:
+          # The last of several playlists with the same name wins, as in a
+          # whole library.
+          del data['Playlists'][:]
+        data['Playlists'].append(self.decode_binary_playlist(plist, fields))
+      track_ids = None
+      if playlist_name is not None:
+        track_ids = set()
+        for playlist in data['Playlists']:
+          track_ids.update(playlist.get('Playlist Items', ()))
+      tracks = { }
+      for key, ref in plist.dict_items(top['Tracks']):
+        id = int(key)
+        if track_ids is None or id in track_ids:
+          tracks[id] = iTunesTrack.from_dict(dict(
+              (field, plist.decode(value)) for field, value in plist.dict_items(ref)
+              if field in iTunesTrack.ATTRIBUTES))
+      data['Tracks'] = tracks
+    finally:
+      plist.close()
+    return data
+
+  def decode_binary_playlist(self, plist, fields):
+    playlist = { }
+    for key, ref in fields.items():
+      if key == 'Playlist Items':
+        playlist[key] = array('i', (plist.decode(dict(plist.dict_items(item))['Track ID'])
+                                    for item in plist.array_refs(ref)))
+      else:
+        value = plist_value(plist.decode(ref))
+        if value is not None:
+          playlist[key] = value
+    return playlist
+
+  def parallel_parse(self, playlist_name=None):
+    """
+    Parse with a pool of worker processes if workers were requested, or
+    return None to parse in this process.
+    """
+    if not self.workers or self.workers < 2:
+      return None
+    # Imported here because parallel_parse uses the handlers in this module.
+    from parallel_parse import parallel_parse
+    return parallel_parse(self.music_library_xml_path, self.workers, playlist_name)
+
+  def stream_parse(self, handler):
+    expat_parse(self.music_library_xml_path, handler)
 
   def make_xml_parser(self):
     """
@@ -92,27 +463,130 @@ class iTunesLibrary(object):
     return parser
 
 
-class iTunesTrackDict(UserDict):
+class iTunesTrack(object):
   """
-  A wrapper for the dictionary of tracks in an iTunes library. Lazilly
-  synthesizes the "File Path" value for tracks that are stored as local files,
-  or makes it None for other tracks.
+  A compact record of a track in an iTunes library, holding only the fields
+  these tools use. Repeated strings like artists and genres are interned.
+  Provides read-only dict-style access by plist key, including a lazily
+  synthesized "File Path" for tracks that are stored as local files, which
+  is None for other tracks.
   """
-  file_prefix_re = re.compile('^file://(localhost)?')
+  FIELDS = (
+    ('Track ID', 'track_id', int),
+    ('Name', 'name', str),
+    ('Artist', 'artist', sys.intern),
+    ('Album', 'album', sys.intern),
+    ('Genre', 'genre', sys.intern),
+    ('Compilation', 'compilation', lambda value: value in (True, 'true')),
+    ('Size', 'size', int),
+    ('Rating', 'rating', int),
+    ('Date Added', 'date_added', lambda value: date_string(value)),
+    ('Location', 'location', str),
+  )
+  ATTRIBUTES = dict((key, attr) for key, attr, convert in FIELDS)
+  __slots__ = tuple(attr for key, attr, convert in FIELDS) + ('_file_path',)
+
+  def __init__(self):
+    for attr in self.__slots__:
+      setattr(self, attr, None)
+    self._file_path = False
+
+  @classmethod
+  def from_dict(cls, fields):
+    track = cls()
+    for key, attr, convert in cls.FIELDS:
+      value = fields.get(key)
+      if value is not None:
+        setattr(track, attr, convert(value))
+    return track
+
+  def values(self):
+    """Return the field values as a tuple, e.g. to send between processes."""
+    return tuple(getattr(self, attr) for key, attr, convert in self.FIELDS)
+
+  @classmethod
+  def from_values(cls, values):
+    track = cls()
+    for (key, attr, convert), value in zip(cls.FIELDS, values):
+      if value is not None:
+        setattr(track, attr, convert(value))
+    return track
+
+  @property
+  def file_path(self):
+    if self._file_path is False:
+      self._file_path = file_string(self.location) if self.location else None
+    return self._file_path
+
+  def __getitem__(self, key):
+    if key == 'File Path':
+      return self.file_path
+    value = getattr(self, self.ATTRIBUTES[key])
+    if value is None:
+      raise KeyError(key)
+    return value
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
 
+  def __contains__(self, key):
+    return self.get(key) is not None
+
+  def keys(self):
+    return [key for key, attr, convert in self.FIELDS if getattr(self, attr) is not None]
+
+  def items(self):
+    return [(key, self[key]) for key in self.keys()]
+
+  def __repr__(self):
+    return "iTunesTrack(%r)" % dict(self.items())
+
+
+class iTunesTrackDict(UserDict):
+  """
+  A wrapper for the dictionary of iTunesTracks in an iTunes library, keyed by
+  integer Track ID. String IDs, as they appear in the plist, are accepted too.
+  """
   def __init__(self, tracks):
     UserDict.__init__(self)
     self.data = tracks
 
   def __getitem__(self, id):
-    track = self.data[id]
-    if 'File Path' not in track:
-      file_path = None
-      if 'Location' in track:
-        file_path = file_string(track['Location'])
-      track['File Path'] = file_path
-    return track
+    return self.data[int(id)]
+
+  def __contains__(self, id):
+    return int(id) in self.data
+
+
+def plist_value(value):
+  """
+  Represent a value decoded from a binary plist the way PListHandler reads
+  it from XML: scalars as strings, and no reals or data, which it skips.
+  """
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  if isinstance(value, int):
+    return str(value)
+  if isinstance(value, datetime.datetime):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+  if isinstance(value, dict):
+    return dict((k, v) for k, v in ((k, plist_value(v)) for k, v in value.items())
+                if v is not None)
+  if isinstance(value, list):
+    return [v for v in map(plist_value, value) if v is not None]
+  if isinstance(value, str):
+    return value
+  return None
+
 
+def date_string(value):
+  """A plist date as PListHandler reads it from XML, which sorts by time."""
+  if isinstance(value, datetime.datetime):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+  return str(value)
 
 FILE_PREFIX_RE = re.compile('^file://(localhost)?')
 def file_string(location):
@@ -123,27 +597,31 @@ def file_string(location):
 
 class iTunesPlaylist(UserDict):
   """
-  A wrapper for a playlist dictionary in an iTunes library. Provides a
-  getitem method for random access to and iteration over the tracks.
+  A wrapper for a playlist dictionary in an iTunes library, whose "Playlist
+  Items" are an array of Track IDs. Provides a getitem method for random
+  access to and iteration over the tracks.
   """
   def __init__(self, playlist, library_tracks):
     UserDict.__init__(self)
     self.data = playlist
     self._library_tracks = library_tracks
 
+  @property
+  def track_ids(self):
+    return self.data.get('Playlist Items') or array('i')
+
   def __getitem__(self, index):
     if 'Playlist Items' not in self.data: raise IndexError
-    id = self.data['Playlist Items'][index]['Track ID']
-    return self._library_tracks[id]
+    return self._library_tracks[self.data['Playlist Items'][index]]
 
   def __len__(self):
     items = self.data.get('Playlist Items')
     return len(items) if items else 0
 
   def __iter__(self):
-    items = self.data.get('Playlist Items')
-    for item in items:
-      yield self._library_tracks[item['Track ID']]
+    tracks = self._library_tracks.data
+    for id in self.track_ids:
+      yield tracks[id]
 
 def main(argv=None):
   """Display the file paths to the tracks in an iTunes playlist.
@@ -160,27 +638,112 @@ Usage:
       help="Path to the iTunes/Music Library.xml file.")
   parser.add_argument("-p", "--playlist", default='Library',
       help="Name of the iTunes/Music playlist (or ? to list all playlists).")
+  parser.add_argument("-q", "--query",
+      help="Show the tracks matching a query rather than a playlist, e.g. "
+           "'genre:Classical - playlist:\"Car *\"'. Terms are playlist names, "
+           "genre:, artist:, album:, is:compilation and is:all, combined with "
+           "| (or), & (and), - (but not) and parentheses.")
+  parser.add_argument("-a", "--all", action="store_true",
+      help="Show every track in the library, streamed from the library file as "
+           "it is read.")
+  parser.add_argument("--format", choices=library_export.FORMATS,
+      help="Write a record of each track (or playlist, with -p ?) as a JSON "
+           "object per line or a tab-separated line, rather than file paths.")
+  parser.add_argument("--fields", default=",".join(library_export.DEFAULT_TRACK_FIELDS),
+      help="Comma-separated track fields to write with --format, from: %s "
+           "(default: %%(default)s)." % ", ".join(library_export.TRACK_FIELDS))
+  parser.add_argument("--no-cache", action="store_true",
+      help="Parse the library file rather than using the parsed library cache.")
+  parser.add_argument("--update-cache", action="store_true",
+      help="Parse the whole library into the parsed library cache, if it is out of "
+           "date, so that later runs for one playlist load from it.")
+  parser.add_argument("-w", "--workers", type=int,
+      help="Parse the library's tracks with this many processes.")
+  phase_stats.add_arguments(parser)
   args = parser.parse_args()
+  phase_stats.configure(args)
+
+  try:
+    fields = library_export.parse_fields(args.fields)
+  except ValueError as e:
+    print("[Error] %s" % e, file=sys.stderr)
+    return 1
 
-  itunes = iTunesLibrary(args.library)
+  try:
+    return show(args, fields)
+  except BrokenPipeError:
+    # The reader went away, e.g. head; don't complain about it on exit either.
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    return 1
 
+def show(args, fields):
+  library_xml = args.library or DEFAULT_LIBRARY_XML
+  use_cache = not args.no_cache
+  if args.update_cache:
+    iTunesLibrary(args.library, use_cache=True, workers=args.workers)
+    return 0
   if args.playlist == '?':
-    print('Music Folder: %s' % itunes.music_folder)
-    print('[%d playlists]' % len(itunes.playlists))
-    for playlist_name, playlist in sorted(itunes.playlists.items()):
-      print('%s (%d tracks)' % (playlist_name, len(playlist)))
+    with STATS.phase("stream_playlists"):
+      if args.format:
+        writer = RecordWriter(sys.stdout, args.format, library_export.PLAYLIST_FIELDS)
+        stream_playlists(library_xml, lambda name, count: writer.write((name, count)),
+                         use_cache)
+        writer.flush()
+        return 0
+      playlists = [ ]
+      music_folder = stream_playlists(library_xml,
+                                      lambda name, count: playlists.append((name, count)),
+                                      use_cache)
+    print('Music Folder: %s' % music_folder)
+    print('[%d playlists]' % len(playlists))
+    for playlist_name, count in sorted(playlists):
+      print('%s (%d tracks)' % (playlist_name, count))
     return 0
 
-  try:
-    playlist = itunes.playlists[args.playlist]
-  except KeyError:
-    print("[Error] No such playlist: '%s'" % args.playlist, file=sys.stderr)
-    return 1
+  writer = RecordWriter(sys.stdout, args.format, fields) if args.format else None
+  if args.all:
+    with STATS.phase("stream_tracks"):
+      stream_tracks(library_xml, writer.write_track if writer else show_track, use_cache)
+    if writer:
+      writer.flush()
+    return 0
+
+  if args.query:
+    itunes = iTunesLibrary(args.library, use_cache=use_cache, workers=args.workers)
+  else:
+    itunes = iTunesLibrary(args.library, args.playlist, use_cache=use_cache,
+                           workers=args.workers)
+
+  if args.query:
+    try:
+      with STATS.phase("query"):
+        playlist = itunes.index.select(args.query)
+    except QueryError as e:
+      print("[Error] %s" % e, file=sys.stderr)
+      return 1
+  else:
+    try:
+      playlist = itunes.playlists[args.playlist]
+    except KeyError:
+      print("[Error] No such playlist: '%s'" % args.playlist, file=sys.stderr)
+      return 1
 
   for track in playlist:
-    file_path = track['File Path']
-    if file_path:
-      print(file_path)
+    if writer:
+      writer.write_track(track)
+    else:
+      show_track(track)
+  if writer:
+    writer.flush()
+  return 0
+
+def show_track(track):
+  STATS.count("tracks_seen")
+  file_path = track['File Path']
+  if file_path:
+    print(file_path)
+  else:
+    STATS.count("tracks_without_file_path")
 
 
 if __name__ == "__main__":
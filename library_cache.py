@@ -0,0 +1,181 @@
+from array import array
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+def cache_home():
+  return os.getenv("XDG_CACHE_HOME") or os.path.join(os.getenv("HOME", "/tmp"), ".cache")
+
+class LibraryCache(object):
+  """
+  An SQLite cache of the parsed contents of an iTunes Library.xml file. The
+  cache is keyed on the library's path and is invalidated when its mtime or
+  size changes. Tracks and playlists are stored as rows so that a single
+  playlist and its tracks can be loaded without reading the rest. Tracks are
+  stored as dicts of their fields and turned back into records by make_track.
+  """
+  SCHEMA_VERSION = "3"
+
+  def __init__(self, library_xml_path, cache_dir=None, make_track=dict):
+    self.make_track = make_track
+    self.library_xml_path = os.path.realpath(library_xml_path)
+    if cache_dir is None:
+      cache_dir = os.path.join(cache_home(), "sync-playlist")
+    digest = hashlib.sha1(self.library_xml_path.encode("utf-8")).hexdigest()[:16]
+    self.cache_path = os.path.join(cache_dir, "library-%s.sqlite" % digest)
+
+  def fingerprint(self):
+    st = os.stat(self.library_xml_path)
+    return "%s:%d:%d" % (self.SCHEMA_VERSION, st.st_mtime_ns, st.st_size)
+
+  def load(self, playlist_name=None):
+    """
+    Return the cached library data in the same shape as LibraryHandler.data,
+    or None if the cache is missing or stale. If playlist_name is given only
+    that playlist and its tracks are loaded.
+    """
+    start = time.time()
+    db, meta = self.connect()
+    if db is None:
+      return None
+    try:
+      data = { 'Music Folder': meta["music_folder"] }
+      if playlist_name is None:
+        rows = db.execute("SELECT data, items FROM playlists ORDER BY position")
+      else:
+        # The last of several playlists with the same name, as when the whole
+        # library is loaded into a dict by name.
+        rows = db.execute("SELECT data, items FROM playlists WHERE name = ? "
+                          "ORDER BY position DESC LIMIT 1", (playlist_name,))
+      data['Playlists'] = [self.decode_playlist(pl, items) for pl, items in rows]
+      if playlist_name is None:
+        rows = db.execute("SELECT id, data FROM tracks")
+        data['Tracks'] = dict((id, self.decode_track(track)) for id, track in rows)
+      else:
+        data['Tracks'] = self.load_playlist_tracks(db, data['Playlists'])
+    except (sqlite3.Error, KeyError, ValueError) as e:
+      self.report("miss (%s)" % e)
+      return None
+    finally:
+      db.close()
+    self.report("hit, %d playlists and %d tracks loaded in %d ms" % (
+        len(data['Playlists']), len(data['Tracks']), (time.time() - start) * 1000))
+    return data
+
+  def connect(self):
+    """
+    Return (connection, meta) for the cache if it is up to date, or (None,
+    None) if it is missing or stale.
+    """
+    if not os.path.isfile(self.cache_path):
+      self.report("miss (no cache)")
+      return None, None
+    try:
+      db = sqlite3.connect(self.cache_path)
+    except sqlite3.Error as e:
+      self.report("miss (%s)" % e)
+      return None, None
+    try:
+      meta = dict(db.execute("SELECT key, value FROM meta"))
+      if meta.get("fingerprint") == self.fingerprint():
+        return db, meta
+      self.report("miss (stale)")
+    except sqlite3.Error as e:
+      self.report("miss (%s)" % e)
+    db.close()
+    return None, None
+
+  def stream_tracks(self, on_track):
+    """
+    Pass each cached track to on_track, in Track ID order, a row at a time.
+    Returns False, without calling on_track, if the cache isn't usable.
+    """
+    db, meta = self.connect()
+    if db is None:
+      return False
+    try:
+      for (track,) in db.execute("SELECT data FROM tracks ORDER BY id"):
+        on_track(self.decode_track(track))
+    finally:
+      db.close()
+    return True
+
+  def stream_playlists(self, on_playlist):
+    """
+    Pass the name and number of tracks of each cached playlist to
+    on_playlist, without reading any tracks. Returns the music folder, or
+    None if the cache isn't usable.
+    """
+    db, meta = self.connect()
+    if db is None:
+      return None
+    try:
+      for name, items in db.execute("SELECT name, items FROM playlists ORDER BY position"):
+        on_playlist(name, len(json.loads(items)) if items is not None else 0)
+    finally:
+      db.close()
+    return meta["music_folder"]
+
+  def load_playlist_tracks(self, db, playlists, batch_size=500):
+    track_ids = sorted(set(id for pl in playlists for id in pl.get('Playlist Items', ())))
+    tracks = { }
+    for i in range(0, len(track_ids), batch_size):
+      batch = track_ids[i:i + batch_size]
+      query = "SELECT id, data FROM tracks WHERE id IN (%s)" % ",".join("?" * len(batch))
+      for id, track in db.execute(query, batch):
+        tracks[id] = self.decode_track(track)
+    return tracks
+
+  def decode_track(self, track):
+    return self.make_track(json.loads(track))
+
+  def decode_playlist(self, playlist, items):
+    playlist = json.loads(playlist)
+    if items is not None:
+      playlist['Playlist Items'] = array('i', json.loads(items))
+    return playlist
+
+  def store(self, data):
+    """Replace the cache with the given LibraryHandler.data."""
+    start = time.time()
+    os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (self.cache_path, os.getpid())
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    try:
+      db.executescript("""
+        CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE tracks (id INTEGER PRIMARY KEY, data TEXT);
+        CREATE TABLE playlists (position INTEGER PRIMARY KEY, name TEXT,
+                                data TEXT, items TEXT);
+        CREATE INDEX playlists_name ON playlists (name);
+      """)
+      db.executemany("INSERT INTO meta VALUES (?, ?)", [
+          ("fingerprint", self.fingerprint()),
+          ("music_folder", data['Music Folder']),
+      ])
+      db.executemany("INSERT INTO tracks VALUES (?, ?)",
+          ((id, json.dumps(dict(track.items()))) for id, track in data['Tracks'].items()))
+      db.executemany("INSERT INTO playlists VALUES (?, ?, ?, ?)",
+          self.encode_playlists(data['Playlists']))
+      db.commit()
+    finally:
+      db.close()
+    os.replace(tmp_path, self.cache_path)
+    self.report("stored %d playlists and %d tracks in %d ms" % (
+        len(data['Playlists']), len(data['Tracks']), (time.time() - start) * 1000))
+
+  def encode_playlists(self, playlists):
+    for position, playlist in enumerate(playlists):
+      fields = dict((k, v) for k, v in playlist.items() if k != 'Playlist Items')
+      items = playlist.get('Playlist Items')
+      if items is not None:
+        items = json.dumps(items.tolist())
+      yield (position, playlist.get('Name'), json.dumps(fields), items)
+
+  def report(self, message):
+    print("Library cache %s: %s" % (self.cache_path, message), file=sys.stderr)
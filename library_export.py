@@ -0,0 +1,65 @@
+import json
+
+FORMATS = ('ndjson', 'tsv')
+TRACK_FIELDS = ('track_id', 'name', 'artist', 'album', 'genre', 'compilation', 'size',
+                'rating', 'date_added', 'location', 'file_path')
+DEFAULT_TRACK_FIELDS = ('track_id', 'name', 'artist', 'album', 'genre', 'file_path')
+PLAYLIST_FIELDS = ('name', 'tracks')
+
+TSV_ESCAPES = str.maketrans({ '\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r' })
+
+def parse_fields(text):
+  """Return the track fields named in a comma-separated list, checking them."""
+  fields = tuple(field.strip() for field in text.split(',') if field.strip())
+  unknown = [field for field in fields if field not in TRACK_FIELDS]
+  if unknown or not fields:
+    raise ValueError("Unknown fields: %s (choose from %s)" % (
+        ", ".join(unknown) or "none given", ", ".join(TRACK_FIELDS)))
+  return fields
+
+def tsv_value(value):
+  if value is None:
+    return ''
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  return str(value).translate(TSV_ESCAPES)
+
+class RecordWriter(object):
+  """
+  Writes records, as tuples of values for the given fields, to a text stream
+  as newline-delimited JSON objects or as tab-separated lines under a header
+  line. Lines are gathered and written batch_size at a time, so writing a
+  record costs little more than formatting it, and nothing holds more than a
+  batch of them.
+  """
+  def __init__(self, out, format, fields, batch_size=512):
+    if format not in FORMATS:
+      raise ValueError("Unknown format %r" % format)
+    self.out = out
+    self.fields = fields
+    self.batch_size = batch_size
+    self.lines = [ ]
+    self.format_record = self.ndjson if format == 'ndjson' else self.tsv
+    if format == 'tsv':
+      self.lines.append('\t'.join(fields) + '\n')
+
+  def ndjson(self, values):
+    return json.dumps(dict(zip(self.fields, values)), ensure_ascii=False,
+                      separators=(',', ':')) + '\n'
+
+  def tsv(self, values):
+    return '\t'.join(map(tsv_value, values)) + '\n'
+
+  def write(self, values):
+    self.lines.append(self.format_record(values))
+    if len(self.lines) >= self.batch_size:
+      self.flush()
+
+  def write_track(self, track):
+    self.write([getattr(track, field) for field in self.fields])
+
+  def flush(self):
+    if self.lines:
+      self.out.write(''.join(self.lines))
+      self.lines = [ ]
+    self.out.flush()
@@ -0,0 +1,135 @@
+import fnmatch
+import re
+
+from phase_stats import STATS
+
+class QueryError(ValueError):
+  pass
+
+# Tokens of a query: parentheses, the set operators, and terms that are
+# either field:value or a bare playlist name, with values optionally quoted.
+TOKEN_RE = re.compile(r'''
+  \s*(?:
+    (?P<op>[()|&-])
+  | (?:(?P<field>[a-z]+):)?(?:"(?P<quoted>[^"]*)"|(?P<bare>[^\s()|&"]+))
+  )''', re.VERBOSE)
+
+class LibraryIndex(object):
+  """
+  Secondary indexes over a loaded library, built once: the tracks in each
+  playlist, the playlists each track is in, and the tracks with each genre,
+  artist and album (compared case-insensitively) or marked as compilations.
+  Each index maps to a set of Track IDs, so queries are set operations
+  rather than scans of the tracks.
+  """
+  FIELDS = ('genre', 'artist', 'album')
+
+  def __init__(self, itunes):
+    with STATS.phase("build_index"):
+      self.tracks = itunes.tracks.data
+      self.all = frozenset(self.tracks)
+      self.playlists = dict((name, frozenset(playlist.track_ids))
+                            for name, playlist in itunes.playlists.items())
+      self.track_playlists = { }
+      for name, ids in self.playlists.items():
+        for id in ids:
+          self.track_playlists.setdefault(id, [ ]).append(name)
+      self.fields = dict((field, { }) for field in self.FIELDS)
+      self.compilations = set()
+      for id, track in self.tracks.items():
+        for field in self.FIELDS:
+          value = getattr(track, field)
+          if value is not None:
+            self.fields[field].setdefault(value.casefold(), set()).add(id)
+        if track.compilation:
+          self.compilations.add(id)
+
+  def playlists_of(self, id):
+    """Return the names of the playlists a track is in."""
+    return sorted(self.track_playlists.get(int(id), ()))
+
+  def term(self, field, value):
+    """Return the set of Track IDs for one term of a query."""
+    if field in (None, 'playlist'):
+      if value in self.playlists:
+        return self.playlists[value]
+      names = fnmatch.filter(self.playlists, value)
+      if not names:
+        raise QueryError("No such playlist: '%s'" % value)
+      return frozenset().union(*(self.playlists[name] for name in names))
+    if field in self.fields:
+      return self.fields[field].get(value.casefold(), frozenset())
+    if field == 'is' and value == 'compilation':
+      return self.compilations
+    if field == 'is' and value == 'all':
+      return self.all
+    raise QueryError("Unknown query term: %s:%s" % (field, value))
+
+  def query(self, expression):
+    """
+    Return the set of Track IDs matching a query. A query combines terms with
+    | (union), & (intersection) and - (difference), with & binding tightest
+    and parentheses for grouping. Terms are:
+
+      "Playlist Name" or playlist:"Name"  the tracks of a playlist, or of all
+                                          the playlists matching a glob
+      genre:X, artist:X, album:X          tracks with that field, ignoring case
+      is:compilation, is:all              compilations, or every track
+
+    For example: genre:Classical - playlist:"Car *"
+    """
+    tokens = self.tokenize(expression)
+    result, rest = self.parse_union(tokens)
+    if rest:
+      raise QueryError("Unexpected %r in query" % (rest[0][1],))
+    return result
+
+  def select(self, expression):
+    """Return the tracks matching a query, in Track ID order."""
+    return [self.tracks[id] for id in sorted(self.query(expression))]
+
+  def tokenize(self, expression):
+    tokens = [ ]
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+      match = TOKEN_RE.match(expression, position)
+      if not match or match.end() == position:
+        raise QueryError("Can't parse query at: %s" % expression[position:])
+      position = match.end()
+      if match.group('op'):
+        tokens.append(('op', match.group('op')))
+      else:
+        value = match.group('quoted')
+        if value is None:
+          value = match.group('bare')
+        tokens.append(('term', (match.group('field'), value)))
+    return tokens
+
+  def parse_union(self, tokens):
+    result, tokens = self.parse_intersection(tokens)
+    while tokens and tokens[0] in (('op', '|'), ('op', '-')):
+      op = tokens[0][1]
+      right, tokens = self.parse_intersection(tokens[1:])
+      result = result | right if op == '|' else result - right
+    return result, tokens
+
+  def parse_intersection(self, tokens):
+    result, tokens = self.parse_operand(tokens)
+    while tokens and tokens[0] == ('op', '&'):
+      right, tokens = self.parse_operand(tokens[1:])
+      result = result & right
+    return result, tokens
+
+  def parse_operand(self, tokens):
+    if not tokens:
+      raise QueryError("Query ends too soon")
+    kind, value = tokens[0]
+    if kind == 'term':
+      return self.term(*value), tokens[1:]
+    if value == '(':
+      result, tokens = self.parse_union(tokens[1:])
+      if not tokens or tokens[0] != ('op', ')'):
+        raise QueryError("Missing ) in query")
+      return result, tokens[1:]
+    raise QueryError("Unexpected %r in query" % value)
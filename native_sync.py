@@ -0,0 +1,472 @@
+import errno
+import os
+import shutil
+import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from dest_manifest import DestinationManifest
+import hash_cache
+from phase_stats import STATS
+from sync_journal import SyncJournal
+
+# One step of a sync plan. op is one of 'delete', 'rmdir', 'mkdir', 'copy' or
+# 'replace'. src_path and size are None for steps that don't copy anything.
+SyncAction = namedtuple('SyncAction', 'op rel_path src_path size')
+
+# The outcome of running one SyncAction.
+SyncResult = namedtuple('SyncResult', 'action ok bytes_copied error')
+
+COPY_CHUNK = 8 * 1024 * 1024
+TMP_SUFFIX = ".sync-tmp"
+
+# Like shutil, only use sendfile() between files on Linux; elsewhere, such as
+# on macOS, it only writes to sockets.
+USE_SENDFILE = sys.platform.startswith('linux') and hasattr(os, 'sendfile')
+USE_KERNEL_COPY = USE_SENDFILE or hasattr(os, 'copy_file_range')
+
+def is_excluded(name):
+  """Hidden files are neither copied nor deleted, like rsync --exclude=.*"""
+  return name.startswith('.')
+
+def scan_tree(top, follow_links, mtimes=None):
+  """
+  Return ({relative file path: size}, set of relative dir paths) for a tree,
+  skipping excluded names. With follow_links, symlinks are copied as the files
+  they point to, like rsync --copy-links. If an mtimes dict is given it is
+  filled in with the mtime_ns of each file.
+  """
+  files = { }
+  dirs = set()
+  if not os.path.isdir(top):
+    return files, dirs
+  for root, dirnames, filenames in os.walk(top, followlinks=follow_links):
+    rel_root = os.path.relpath(root, top)
+    rel_root = "" if rel_root == "." else rel_root + "/"
+    dirnames[:] = [d for d in dirnames if not is_excluded(d)]
+    for d in dirnames:
+      if not follow_links and os.path.islink(os.path.join(root, d)):
+        files[rel_root + d] = 0
+      else:
+        dirs.add(rel_root + d)
+    for name in filenames:
+      if is_excluded(name):
+        continue
+      path = os.path.join(root, name)
+      try:
+        st = os.stat(path) if follow_links else os.lstat(path)
+      except OSError as e:
+        print("Skipping unreadable file %s: %s" % (path, e.strerror), file=sys.stderr)
+        continue
+      files[rel_root + name] = st.st_size
+      if mtimes is not None:
+        mtimes[rel_root + name] = st.st_mtime_ns
+  return files, dirs
+
+def plan_sync(src_dir, dest_dir, delete=True):
+  """
+  Compare a source tree with a destination tree by size, like rsync
+  --size-only, and return the list of SyncActions that would make the
+  destination match. Deletions come first, deepest paths first, followed by
+  directory creation and then the copies.
+  """
+  src_files, src_dirs = scan_tree(src_dir, follow_links=True)
+  dest_files, dest_dirs = scan_tree(dest_dir, follow_links=False)
+  return make_plan(src_dir, src_files, src_dirs, dest_files, dest_dirs, delete)
+
+def make_plan(src_dir, src_files, src_dirs, dest_files, dest_dirs, delete=True,
+              src_sources=None, dest_sources=None, src_digests=None, dest_digests=None):
+  """
+  Make a sync plan from the scanned trees. If the source files each file was
+  copied from are known, a file is also replaced when its source has changed,
+  and if digests are given, when its contents have. If src_dir is None,
+  files are copied straight from their sources.
+  """
+  actions = [ ]
+  if delete:
+    for rel_path in sorted(dest_files, reverse=True):
+      if rel_path not in src_files:
+        actions.append(SyncAction('delete', rel_path, None, None))
+    for rel_path in sorted(dest_dirs, reverse=True):
+      if rel_path not in src_dirs:
+        actions.append(SyncAction('rmdir', rel_path, None, None))
+  for rel_path in sorted(src_dirs):
+    if rel_path not in dest_dirs:
+      actions.append(SyncAction('mkdir', rel_path, None, None))
+  for rel_path, size in sorted(src_files.items()):
+    if rel_path in dest_dirs:
+      op = 'replace'
+    elif rel_path not in dest_files:
+      op = 'copy'
+    elif dest_files[rel_path] != size:
+      op = 'replace'
+    elif dest_sources and dest_sources.get(rel_path) not in (None, src_sources[rel_path]):
+      op = 'replace'
+    elif src_digests and dest_digests.get(rel_path) != src_digests[rel_path]:
+      op = 'replace'
+    else:
+      continue
+    src_path = src_sources[rel_path] if src_dir is None else os.path.join(src_dir, rel_path)
+    actions.append(SyncAction(op, rel_path, src_path, size))
+  return actions
+
+def temp_path(dest_path):
+  dest_dir, name = os.path.split(dest_path)
+  return os.path.join(dest_dir, ".%s%s" % (name, TMP_SUFFIX))
+
+def copy_file(src_path, dest_path):
+  """
+  Copy src_path to a temporary name next to dest_path, then rename it into
+  place so that an interrupted copy never leaves a partial file behind. The
+  data is flushed to the device before the rename, so a pulled cable can't
+  leave a renamed but incomplete file either. Returns the number of bytes
+  copied.
+  """
+  copied = 0
+  tmp_path = temp_path(dest_path)
+  try:
+    if USE_KERNEL_COPY:
+      with open(src_path, 'rb') as src, open(tmp_path, 'wb') as dest:
+        copied = copy_fd(src, dest)
+        os.fsync(dest.fileno())
+    else:
+      # shutil copies in the kernel where it can, with fcopyfile() on macOS.
+      shutil.copyfile(src_path, tmp_path)
+      with open(tmp_path, 'rb+') as dest:
+        copied = os.fstat(dest.fileno()).st_size
+        os.fsync(dest.fileno())
+    os.replace(tmp_path, dest_path)
+  except BaseException:
+    if os.path.lexists(tmp_path):
+      os.remove(tmp_path)
+    raise
+  return copied
+
+def copy_fd(src, dest):
+  """Copy an open file in the kernel where possible."""
+  src_fd, dest_fd = src.fileno(), dest.fileno()
+  copied = 0
+  for kernel_copy in (getattr(os, 'copy_file_range', None),
+                      kernel_sendfile if USE_SENDFILE else None):
+    if kernel_copy is None:
+      continue
+    try:
+      while True:
+        n = kernel_copy(src_fd, dest_fd, COPY_CHUNK)
+        if n == 0:
+          return copied
+        copied += n
+    except OSError as e:
+      # Not supported between these file systems, so fall back, but only if
+      # nothing has been written yet.
+      if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                   errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOTSOCK):
+        raise
+  shutil.copyfileobj(src, dest, COPY_CHUNK)
+  return dest.tell()
+
+def kernel_sendfile(src_fd, dest_fd, count):
+  return os.sendfile(dest_fd, src_fd, None, count)
+
+def describe(action):
+  return "%-7s %s%s" % (action.op, action.rel_path, "/" if action.op in ('mkdir', 'rmdir') else "")
+
+def run_action(dest_dir, action):
+  dest_path = os.path.join(dest_dir, action.rel_path)
+  try:
+    copied = 0
+    if action.op == 'delete':
+      os.remove(dest_path)
+    elif action.op == 'rmdir':
+      os.rmdir(dest_path)
+    elif action.op == 'mkdir':
+      os.makedirs(dest_path, exist_ok=True)
+    else:
+      if os.path.isdir(dest_path) and not os.path.islink(dest_path):
+        shutil.rmtree(dest_path)
+      copied = copy_file(action.src_path, dest_path)
+  except OSError as e:
+    return SyncResult(action, False, 0, e)
+  return SyncResult(action, True, copied, None)
+
+def run_plan(dest_dir, actions, dry_run=False, jobs=4, on_result=None):
+  """
+  Carry out a sync plan. Deletions and directory creation run in order, and
+  the copies run on a pool of jobs threads. Returns a list of SyncResults in
+  plan order; nothing is touched for a dry run. on_result, if given, is
+  called with each result as it comes in.
+  """
+  if dry_run:
+    for action in actions:
+      print(describe(action))
+    return [SyncResult(action, True, 0, None) for action in actions]
+
+  results = [ ]
+  copies = [ ]
+  for action in actions:
+    if action.op in ('copy', 'replace'):
+      copies.append(action)
+    else:
+      result = run_action(dest_dir, action)
+      report(result)
+      results.append(result)
+      if on_result:
+        on_result(result)
+  pool = ThreadPoolExecutor(max_workers=jobs)
+  try:
+    for result in pool.map(lambda action: run_action(dest_dir, action), copies):
+      report(result)
+      results.append(result)
+      if on_result:
+        on_result(result)
+  finally:
+    # On an interrupt, let the copies under way finish but start no more.
+    pool.shutdown(cancel_futures=True)
+  return results
+
+def report(result):
+  if result.ok:
+    print(describe(result.action))
+  else:
+    print("[Error] %s: %s" % (describe(result.action), result.error), file=sys.stderr)
+
+def summarize(results):
+  counts = dict((op, 0) for op in ('copy', 'replace', 'delete', 'rmdir', 'mkdir'))
+  errors = 0
+  copied = 0
+  for result in results:
+    if result.ok:
+      counts[result.action.op] += 1
+      copied += result.bytes_copied
+    else:
+      errors += 1
+  return ("%(copy)d copied, %(replace)d replaced, %(delete)d deleted, "
+          "%(mkdir)d dirs created, %(rmdir)d dirs removed" % counts +
+          ", %d bytes, %d errors" % (copied, errors))
+
+def scan_sources(src_dir, src_files):
+  """Return {relative path: the file it links to} for a staging tree."""
+  return dict((rel_path, os.path.realpath(os.path.join(src_dir, rel_path)))
+              for rel_path in src_files)
+
+def load_manifest(manifest, verify=False):
+  """
+  Load a destination's manifest, or rebuild it by scanning the destination if
+  it is missing or verify is set.
+  """
+  if manifest.load() and not verify:
+    return
+  dest_dir = os.path.dirname(manifest.path)
+  print("Scanning %s" % dest_dir, file=sys.stderr)
+  mtimes = { }
+  dest_files, dest_dirs = scan_tree(dest_dir, follow_links=False, mtimes=mtimes)
+  known = manifest.files
+  manifest.files = { }
+  for rel_path, size in dest_files.items():
+    mtime_ns = mtimes.get(rel_path, 0)
+    source = digest = None
+    if rel_path in known:
+      source = known[rel_path][2]
+      # The digest still holds if the file hasn't been touched since.
+      if known[rel_path][:2] == (size, mtime_ns):
+        digest = known[rel_path][3]
+    manifest.set_file(rel_path, size, mtime_ns, source, digest)
+  manifest.dirs = set(dest_dirs)
+  STATS.count("dest_scans")
+
+def record_plan(manifest, plan):
+  """
+  Bring a destination's manifest up to date after rsync has made the
+  destination match a StagingPlan. rsync --size-only leaves a file alone if
+  its size matches, so the entry for such a file still holds; only the files
+  it copied are stat'ed.
+  """
+  dest_dir = os.path.dirname(manifest.path)
+  known = manifest.files
+  manifest.files = { }
+  for staged in plan:
+    entry = known.get(staged.rel_path)
+    if entry is not None and entry[0] == staged.size:
+      manifest.set_file(staged.rel_path, entry[0], entry[1], staged.src_path, entry[3])
+      continue
+    try:
+      st = os.stat(os.path.join(dest_dir, staged.rel_path))
+    except OSError:
+      continue
+    manifest.set_file(staged.rel_path, st.st_size, st.st_mtime_ns, staged.src_path)
+  manifest.dirs = set(plan.dirs())
+
+def fill_dest_digests(manifest, src_files, mode, jobs=4):
+  """
+  Hash the destination files that are the same size as their source but have
+  no digest of the given mode in the manifest, so they can be compared by
+  content. This reads each of them once; after that the manifest remembers.
+  """
+  dest_dir = os.path.dirname(manifest.path)
+  unknown = [rel_path for rel_path, entry in manifest.files.items()
+             if rel_path in src_files and entry[0] == src_files[rel_path] and
+             hash_cache.digest_mode(entry[3]) != mode]
+  if not unknown:
+    return
+  print("Hashing %d files on %s" % (len(unknown), dest_dir), file=sys.stderr)
+  with STATS.phase("hash"), ThreadPoolExecutor(max_workers=jobs) as pool:
+    digests = pool.map(lambda rel_path: hash_cache.file_digest(
+        os.path.join(dest_dir, rel_path), mode), unknown)
+    for rel_path, digest in zip(unknown, digests):
+      size, mtime_ns, source, _ = manifest.files[rel_path]
+      manifest.set_file(rel_path, size, mtime_ns, source, digest)
+
+def plan_manifest_sync(src_dir, manifest, delete=True, hashes=None, staged=None):
+  """
+  Plan a sync against the destination's manifest, which load_manifest has
+  read or rebuilt, rather than walking the destination. The source is the
+  files of a StagingPlan if staged is given, and otherwise the tree under
+  src_dir. With a HashCache, files are also compared by their digests.
+  Returns the actions, and the source path and digest of each file to be
+  synced.
+  """
+  if staged is None:
+    src_files, src_dirs = scan_tree(src_dir, follow_links=True)
+    src_sources = scan_sources(src_dir, src_files)
+  else:
+    src_dir = None
+    src_files, src_dirs, src_sources = staged.sizes(), set(staged.dirs()), staged.sources()
+  src_digests = None
+  if hashes is not None:
+    by_source = hashes.digests(src_sources.values())
+    src_digests = dict((rel_path, by_source[source]) for rel_path, source in src_sources.items())
+    fill_dest_digests(manifest, src_files, hashes.mode, hashes.jobs)
+  actions = make_plan(src_dir, src_files, src_dirs, manifest.sizes(), manifest.dirs, delete,
+                      src_sources, manifest.sources(), src_digests, manifest.digests())
+  return actions, src_sources, src_digests
+
+def record_result(manifest, result, source=None, digest=None):
+  """Record the outcome of one action in the manifest."""
+  action = result.action
+  if action.op in ('copy', 'replace'):
+    manifest.files.pop(action.rel_path, None)
+    if result.ok:
+      manifest.dirs.discard(action.rel_path)
+      st = os.stat(os.path.join(os.path.dirname(manifest.path), action.rel_path))
+      manifest.set_file(action.rel_path, st.st_size, st.st_mtime_ns, source, digest)
+  elif not result.ok:
+    return
+  elif action.op == 'delete':
+    manifest.files.pop(action.rel_path, None)
+  elif action.op == 'rmdir':
+    manifest.dirs.discard(action.rel_path)
+  elif action.op == 'mkdir':
+    manifest.dirs.add(action.rel_path)
+
+def update_manifest(manifest, results, src_sources, src_digests=None):
+  """Record the outcome of a sync in the manifest."""
+  src_digests = src_digests or { }
+  for result in results:
+    rel_path = result.action.rel_path
+    record_result(manifest, result, src_sources.get(rel_path), src_digests.get(rel_path))
+  # Files that were already in place were copied from the same source.
+  for rel_path, (size, mtime_ns, source, digest) in list(manifest.files.items()):
+    if source is None and rel_path in src_sources:
+      manifest.set_file(rel_path, size, mtime_ns, src_sources[rel_path], digest)
+
+def replay_journal(manifest, planned, done, dry_run=False):
+  """
+  Record in the manifest the actions that an interrupted sync completed, and
+  remove the temporary files of the copies it didn't, or for a dry run, only
+  say which would be removed.
+  """
+  dest_dir = os.path.dirname(manifest.path)
+  for fields, source, digest in planned:
+    action = SyncAction(*fields)
+    if (action.op, action.rel_path) in done:
+      try:
+        record_result(manifest, SyncResult(action, True, 0, None), source, digest)
+      except OSError:
+        pass
+    elif action.op in ('copy', 'replace'):
+      tmp_path = temp_path(os.path.join(dest_dir, action.rel_path))
+      if not os.path.lexists(tmp_path):
+        continue
+      if dry_run:
+        print("Would remove %s, left by an interrupted sync" % tmp_path, file=sys.stderr)
+      else:
+        os.remove(tmp_path)
+
+def sync_directories(src_dir, dest_dir, dry_run=False, delete=True, jobs=4, verify=False,
+                     hashes=None, resume=False, staged=None, manifest=None):
+  """
+  Make dest_dir match src_dir, or the StagingPlan staged if one is given,
+  and return the list of SyncResults. The destination's manifest, or manifest
+  if it has already been loaded, is used in place of a scan, and updated
+  after the sync. With a HashCache, files whose contents changed are replaced
+  even if their size didn't.
+
+  The sync is journaled on the destination. The work done by an interrupted
+  sync is always recorded in the manifest; with resume, the rest of its plan
+  is carried out rather than planning again.
+  """
+  with STATS.phase("sync_plan"):
+    plan = prepare_sync(src_dir, dest_dir, dry_run, delete, verify, hashes, resume, staged,
+                        manifest)
+  with STATS.phase("sync_copy"):
+    results = run_plan(dest_dir, plan.actions, dry_run, jobs, plan.journal.done)
+  finish_sync(plan, results, dry_run)
+  print(summarize(results), file=sys.stderr)
+  return results
+
+# A planned sync to one destination, with what finish_sync needs to record it.
+DestinationPlan = namedtuple('DestinationPlan',
+                             'dest_dir manifest journal actions src_sources src_digests')
+
+def prepare_sync(src_dir, dest_dir, dry_run=False, delete=True, verify=False, hashes=None,
+                 resume=False, staged=None, manifest=None):
+  """
+  Plan a sync of src_dir, or of the StagingPlan staged, to dest_dir, or pick
+  up an interrupted one with resume, and unless this is a dry run, write the
+  journal of the plan. The destination's manifest is loaded unless it is
+  given, already loaded. Returns a DestinationPlan.
+  """
+  source = os.path.abspath(src_dir) if staged is None else staged.key()
+  if manifest is None:
+    manifest = DestinationManifest(dest_dir)
+    load_manifest(manifest, verify)
+  journal = SyncJournal(dest_dir)
+  unfinished = journal.load()
+  if unfinished:
+    replay_journal(manifest, unfinished[1], unfinished[2], dry_run)
+  if resume and unfinished and unfinished[0] == source:
+    _, planned, done = unfinished
+    print("Resuming an interrupted sync to %s, %d of %d actions already done" % (
+        dest_dir, len(done), len(planned)), file=sys.stderr)
+    actions = [SyncAction(*fields) for fields, _, _ in planned
+               if tuple(fields[:2]) not in done]
+    src_sources = dict((fields[1], source) for fields, source, _ in planned)
+    src_digests = dict((fields[1], digest) for fields, _, digest in planned)
+  else:
+    if resume:
+      print("No interrupted sync of %s to %s to resume" % (
+          src_dir if staged is None else "this playlist", dest_dir), file=sys.stderr)
+    actions, src_sources, src_digests = plan_manifest_sync(src_dir, manifest, delete, hashes,
+                                                           staged)
+  if not dry_run:
+    try:
+      manifest.save()
+      journal.start(source, actions, src_sources, src_digests)
+    except OSError as e:
+      print("[Error] Couldn't write the journal %s: %s" % (journal.path, e), file=sys.stderr)
+  return DestinationPlan(dest_dir, manifest, journal, actions, src_sources, src_digests)
+
+def finish_sync(plan, results, dry_run=False):
+  """Record the results of a planned sync in its manifest and close its journal."""
+  if dry_run:
+    return
+  try:
+    update_manifest(plan.manifest, results, plan.src_sources, plan.src_digests)
+    plan.manifest.save()
+    plan.journal.finish()
+  except OSError as e:
+    print("[Error] Couldn't write the manifest %s: %s" % (plan.manifest.path, e),
+          file=sys.stderr)
+  STATS.count("bytes_copied", sum(result.bytes_copied for result in results))
+  STATS.count("files_copied", sum(1 for result in results
+                                  if result.ok and result.action.op in ('copy', 'replace')))
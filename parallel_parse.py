@@ -0,0 +1,135 @@
+import mmap
+import re
+import xml.parsers.expat
+from concurrent.futures import ProcessPoolExecutor
+
+from itunes_playlist import (LibraryHandler, ParseComplete, PlaylistFilterHandler,
+                             iTunesTrack)
+
+TRACKS_KEY = b'<key>Tracks</key>'
+PLAYLISTS_KEY = b'<key>Playlists</key>'
+TRACK_START_RE = re.compile(rb'<key>\d+</key>\s*<dict>')
+
+# Each chunk of the Tracks dict is wrapped in this to make a plist of its own.
+CHUNK_PREFIX = b'<plist><dict><key>Tracks</key><dict>'
+CHUNK_SUFFIX = b'</dict></dict></plist>'
+
+def find_tracks_body(mm):
+  """
+  Return the (start, end) offsets of the contents of the Tracks dict in a
+  mapped Library.xml, or None if it can't be found.
+  """
+  key = mm.find(TRACKS_KEY)
+  if key < 0:
+    return None
+  start = mm.find(b'<dict>', key)
+  empty = mm.find(b'<dict/>', key)
+  if start < 0 or (0 <= empty < start):
+    return None
+  start += len(b'<dict>')
+  playlists = mm.find(PLAYLISTS_KEY, start)
+  if playlists < 0:
+    return None
+  end = mm.rfind(b'</dict>', start, playlists)
+  if end < 0:
+    return None
+  return start, end
+
+def split_tracks(mm, start, end, chunks):
+  """Split the Tracks dict contents at track boundaries into (start, end) pairs."""
+  bounds = [start]
+  step = max(1, (end - start) // chunks)
+  for offset in range(start + step, end, step):
+    if offset <= bounds[-1]:
+      continue
+    match = TRACK_START_RE.search(mm, offset, end)
+    if not match:
+      break
+    if match.start() > bounds[-1]:
+      bounds.append(match.start())
+  bounds.append(end)
+  return list(zip(bounds[:-1], bounds[1:]))
+
+def parse_chunk(library_xml_path, start, end, track_ids=None):
+  """
+  Parse one chunk of the Tracks dict in a worker process, returning a list of
+  (Track ID, iTunesTrack values) for the tracks in it, keeping only those in
+  track_ids if it is given.
+  """
+  with open(library_xml_path, 'rb') as f:
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      chunk = mm[start:end]
+    finally:
+      mm.close()
+  if track_ids is None:
+    handler = LibraryHandler()
+  else:
+    handler = PlaylistFilterHandler(None, track_ids)
+  parser = make_expat_parser(handler)
+  try:
+    parser.Parse(CHUNK_PREFIX, False)
+    parser.Parse(chunk, False)
+    parser.Parse(CHUNK_SUFFIX, True)
+  except ParseComplete:
+    pass
+  return [(id, track.values()) for id, track in handler.data['Tracks'].items()]
+
+def make_expat_parser(handler):
+  parser = xml.parsers.expat.ParserCreate()
+  parser.SetParamEntityParsing(xml.parsers.expat.XML_PARAM_ENTITY_PARSING_NEVER)
+  parser.buffer_text = True
+  parser.StartElementHandler = handler.startElement
+  parser.EndElementHandler = handler.endElement
+  parser.CharacterDataHandler = handler.characters
+  return parser
+
+def parse_outside_tracks(mm, start, end, handler):
+  """Parse everything except the contents of the Tracks dict with handler."""
+  parser = make_expat_parser(handler)
+  try:
+    parser.Parse(mm[:start], False)
+    parser.Parse(mm[end:], True)
+  except ParseComplete:
+    pass
+
+def parallel_parse(library_xml_path, workers, playlist_name=None):
+  """
+  Parse a Library.xml file, splitting the Tracks dict into chunks that are
+  parsed by a pool of worker processes. The rest of the file is parsed in
+  this process. Returns the same data as LibraryHandler, or as
+  iTunesLibrary.parse_playlist if playlist_name is given, or None if the
+  Tracks dict can't be located.
+  """
+  with open(library_xml_path, 'rb') as f:
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    body = find_tracks_body(mm)
+    if body is None:
+      return None
+    start, end = body
+    if playlist_name is None:
+      handler = LibraryHandler()
+      track_ids = None
+    else:
+      handler = PlaylistFilterHandler(playlist_name)
+    parse_outside_tracks(mm, start, end, handler)
+    data = handler.data
+    if playlist_name is not None:
+      track_ids = set()
+      for playlist in data['Playlists']:
+        track_ids.update(playlist.get('Playlist Items', ()))
+      if not data['Playlists']:
+        return data
+    chunks = split_tracks(mm, start, end, workers * 4)
+  finally:
+    mm.close()
+
+  tracks = data['Tracks']
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    futures = [pool.submit(parse_chunk, library_xml_path, chunk_start, chunk_end, track_ids)
+               for chunk_start, chunk_end in chunks]
+    for future in futures:
+      for id, values in future.result():
+        tracks[id] = iTunesTrack.from_values(values)
+  return data
@@ -0,0 +1,84 @@
+import os
+import stat
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+class PathResolver(object):
+  """
+  Resolves symlinks in many file paths at once, like os.path.realpath, for
+  libraries on network file systems where every lstat is a round trip.
+
+  Each directory is resolved once from its already-resolved parent and the
+  result is cached, so the tracks of an album share the lookups for the
+  album, artist and music folder directories. The file itself is lstat'ed in
+  the same pass, which also tells whether it exists and its size. Directories
+  and files are resolved on a thread pool.
+  """
+  def __init__(self, jobs=16):
+    self.jobs = jobs
+    self.dirs = { '/': '/' }
+
+  def resolve_dir(self, path):
+    resolved = self.dirs.get(path)
+    if resolved is None:
+      parent, name = os.path.split(path)
+      candidate = os.path.join(self.resolve_dir(parent), name)
+      if os.path.islink(candidate):
+        resolved = os.path.realpath(candidate)
+      else:
+        resolved = candidate
+      self.dirs[path] = resolved
+    return resolved
+
+  def resolve_file(self, path):
+    """Return (resolved path, its size, or None if it doesn't exist)."""
+    if not self.is_simple(path):
+      resolved = os.path.realpath(path)
+      return resolved, file_size(resolved)
+    parent, name = os.path.split(path)
+    candidate = os.path.join(self.dirs[parent], name)
+    try:
+      st = os.lstat(candidate)
+    except OSError:
+      return candidate, None
+    if stat.S_ISLNK(st.st_mode):
+      resolved = os.path.realpath(candidate)
+      return resolved, file_size(resolved)
+    return candidate, st.st_size
+
+  def is_simple(self, path):
+    # Relative paths and paths with . or .. components are left to realpath.
+    return (os.path.isabs(path) and path == os.path.normpath(path) and
+            not path.startswith('//'))
+
+  def resolve(self, paths):
+    """
+    Resolve a list of file paths, returning a list of (resolved path, size
+    or None if it doesn't exist) in the same order.
+    """
+    parents = set(os.path.dirname(path) for path in paths if self.is_simple(path))
+    with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+      # Resolve the shallowest directories first so that deeper ones find
+      # their parents in the cache.
+      by_depth = { }
+      for parent in parents:
+        by_depth.setdefault(parent.count('/'), [ ]).append(parent)
+      for depth in sorted(by_depth):
+        list(pool.map(self.resolve_dir, by_depth[depth]))
+      return list(pool.map(self.resolve_file, paths))
+
+def file_size(path):
+  try:
+    return os.stat(path).st_size
+  except OSError:
+    return None
+
+def report_missing(missing, limit=20):
+  """Print one summary of the tracks whose files don't exist."""
+  if not missing:
+    return
+  print("%d tracks are missing their files:" % len(missing), file=sys.stderr)
+  for path in missing[:limit]:
+    print("  %s" % path, file=sys.stderr)
+  if len(missing) > limit:
+    print("  ... and %d more" % (len(missing) - limit), file=sys.stderr)
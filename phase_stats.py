@@ -0,0 +1,161 @@
+import atexit
+import contextlib
+import cProfile
+import json
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+def peak_rss_kb():
+  """The peak resident set size of this process, in KB."""
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in bytes on macOS, and in kilobytes on Linux.
+  return peak // 1024 if sys.platform == 'darwin' else peak
+
+class Stats(object):
+  """
+  Collects wall and CPU time per named phase, peak memory, and counters for
+  a run of one of the tools. Phases may nest and may be entered many times,
+  from any thread; their times accumulate. Nothing is printed unless report()
+  is called.
+
+  Until enabled is set, by configure() for --stats or --profile, phases and
+  counters cost next to nothing, so they can go around work done per track.
+  """
+  NO_PHASE = contextlib.nullcontext()
+
+  def __init__(self):
+    self.enabled = False
+    self.phases = { }
+    self.counters = { }
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.start = time.perf_counter()
+    self.trace_memory = False
+    self.profile_phase = None
+    self.profile_output = None
+    self.profiler = None
+
+  @property
+  def stack(self):
+    stack = getattr(self.local, 'stack', None)
+    if stack is None:
+      stack = self.local.stack = [ ]
+    return stack
+
+  def count(self, name, n=1):
+    if not self.enabled:
+      return
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def phase(self, name):
+    """A context manager that times the named phase, if stats are enabled."""
+    if not self.enabled:
+      return self.NO_PHASE
+    return self.timed_phase(name)
+
+  @contextlib.contextmanager
+  def timed_phase(self, name):
+    profile = (name == self.profile_phase)
+    if profile:
+      if self.profiler is None:
+        self.profiler = cProfile.Profile()
+      self.profiler.enable()
+    frame = { 'peak': 0 }
+    self.stack.append(frame)
+    if self.trace_memory:
+      self.note_child_peak()
+      tracemalloc.reset_peak()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+      yield
+    finally:
+      wall = time.perf_counter() - wall
+      cpu = time.process_time() - cpu
+      if profile:
+        self.profiler.disable()
+      stack = self.stack
+      stack.pop()
+      with self.lock:
+        phase = self.phases.setdefault(name, { 'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0 })
+        phase['calls'] += 1
+        phase['wall_s'] += wall
+        phase['cpu_s'] += cpu
+        phase['peak_rss_kb'] = peak_rss_kb()
+      if self.trace_memory:
+        peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+        phase['peak_traced_kb'] = max(phase.get('peak_traced_kb', 0), peak // 1024)
+        if stack:
+          stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+
+  def note_child_peak(self):
+    # Resetting the tracemalloc peak for a nested phase would lose the
+    # enclosing phase's peak so far, so remember it first.
+    if len(self.stack) > 1:
+      parent = self.stack[-2]
+      parent['peak'] = max(parent['peak'], tracemalloc.get_traced_memory()[1])
+
+  def as_dict(self):
+    return {
+      'total_wall_s': time.perf_counter() - self.start,
+      'total_cpu_s': time.process_time(),
+      'peak_rss_kb': peak_rss_kb(),
+      'phases': self.phases,
+      'counters': self.counters,
+    }
+
+  def report(self, format='text', file=sys.stderr):
+    """Print the stats as text or json, and write the profile if any."""
+    if self.profiler is not None:
+      self.profiler.dump_stats(self.profile_output)
+      print("Wrote profile of phase '%s' to %s" % (self.profile_phase, self.profile_output),
+            file=file)
+    if format is None:
+      return
+    stats = self.as_dict()
+    if format == 'json':
+      print(json.dumps(stats, indent=2, sort_keys=True), file=file)
+      return
+    print("\nstats:", file=file)
+    for name, phase in self.phases.items():
+      line = "%-24s %9.3fs wall %9.3fs cpu %6d calls %9d KB peak RSS" % (
+          name, phase['wall_s'], phase['cpu_s'], phase['calls'], phase['peak_rss_kb'])
+      if 'peak_traced_kb' in phase:
+        line += " %9d KB peak traced" % phase['peak_traced_kb']
+      print(line, file=file)
+    for name, value in sorted(self.counters.items()):
+      print("%-24s %d" % (name, value), file=file)
+    print("%-24s %9.3fs wall %9.3fs cpu %15s %9d KB peak RSS" % (
+        "total", stats['total_wall_s'], stats['total_cpu_s'], "", stats['peak_rss_kb']),
+        file=file)
+
+
+# The stats for this process, shared by all the modules.
+STATS = Stats()
+
+def add_arguments(parser):
+  parser.add_argument("--stats", nargs="?", const="text", choices=("text", "json"),
+      help="Print time, memory and counters per phase on stderr when done.")
+  parser.add_argument("--trace-memory", action="store_true",
+      help="With --stats, also trace Python allocations to get peak memory "
+           "per phase (slower).")
+  parser.add_argument("--profile",
+      metavar="PHASE",
+      help="Profile the named phase with cProfile.")
+  parser.add_argument("--profile-output",
+      help="Where to write the --profile data (default PHASE.prof).")
+
+def configure(args):
+  """Set up STATS from the add_arguments options, reporting at exit."""
+  if args.trace_memory:
+    STATS.trace_memory = True
+    tracemalloc.start()
+  if args.profile:
+    STATS.profile_phase = args.profile
+    STATS.profile_output = args.profile_output or "%s.prof" % args.profile
+  if args.stats or args.profile:
+    STATS.enabled = True
+    atexit.register(STATS.report, args.stats)
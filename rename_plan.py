@@ -0,0 +1,242 @@
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from library_cache import cache_home
+from phase_stats import STATS
+
+TEMP_PREFIX = ".clean-"
+
+def scan_dir(path):
+  """Return (mtime_ns, [(name, is_dir)]) for one directory."""
+  entries = [ ]
+  with os.scandir(path) as it:
+    for entry in it:
+      entries.append((entry.name, entry.is_dir(follow_symlinks=False)))
+  return os.stat(path).st_mtime_ns, entries
+
+class CleanJournal(object):
+  """
+  Remembers, per directory tree, the directories whose entries were already
+  clean and their mtimes, so that a re-run can skip listing and cleaning any
+  directory that hasn't changed since. Only the names of its subdirectories
+  are kept, to carry on the walk.
+  """
+  VERSION = 1
+
+  def __init__(self, top):
+    digest = hashlib.sha1(os.path.realpath(top).encode("utf-8")).hexdigest()[:16]
+    self.path = os.path.join(cache_home(), "sync-playlist", "clean-%s.json" % digest)
+    self.dirs = { }
+
+  def load(self):
+    try:
+      with open(self.path, encoding="utf-8") as f:
+        journal = json.load(f)
+      if journal.get("version") == self.VERSION:
+        self.dirs = journal["dirs"]
+    except (OSError, ValueError, KeyError):
+      self.dirs = { }
+
+  def save(self, clean_dirs):
+    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+    tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+    with open(tmp_path, "w", encoding="utf-8") as f:
+      json.dump({ "version": self.VERSION, "dirs": clean_dirs }, f)
+    os.replace(tmp_path, self.path)
+
+
+class RenamePlanner(object):
+  """
+  Cleans the names in a directory tree in three steps. The tree is listed
+  with os.scandir on a pool of threads, one directory per task. Then the new
+  name of every entry is worked out in memory, and names that would collide
+  in a directory (ignoring case, for FAT and HFS targets, if ignore_case is
+  set) are reported before anything is touched. Finally the renames run
+  deepest directories first, with the directories at each depth renamed in
+  parallel.
+
+  A new name may be the current name of another entry that is itself being
+  renamed, since cleaning a clean name can change it again ("The The Band"
+  becomes "The Band, The", which becomes "Band, The, The"). Such an entry is
+  renamed out of the way first, and a cycle of them goes by a temporary name.
+  """
+  def __init__(self, cleaner, jobs=8, ignore_case=False, use_journal=True):
+    self.cleaner = cleaner
+    self.jobs = jobs
+    self.ignore_case = ignore_case
+    self.use_journal = use_journal
+
+  def scan(self, top, journal):
+    """
+    Return {directory: (mtime_ns, [(name, is_dir)])} for every directory
+    that needs its entries checked, and {directory: [mtime_ns, subdir names]} for the ones
+    that were skipped as unchanged.
+    """
+    listings = { }
+    skipped = { }
+    with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+      pending = { pool.submit(self.scan_or_skip, top, journal): top }
+      while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+          path = pending.pop(future)
+          mtime_ns, entries, cached = future.result()
+          if entries is None:
+            skipped[path] = [mtime_ns, cached]
+            subdirs = cached
+          else:
+            listings[path] = (mtime_ns, entries)
+            subdirs = [name for name, is_dir in entries if is_dir]
+          for name in subdirs:
+            subdir = os.path.join(path, name)
+            pending[pool.submit(self.scan_or_skip, subdir, journal)] = subdir
+    return listings, skipped
+
+  def scan_or_skip(self, path, journal):
+    known = journal.dirs.get(path)
+    if known is not None:
+      try:
+        mtime_ns = os.stat(path).st_mtime_ns
+      except OSError:
+        mtime_ns = None
+      if mtime_ns == known[0]:
+        return mtime_ns, None, known[1]
+    try:
+      mtime_ns, entries = scan_dir(path)
+    except OSError as e:
+      print("[Error] Skipping %s: %s" % (path, e.strerror), file=sys.stderr)
+      return None, [ ], None
+    return mtime_ns, entries, None
+
+  def plan(self, listings):
+    """
+    Return ({directory: [(old name, new name)]}, [collision messages]).
+    """
+    renames = { }
+    collisions = [ ]
+    for path, (_, entries) in listings.items():
+      targets = { }
+      dir_renames = [ ]
+      for name, _ in entries:
+        with STATS.phase("clean_name"):
+          new_name = self.cleaner.clean_name(name)
+        if new_name != name:
+          dir_renames.append((name, new_name))
+        key = new_name.casefold() if self.ignore_case else new_name
+        targets.setdefault(key, [ ]).append(name)
+      for key, names in targets.items():
+        if len(names) > 1:
+          collisions.append("%s: %s all become %s" % (
+              path, ", ".join(repr(name) for name in sorted(names)),
+              repr(self.cleaner.clean_name(names[0]))))
+      if dir_renames:
+        renames[path] = self.order_renames(dir_renames, [name for name, _ in entries])
+    return renames, collisions
+
+  def key(self, name):
+    return name.casefold() if self.ignore_case else name
+
+  def order_renames(self, dir_renames, names):
+    """
+    Order the renames in one directory so that none of them replaces an entry
+    that hasn't been renamed away yet. The new names don't collide, so each
+    is the current name of at most one other entry, and the renames form
+    chains and cycles; each chain is renamed from its free end.
+    """
+    new_names = dict(dir_renames)
+    renamed_from = dict((self.key(name), name) for name, _ in dir_renames)
+    taken = set(self.key(name) for name in names)
+    ordered = [ ]
+    done = set()
+    for name, _ in dir_renames:
+      chain = [ ]
+      in_chain = set()
+      while name is not None and name not in done and name not in in_chain:
+        chain.append(name)
+        in_chain.add(name)
+        name = renamed_from.get(self.key(new_names[name]))
+        if name == chain[-1]:
+          # Only a change of case, ignored by the file system.
+          name = None
+      done.update(chain)
+      if name in in_chain:
+        first = chain[0]
+        temp_name = TEMP_PREFIX + first
+        while self.key(temp_name) in taken:
+          temp_name = TEMP_PREFIX + temp_name
+        ordered.append((first, temp_name))
+        ordered.extend((name, new_names[name]) for name in reversed(chain[1:]))
+        ordered.append((temp_name, new_names[first]))
+      else:
+        ordered.extend((name, new_names[name]) for name in reversed(chain))
+    return ordered
+
+  def rename_dir(self, path, dir_renames, dry_run):
+    dry = "would " if dry_run else ""
+    errors = 0
+    for name, new_name in dir_renames:
+      old_path, new_path = os.path.join(path, name), os.path.join(path, new_name)
+      # One write, so that lines from different threads don't interleave.
+      sys.stdout.write("%srename: %s\n     -> %s\n" % (dry, old_path, new_path))
+      STATS.count("renames")
+      if not dry_run:
+        try:
+          os.rename(old_path, new_path)
+        except OSError as e:
+          print("[Error] rename %s: %s" % (old_path, e), file=sys.stderr)
+          errors += 1
+    return errors
+
+  def run(self, top, dry_run=True):
+    """Clean the names under top, returning False if anything went wrong."""
+    print("%s filenames in %s" % ("Checking" if dry_run else "Cleaning", top))
+    journal = CleanJournal(top)
+    if self.use_journal:
+      journal.load()
+    with STATS.phase("scan"):
+      listings, skipped = self.scan(top, journal)
+    STATS.count("dirs_skipped", len(skipped))
+    renames, collisions = self.plan(listings)
+    if collisions:
+      print("[Error] Not renaming anything, because these names would collide:",
+            file=sys.stderr)
+      for collision in sorted(collisions):
+        print("  %s" % collision, file=sys.stderr)
+      return False
+
+    errors = 0
+    with STATS.phase("rename"), ThreadPoolExecutor(max_workers=self.jobs) as pool:
+      by_depth = { }
+      for path in renames:
+        by_depth.setdefault(path.count(os.sep), [ ]).append(path)
+      for depth in sorted(by_depth, reverse=True):
+        paths = sorted(by_depth[depth])
+        errors += sum(pool.map(lambda path: self.rename_dir(path, renames[path], dry_run),
+                               paths))
+
+    if self.use_journal:
+      # Directories are only remembered once they are clean and haven't been
+      # renamed themselves, which a re-run will confirm.
+      clean_dirs = dict(skipped)
+      for path, (mtime_ns, entries) in listings.items():
+        if path not in renames and mtime_ns is not None:
+          clean_dirs[path] = [mtime_ns, [name for name, is_dir in entries if is_dir]]
+      renamed = set(os.path.join(path, name) for path, dir_renames in renames.items()
+                    for name, _ in dir_renames)
+      clean_dirs = dict((path, known) for path, known in clean_dirs.items()
+                        if not is_under(path, renamed))
+      journal.save(clean_dirs)
+    return errors == 0
+
+def is_under(path, renamed):
+  """Whether path is, or is inside, one of the renamed paths."""
+  while True:
+    if path in renamed:
+      return True
+    parent = os.path.dirname(path)
+    if parent == path:
+      return False
+    path = parent
@@ -0,0 +1,86 @@
+import bisect
+import hashlib
+from collections import namedtuple
+
+# A file to put on a destination: its path relative to the top of the
+# destination (or staging directory), the file it comes from, and its size.
+StagedFile = namedtuple('StagedFile', 'rel_path src_path size')
+
+class StagingPlan(object):
+  """
+  The files of a playlist as they are to be laid out on a destination, as a
+  list of StagedFiles sorted by relative path. If two files are given the
+  same path, the first one is kept.
+
+  The native engine syncs straight from a plan, without a staging directory.
+  For rsync, which needs a tree on disk to copy, the plan is written out as a
+  farm of symlinks.
+
+  tracks maps the relative path of each file that came from a playlist to
+  (its position in the playlist, its iTunesTrack), for deciding which to
+  leave out when the plan doesn't fit.
+  """
+  def __init__(self, files=(), tracks=None):
+    self.tracks = tracks or { }
+    self.files = [ ]
+    seen = set()
+    for staged in files:
+      if staged[0] not in seen:
+        seen.add(staged[0])
+        self.files.append(StagedFile(*staged))
+    self.files.sort()
+
+  def __iter__(self):
+    return iter(self.files)
+
+  def __len__(self):
+    return len(self.files)
+
+  def add(self, rel_path, src_path, size):
+    """Add a file in its place, unless there's already one at rel_path."""
+    i = bisect.bisect_left(self.files, (rel_path,))
+    if i < len(self.files) and self.files[i].rel_path == rel_path:
+      return False
+    self.files.insert(i, StagedFile(rel_path, src_path, size))
+    return True
+
+  def dirs(self):
+    """
+    Return every directory the files need, each once, parents before their
+    children. Neighbouring files mostly share a directory, so each file costs
+    one comparison.
+    """
+    dirs = [ ]
+    seen = set()
+    last = None
+    for staged in self.files:
+      parent = staged.rel_path.rpartition('/')[0]
+      if parent == last:
+        continue
+      last = parent
+      new = [ ]
+      while parent and parent not in seen:
+        seen.add(parent)
+        new.append(parent)
+        parent = parent.rpartition('/')[0]
+      dirs.extend(reversed(new))
+    return dirs
+
+  def sizes(self):
+    return dict((staged.rel_path, staged.size) for staged in self.files)
+
+  def sources(self):
+    return dict((staged.rel_path, staged.src_path) for staged in self.files)
+
+  def total_size(self):
+    return sum(staged.size for staged in self.files)
+
+  def key(self):
+    """
+    A name for the plan's contents, which stands in for the staging directory
+    when journaling a sync, so that only the same plan is resumed.
+    """
+    h = hashlib.sha1()
+    for staged in self.files:
+      h.update(("%s\0%s\0%d\n" % staged).encode("utf-8", "surrogateescape"))
+    return "plan:%s" % h.hexdigest()
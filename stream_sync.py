@@ -0,0 +1,247 @@
+import itertools
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from clean_filenames import FilenameCleaner
+from dest_manifest import DestinationManifest
+import hash_cache
+from hash_cache import HashCache
+from itunes_playlist import iTunesLibrary
+import native_sync
+from native_sync import SyncAction, SyncResult
+from path_resolver import PathResolver, report_missing
+from phase_stats import STATS
+from staging_plan import StagingPlan
+import sync_playlist
+
+RESOLVE_BATCH = 256
+# How often the manifest is saved while streaming, so that an interrupted
+# sync keeps what it had copied.
+SAVE_SECONDS = 10.0
+
+def iter_links(playlist, music_folder, cleaner, dirty=False, resolve_jobs=16,
+               batch_size=RESOLVE_BATCH):
+  """
+  Yield (relative path, file path, size) for each track of a playlist whose
+  file exists, as build_staging_plan would place it. Paths are resolved a
+  batch at a time, so the first tracks are ready while the rest are still to
+  come.
+  """
+  path_prefix = os.path.realpath(music_folder) + "/Music"
+  resolver = PathResolver(resolve_jobs)
+  missing = [ ]
+
+  def with_file_paths():
+    for track in playlist:
+      STATS.count("tracks_seen")
+      if not track["File Path"]:
+        STATS.count("tracks_without_file_path")
+        continue
+      yield track
+
+  tracks = with_file_paths()
+  while True:
+    batch = list(itertools.islice(tracks, batch_size))
+    if not batch:
+      break
+    with STATS.phase("resolve_paths"):
+      resolved = resolver.resolve([track["File Path"] for track in batch])
+    for track, (file_path, size) in zip(batch, resolved):
+      if size is None:
+        missing.append(file_path)
+        continue
+      yield (sync_playlist.link_path(track, file_path, path_prefix, cleaner, dirty), file_path,
+             size)
+
+  STATS.count("tracks_missing", len(missing))
+  report_missing(missing)
+
+def parent_dirs(rel_path):
+  """Yield the directories above a relative path, outermost first."""
+  pieces = rel_path.split('/')[:-1]
+  for i in range(1, len(pieces) + 1):
+    yield '/'.join(pieces[:i])
+
+class StreamSync(object):
+  """
+  Copies files to a destination as they arrive, rather than planning the
+  whole sync first. Each (relative path, source path, size) is compared with
+  the destination's manifest and, if it needs copying, handed to a pool of
+  copy threads. No more than twice as many copies as there are threads are
+  queued at once, which holds back whatever is producing the paths. Files
+  and directories that weren't seen are deleted at the end. With a
+  HashCache, files are compared by their digests too. The manifest is saved
+  every SAVE_SECONDS and when the sync ends, however it ends.
+  """
+  def __init__(self, dest_dir, dry_run=False, jobs=4, verify=False, delete=True, hashes=None):
+    self.dest_dir = dest_dir
+    self.hashes = hashes
+    self.dry_run = dry_run
+    self.jobs = jobs
+    self.delete = delete
+    self.manifest = DestinationManifest(dest_dir)
+    native_sync.load_manifest(self.manifest, verify)
+    self.wanted = set()
+    self.wanted_dirs = set()
+    self.results = [ ]
+    self.pending = { }
+    self.saved_at = time.monotonic()
+
+  def run(self, links):
+    """
+    Sync an iterable of (relative path, source path, size); return the
+    SyncResults.
+    """
+    try:
+      with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+        try:
+          for rel_path, src_path, size in links:
+            action = self.plan(rel_path, src_path, size)
+            if action is None:
+              continue
+            if self.dry_run and not self.hashes:
+              self.finish(SyncResult(action, True, 0, None), src_path)
+              continue
+            while len(self.pending) >= 2 * self.jobs:
+              self.collect(wait(self.pending, return_when=FIRST_COMPLETED).done)
+            entry = self.manifest.files.get(rel_path)
+            future = pool.submit(self.sync_file, action, entry)
+            self.pending[future] = (rel_path, src_path, entry)
+        finally:
+          # Record the copies already under way, even if interrupted.
+          self.collect(wait(self.pending).done)
+      if self.delete:
+        self.delete_unwanted()
+    finally:
+      self.save()
+    return self.results
+
+  def save(self):
+    if self.dry_run:
+      return
+    try:
+      self.manifest.save()
+    except OSError as e:
+      print("[Error] Couldn't write the manifest %s: %s" % (self.manifest.path, e),
+            file=sys.stderr)
+    self.saved_at = time.monotonic()
+
+  def plan(self, rel_path, src_path, size):
+    """
+    Return the SyncAction to bring one file up to date, or None if it's known
+    to be. With a HashCache, a file that matches its manifest entry gets a
+    'check' action, as only its digest can show whether it needs replacing.
+    """
+    # Like the symlink tree, the first track to claim a path keeps it.
+    if rel_path in self.wanted:
+      return None
+    self.wanted.add(rel_path)
+    for dir_path in parent_dirs(rel_path):
+      if dir_path in self.wanted_dirs:
+        continue
+      self.wanted_dirs.add(dir_path)
+      if dir_path in self.manifest.files:
+        self.run_now(SyncAction('delete', dir_path, None, None))
+      if dir_path not in self.manifest.dirs:
+        self.run_now(SyncAction('mkdir', dir_path, None, None))
+    entry = self.manifest.files.get(rel_path)
+    if rel_path in self.manifest.dirs:
+      op = 'replace'
+    elif entry is None:
+      op = 'copy'
+    elif entry[0] != size or entry[2] not in (None, src_path):
+      op = 'replace'
+    elif self.hashes:
+      op = 'check'
+    else:
+      if entry[2] is None:
+        self.manifest.set_file(rel_path, entry[0], entry[1], src_path, entry[3])
+      return None
+    return SyncAction(op, rel_path, src_path, size)
+
+  def sync_file(self, action, entry):
+    """
+    Carry out one file's action on a copy thread, hashing its source (and for
+    a 'check', the destination) first. Return the SyncResult, or None if the
+    file turned out to be up to date, along with the source's digest.
+    """
+    digest = self.hashes.digest(action.src_path) if self.hashes else None
+    if action.op == 'check':
+      if self.dest_digest(action.rel_path, entry) == digest:
+        return None, digest
+      action = action._replace(op='replace')
+    if self.dry_run:
+      return SyncResult(action, True, 0, None), digest
+    return native_sync.run_action(self.dest_dir, action), digest
+
+  def dest_digest(self, rel_path, entry):
+    if hash_cache.digest_mode(entry[3]) == self.hashes.mode:
+      return entry[3]
+    return hash_cache.file_digest(os.path.join(self.dest_dir, rel_path), self.hashes.mode)
+
+  def run_now(self, action):
+    if self.dry_run:
+      result = SyncResult(action, True, 0, None)
+    else:
+      result = native_sync.run_action(self.dest_dir, action)
+    self.finish(result)
+
+  def collect(self, futures):
+    for future in futures:
+      rel_path, src_path, entry = self.pending.pop(future)
+      result, digest = future.result()
+      if result is not None:
+        self.finish(result, src_path, digest)
+      elif entry[2] is None or entry[3] != digest:
+        self.manifest.set_file(rel_path, entry[0], entry[1], src_path, digest)
+    if time.monotonic() - self.saved_at >= SAVE_SECONDS:
+      self.save()
+
+  def finish(self, result, source=None, digest=None):
+    native_sync.report(result)
+    self.results.append(result)
+    if not self.dry_run:
+      native_sync.record_result(self.manifest, result, source, digest)
+
+  def delete_unwanted(self):
+    for rel_path in sorted(self.manifest.files, reverse=True):
+      if rel_path not in self.wanted:
+        self.run_now(SyncAction('delete', rel_path, None, None))
+    for rel_path in sorted(self.manifest.dirs, reverse=True):
+      if rel_path not in self.wanted_dirs:
+        self.run_now(SyncAction('rmdir', rel_path, None, None))
+
+
+def stream_playlist(playlist_name, dest_dir, my_dir, library_xml=None, dirty=False,
+                    use_cache=False, resolve_jobs=16, workers=None, dry_run=False,
+                    jobs=4, verify=False, checksum=None):
+  """
+  Sync a playlist straight to dest_dir without a staging directory, copying
+  each track as soon as its path has been worked out. Returns True if nothing
+  failed.
+  """
+  with STATS.phase("compute_symlink_paths"):
+    cleaner = FilenameCleaner(ccdict_path=my_dir)
+    itunes = iTunesLibrary(library_xml, playlist_name, use_cache=use_cache, workers=workers)
+  playlist = itunes.playlists[playlist_name]
+  intro = StagingPlan()
+  sync_playlist.link_intro(intro)
+  links = itertools.chain(
+      iter_links(playlist, itunes.music_folder, cleaner, dirty, resolve_jobs),
+      ((staged.rel_path, staged.src_path, staged.size) for staged in intro))
+  print("%s to %s" % ("Would stream" if dry_run else "Streaming", dest_dir), file=sys.stderr)
+  hashes = HashCache(checksum, jobs=jobs) if checksum else None
+  try:
+    with STATS.phase("stream"):
+      results = StreamSync(dest_dir, dry_run, jobs, verify, hashes=hashes).run(links)
+  finally:
+    if hashes:
+      hashes.close()
+  if not dry_run:
+    STATS.count("bytes_copied", sum(result.bytes_copied for result in results))
+    STATS.count("files_copied", sum(1 for result in results
+                                    if result.ok and result.action.op in ('copy', 'replace')))
+  print(native_sync.summarize(results), file=sys.stderr)
+  return all(result.ok for result in results)
@@ -0,0 +1,209 @@
+import json
+import os
+import re
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import capacity
+from clean_filenames import FilenameCleaner
+import hash_cache
+from itunes_playlist import iTunesLibrary
+from phase_stats import STATS
+import sync_playlist
+
+# Options that may be given at the top level of a job file as defaults, or
+# per job, and the command line options they default to.
+JOB_OPTIONS = {
+  "dirty": "dirty",
+  "engine": "engine",
+  "copy_jobs": "jobs",
+  "rebuild": "rebuild",
+  "force": "force",
+  "verify": "verify",
+  "checksum": "checksum",
+  "resume": "resume",
+  "no_space_check": "no_space_check",
+  "trim": "trim",
+}
+
+class SyncJob(object):
+  """One playlist to stage and sync to one destination."""
+  def __init__(self, index, playlist, dest_dir=None, name=None, **options):
+    self.playlist = playlist
+    self.dest_dir = dest_dir
+    self.name = name or playlist
+    self.options = options
+    self.staged = None
+    slug = re.sub(r'[^A-Za-z0-9]+', '-', self.name).strip('-') or "playlist"
+    self.staging_name = "%02d-%s" % (index, slug)
+
+  def __getattr__(self, option):
+    try:
+      return self.__dict__['options'][option]
+    except KeyError:
+      raise AttributeError(option)
+
+
+class SharedCleaner(object):
+  """
+  Wraps a FilenameCleaner to remember cleaned paths, since the same tracks
+  turn up in many of the playlists in a batch.
+  """
+  def __init__(self, cleaner):
+    self.cleaner = cleaner
+    self.cleaned = { }
+
+  def clean_name(self, name):
+    cleaned = self.cleaned.get(name)
+    if cleaned is None:
+      cleaned = self.cleaned[name] = self.cleaner.clean_name(name)
+    return cleaned
+
+
+def job_from_args(args):
+  """Make the one SyncJob described by the -p and -d command line options."""
+  return SyncJob(0, args.playlist, args.dest_dir,
+                 **dict((option, getattr(args, arg)) for option, arg in JOB_OPTIONS.items()))
+
+def load_job_file(path, args):
+  """
+  Read a JSON (or, with a .toml extension, TOML) job file. Returns the top
+  level settings and a list of SyncJobs. Options missing from a job come from
+  the top level of the file, then from the command line args.
+  """
+  if path.endswith(".toml"):
+    import tomllib
+    with open(path, "rb") as f:
+      config = tomllib.load(f)
+  else:
+    with open(path) as f:
+      config = json.load(f)
+  defaults = dict((option, config.get(option, getattr(args, arg)))
+                  for option, arg in JOB_OPTIONS.items())
+  jobs = [ ]
+  for index, job in enumerate(config.get("jobs", [ ])):
+    if "playlist" not in job:
+      raise ValueError("Job %d in %s has no playlist" % (index, path))
+    unknown = set(job) - set(JOB_OPTIONS) - set(("playlist", "dest_dir", "name"))
+    if unknown:
+      raise ValueError("Job %d in %s has unknown options: %s" % (
+          index, path, ", ".join(sorted(unknown))))
+    options = dict(defaults)
+    options.update(job)
+    check_options(options, "Job %d in %s" % (index, path))
+    jobs.append(SyncJob(index, **options))
+  return config, jobs
+
+def check_options(options, where):
+  """Raise ValueError for options that the job's engine can't carry out."""
+  if options["trim"] and options["trim"] not in capacity.TRIM_ORDERS:
+    raise ValueError("%s has an unknown trim order: %s (choose from %s)" % (
+        where, options["trim"], ", ".join(capacity.TRIM_ORDERS)))
+  if options["checksum"] and options["checksum"] not in hash_cache.MODES:
+    raise ValueError("%s has an unknown checksum mode: %s (choose from %s)" % (
+        where, options["checksum"], ", ".join(hash_cache.MODES)))
+  for option in ("checksum", "resume"):
+    if options[option] and options["engine"] != "native":
+      raise ValueError("%s sets %s, which needs engine \"native\"" % (where, option))
+
+def device_id(path):
+  return os.stat(path).st_dev
+
+def run_job_file(job_file, my_dir, args):
+  """
+  Run every job in a job file from one load of the library and one
+  FilenameCleaner. Each job is staged in its own directory under the
+  temp_dir, then the syncs run concurrently, with at most
+  device_concurrency syncs writing to any one device at a time.
+  """
+  try:
+    config, jobs = load_job_file(job_file, args)
+  except (OSError, ValueError) as e:
+    print("[Error] Bad job file %s: %s" % (job_file, e), file=sys.stderr)
+    return 1
+  temp_dir = config.get("temp_dir", args.temp_dir)
+  library_xml = config.get("library_xml", args.library_xml)
+  device_concurrency = config.get("device_concurrency", 1)
+
+  for job in jobs:
+    if job.dest_dir and not os.path.isdir(job.dest_dir):
+      print("[Error] Destination for %s must be a directory: %s" % (job.name, job.dest_dir),
+            file=sys.stderr)
+      return 1
+
+  with STATS.phase("compute_symlink_paths"):
+    itunes = iTunesLibrary(library_xml, use_cache=not args.no_cache, workers=args.workers)
+    cleaner = SharedCleaner(FilenameCleaner(ccdict_path=my_dir))
+  if not stage_jobs(jobs, itunes, cleaner, temp_dir, args.resolve_jobs):
+    return 1
+  ok = sync_all(jobs, device_concurrency)
+  if any(not job.force for job in jobs if job.dest_dir):
+    print("\nPass -f (or set \"force\" in the job file) to do it for real")
+  return 0 if ok else 1
+
+def stage_jobs(jobs, itunes, cleaner, temp_dir, resolve_jobs=16):
+  """
+  Work out the StagingPlan for each job from the loaded library. Jobs that
+  copy with the native engine sync from their plan; for the others, it's
+  also written as symlinks to the job's own staging directory. Returns False
+  if a playlist is missing.
+  """
+  for job in jobs:
+    if job.playlist not in itunes.playlists:
+      print("[Error] No such playlist: '%s'" % job.playlist, file=sys.stderr)
+      return False
+
+  with STATS.phase("compute_symlink_paths"):
+    for job in jobs:
+      job.staging_dir = os.path.join(temp_dir, job.staging_name)
+      print("Calculating symlinks for %s" % job.name, file=sys.stderr)
+      job.staged = sync_playlist.build_staging_plan(
+          itunes.playlists[job.playlist], itunes.music_folder, cleaner, job.dirty,
+          resolve_jobs)
+
+  for job in jobs:
+    if job.engine != "native" or not job.dest_dir:
+      sync_playlist.stage_symlinks(job.staging_dir, job.staged, job.rebuild)
+  return True
+
+def sync_all(jobs, device_concurrency=1):
+  """
+  Sync the staged jobs that have a destination, concurrently, with at most
+  device_concurrency syncs to any one device. Unless a job sets
+  no_space_check, its plan is first checked against the space on its
+  destination, and trimmed to fit if it sets trim. Returns True if none
+  failed.
+  """
+  sync_jobs = [job for job in jobs if job.dest_dir]
+  device_locks = { }
+  for job in sync_jobs:
+    device = device_id(job.dest_dir)
+    if device not in device_locks:
+      device_locks[device] = threading.BoundedSemaphore(device_concurrency)
+    job.device_lock = device_locks[device]
+
+  def sync_job(job):
+    with job.device_lock:
+      plan, manifest = job.staged, None
+      if not job.no_space_check:
+        with STATS.phase("preflight"):
+          plan, manifests = capacity.preflight(plan, [job.dest_dir], job.trim, job.verify)
+        if plan is None:
+          return False
+        manifest = manifests[job.dest_dir]
+        if job.engine != "native" and len(plan) != len(job.staged):
+          sync_playlist.stage_symlinks(job.staging_dir, plan)
+      print("Syncing %s to %s" % (job.name, job.dest_dir), file=sys.stderr)
+      return sync_playlist.sync_files(job.staging_dir, job.dest_dir, not job.force,
+                                      job.engine, job.copy_jobs, job.verify,
+                                      job.checksum, job.resume, plan, manifest)
+
+  ok = True
+  if sync_jobs:
+    with STATS.phase("sync"), ThreadPoolExecutor(max_workers=len(sync_jobs)) as pool:
+      for job, job_ok in zip(sync_jobs, pool.map(sync_job, sync_jobs)):
+        if not job_ok:
+          print("[Error] Sync of %s to %s failed" % (job.name, job.dest_dir), file=sys.stderr)
+          ok = False
+  return ok
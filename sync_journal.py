@@ -0,0 +1,88 @@
+import json
+import os
+import sys
+
+JOURNAL_NAME = ".sync-journal"
+
+class SyncJournal(object):
+  """
+  A write-ahead journal of a native sync, kept in a hidden file at the top of
+  the destination. The whole plan is written before anything is touched, and
+  each action is appended as done once it has completed, so an interrupted
+  sync can be picked up where it stopped without planning it again. The
+  journal is removed when a sync finishes.
+
+  Each planned action is stored with the source path and digest that the
+  manifest will record for it.
+  """
+  VERSION = 1
+
+  def __init__(self, dest_dir):
+    self.path = os.path.join(dest_dir, JOURNAL_NAME)
+    self.f = None
+
+  def load(self):
+    """
+    Return (src_dir, [(action fields, source, digest)], set of done
+    (op, rel_path)) from an unfinished sync, or None if there isn't one.
+    """
+    try:
+      with open(self.path, encoding="utf-8") as f:
+        lines = f.read().split("\n")
+    except FileNotFoundError:
+      return None
+    except OSError as e:
+      print("Ignoring unreadable journal %s: %s" % (self.path, e), file=sys.stderr)
+      return None
+    src_dir = None
+    planned = [ ]
+    done = set()
+    for line in lines:
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        # The last line may have been cut off part way through.
+        continue
+      if "version" in entry:
+        if entry["version"] != self.VERSION:
+          return None
+        src_dir = entry["src_dir"]
+      elif "plan" in entry:
+        fields, source, digest = entry["plan"][:4], entry["plan"][4], entry["plan"][5]
+        planned.append((tuple(fields), source, digest))
+      elif "done" in entry:
+        done.add(tuple(entry["done"]))
+    if src_dir is None:
+      return None
+    return src_dir, planned, done
+
+  def start(self, source, actions, src_sources, src_digests=None):
+    """
+    Write out the plan, replacing any previous journal. source names what is
+    being synced, the absolute path of a staging directory or a
+    StagingPlan's key, and is what load returns as src_dir.
+    """
+    src_digests = src_digests or { }
+    self.f = open(self.path, "w", encoding="utf-8")
+    self.write({ "version": self.VERSION, "src_dir": source })
+    for action in actions:
+      self.write({ "plan": list(action) + [src_sources.get(action.rel_path),
+                                           src_digests.get(action.rel_path)] })
+    self.f.flush()
+    os.fsync(self.f.fileno())
+
+  def done(self, result):
+    if self.f and result.ok:
+      self.write({ "done": [result.action.op, result.action.rel_path] })
+      self.f.flush()
+
+  def write(self, entry):
+    self.f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+  def finish(self):
+    """Close and remove the journal once its sync is over."""
+    if self.f:
+      self.f.close()
+      self.f = None
+    if os.path.exists(self.path):
+      os.remove(self.path)
@@ -6,8 +6,18 @@ import os
 import sys
 from subprocess import call
 
+import capacity
 from clean_filenames import FilenameCleaner
+from dest_manifest import DestinationManifest
 from itunes_playlist import iTunesLibrary
+from library_query import QueryError
+import hash_cache
+from hash_cache import HashCache
+import native_sync
+from path_resolver import PathResolver, report_missing
+import phase_stats
+from phase_stats import STATS
+from staging_plan import StagingPlan
 
 TMP_DIR = "/tmp/playlist-files"
 INTRO_MP3 = "%s/Music/Ringtones/+A.mp3" % os.getenv("HOME")
@@ -22,9 +32,14 @@ def main(argv=None):
   parser.add_argument("-p", "--playlist",
       help="Name of the iTunes playlist to copy. "
            "If not specified, the last collected symlinks run will be written")
-  parser.add_argument("-d", "--dest_dir",
+  parser.add_argument("-q", "--query",
+      help="Copy the tracks matching a query rather than a playlist; "
+           "see itunes_playlist.py --help for the syntax.")
+  parser.add_argument("-d", "--dest_dir", action="append",
       help="Path to the directory where the songs will be written. "
-           "If not specified, symlinks will be collected without copying them.")
+           "If not specified, symlinks will be collected without copying them. "
+           "Give it more than once to copy to several devices at once with the "
+           "native engine, reading each song only once.")
   parser.add_argument("-l", "--library_xml",
       help="Path to \"iTunes Library.xml\"")
   parser.add_argument("-t", "--temp_dir",
@@ -32,73 +47,283 @@ def main(argv=None):
       help="Path to the directory where symlinks will be collected.")
   parser.add_argument("--dirty", action="store_true",
       help="Don't clean filenames.")
+  parser.add_argument("--no-cache", action="store_true",
+      help="Parse the library file rather than using the parsed library cache.")
+  parser.add_argument("-w", "--workers", type=int,
+      help="Parse the library's tracks with this many processes.")
+  parser.add_argument("--symlinks", action="store_true",
+      help="Write the symlinks to --temp_dir even when the native engine is copying "
+           "the playlist, which it otherwise does without them.")
+  parser.add_argument("--rebuild", action="store_true",
+      help="Clear the staging directory and recreate every symlink, "
+           "rather than only updating the symlinks that changed.")
+  parser.add_argument("--engine", choices=("rsync", "native"), default="rsync",
+      help="Copy with rsync, or with the built-in parallel copier.")
+  parser.add_argument("-j", "--jobs", type=int, default=4,
+      help="Number of files the native engine copies at once.")
+  parser.add_argument("--verify", action="store_true",
+      help="Have the native engine scan the destination rather than trusting its manifest.")
+  parser.add_argument("--resume", action="store_true",
+      help="Have the native engine carry on with an interrupted sync to --dest_dir "
+           "from its journal, rather than planning it again.")
+  parser.add_argument("--checksum", choices=hash_cache.MODES,
+      help="Have the native engine also compare files by a digest of a sample of them, "
+           "or of all of them, so that retagged tracks of the same size are copied again. "
+           "Digests of the library's files are cached.")
+  parser.add_argument("--stream", action="store_true",
+      help="Copy each track with the native engine as soon as its path is known, "
+           "without a staging directory. Needs --playlist and --dest_dir.")
+  parser.add_argument("--resolve-jobs", type=int, default=16,
+      help="Number of track paths resolved at once, for libraries on network file systems.")
+  parser.add_argument("--trim", choices=capacity.TRIM_ORDERS,
+      help="If the playlist doesn't fit on --dest_dir, leave out tracks until it does: "
+           "the last in the playlist, the lowest rated or the least recently added. "
+           "Otherwise a playlist that doesn't fit is refused before anything is copied.")
+  parser.add_argument("--no-space-check", action="store_true",
+      help="Don't check that the playlist fits on --dest_dir before copying it.")
   parser.add_argument("-f", "--force", action="store_true",
       help="Really sync rather than just showing what rsync would do.")
+  parser.add_argument("--job-file",
+      help="Sync every playlist listed in this JSON or TOML file, from one load of the library.")
+  parser.add_argument("--watch", action="store_true",
+      help="Keep running, and resync the playlists of --job-file (or --playlist) whenever "
+           "they change in the library or their destination is mounted.")
+  parser.add_argument("--debounce", type=float, default=5.0,
+      help="With --watch, seconds the library must be unchanged before it is reread.")
+  phase_stats.add_arguments(parser)
   args = parser.parse_args()
+  phase_stats.configure(args)
 
-  if not args.playlist and not args.dest_dir:
-    print("Specify either --playlist or --dest_dir or both.", file=sys.stderr)
+  dest_dirs = args.dest_dir or [ ]
+  args.dest_dir = dest_dirs[0] if dest_dirs else None
+  if len(dest_dirs) > 1:
+    if args.watch or args.job_file or args.stream:
+      print("Several --dest_dir values can't be used with --watch, --job-file or --stream.",
+            file=sys.stderr)
+      return 1
+    args.engine = "native"
+
+  if args.checksum and args.engine != "native" and not args.stream:
+    print("--checksum needs --engine native or --stream.", file=sys.stderr)
+    return 1
+
+  if args.resume and args.engine != "native":
+    print("--resume needs --engine native.", file=sys.stderr)
     return 1
 
-  if args.dest_dir and not os.path.isdir(args.dest_dir):
-    print("Destination must be a directory: %s" % args.dest_dir, file=sys.stderr)
+  if args.watch:
+    if not args.job_file and not args.playlist:
+      print("--watch needs --job-file or --playlist.", file=sys.stderr)
+      return 1
+    import watch_sync
+    return watch_sync.watch(my_dir, args)
+
+  if args.job_file:
+    import sync_jobs
+    return sync_jobs.run_job_file(args.job_file, my_dir, args)
+
+  if not args.playlist and not args.query and not args.dest_dir:
+    print("Specify either --playlist (or --query) or --dest_dir or both.", file=sys.stderr)
     return 1
 
-  if args.playlist:
-    delete_directory_contents(args.temp_dir)
-    link_intro(args.temp_dir)
+  if args.playlist and args.query:
+    print("Specify only one of --playlist and --query.", file=sys.stderr)
+    return 1
+
+  for dest_dir in dest_dirs:
+    if not os.path.isdir(dest_dir):
+      print("Destination must be a directory: %s" % dest_dir, file=sys.stderr)
+      return 1
+
+  if args.stream:
+    if not args.playlist or not args.dest_dir:
+      print("--stream needs both --playlist and --dest_dir.", file=sys.stderr)
+      return 1
+    import stream_sync
+    ok = stream_sync.stream_playlist(args.playlist, args.dest_dir, my_dir, args.library_xml,
+                                     args.dirty, use_cache=not args.no_cache,
+                                     resolve_jobs=args.resolve_jobs, workers=args.workers,
+                                     dry_run=not args.force, jobs=args.jobs,
+                                     verify=args.verify, checksum=args.checksum)
+    if not args.force:
+      print("\nPass -f to do it for real")
+    return 0 if ok else 1
+
+  staged = None
+  manifests = { }
+  if args.playlist or args.query:
     print("Calculating symlinks", file=sys.stderr)
-    symlink_tree = compute_symlink_paths(args.playlist, my_dir, args.library_xml, args.dirty)
-    make_symlinks(args.temp_dir, symlink_tree)
+    try:
+      plan = compute_staging_plan(args.playlist, my_dir, args.library_xml, args.dirty,
+                                  use_cache=not args.no_cache,
+                                  resolve_jobs=args.resolve_jobs,
+                                  workers=args.workers, query=args.query)
+    except QueryError as e:
+      print("[Error] %s" % e, file=sys.stderr)
+      return 1
+    if dest_dirs and not args.no_space_check:
+      with STATS.phase("preflight"):
+        plan, manifests = capacity.preflight(plan, dest_dirs, args.trim, args.verify)
+      if plan is None:
+        return 1
+    if args.engine == "rsync" or not dest_dirs or args.symlinks:
+      stage_symlinks(args.temp_dir, plan, args.rebuild)
+    staged = plan
 
   dry_run = not args.force
-  if args.dest_dir:
-    sync_files(args.temp_dir, args.dest_dir, dry_run)
+  if len(dest_dirs) > 1:
+    with STATS.phase("sync"):
+      ok = fan_out_files(args.temp_dir, dest_dirs, dry_run, args.jobs, args.verify,
+                         args.checksum, args.resume, staged, manifests)
+    if dry_run:
+      print("\nPass -f to do it for real")
+    if not ok:
+      return 1
+  elif args.dest_dir:
+    with STATS.phase("sync"):
+      ok = sync_files(args.temp_dir, args.dest_dir, dry_run, args.engine, args.jobs,
+                      args.verify, args.checksum, args.resume, staged,
+                      manifests.get(args.dest_dir))
     if dry_run:
       print("\nPass -f to do it for real")
+    if not ok:
+      return 1
+
+def compute_staging_plan(playlist_name, my_dir, library_xml=None, dirty=False,
+                         use_cache=False, resolve_jobs=16, workers=None, query=None):
+  """
+  Work out the StagingPlan for a playlist, or, if query is given, for the
+  tracks matching a LibraryIndex query.
+  """
+  with STATS.phase("compute_symlink_paths"):
+    cleaner = FilenameCleaner(ccdict_path=my_dir)
+    if query is None:
+      itunes = iTunesLibrary(library_xml, playlist_name, use_cache=use_cache,
+                             workers=workers)
+      playlist = itunes.playlists[playlist_name]
+    else:
+      itunes = iTunesLibrary(library_xml, use_cache=use_cache, workers=workers)
+      with STATS.phase("query"):
+        playlist = itunes.index.select(query)
+    return build_staging_plan(playlist, itunes.music_folder, cleaner, dirty, resolve_jobs)
 
-def compute_symlink_paths(playlist_name, my_dir, library_xml=None, dirty=False):
-  cleaner = FilenameCleaner(ccdict_path=my_dir)
-  itunes = iTunesLibrary(library_xml)
-  playlist = itunes.playlists[playlist_name]
-  path_prefix = os.path.realpath(itunes.music_folder) + "/Music"
+def build_staging_plan(playlist, music_folder, cleaner, dirty=False, resolve_jobs=16):
+  """Return the StagingPlan for the tracks of a playlist whose files exist, and the intro."""
+  path_prefix = os.path.realpath(music_folder) + "/Music"
   print("iTunes folder: ", path_prefix)
-  symlink_tree = {}
+  tracks = [ ]
   for track in playlist:
-    file_path = os.path.realpath(track["File Path"])
+    STATS.count("tracks_seen")
+    if not track["File Path"]:
+      STATS.count("tracks_without_file_path")
+      continue
+    tracks.append(track)
+  with STATS.phase("resolve_paths"):
+    resolved = PathResolver(resolve_jobs).resolve([track["File Path"] for track in tracks])
+  missing = [ ]
+  staged = [ ]
+  positions = { }
+  for position, (track, (file_path, size)) in enumerate(zip(tracks, resolved)):
+    if size is None:
+      missing.append(file_path)
+      continue
     if file_path:
-      if file_path.startswith(path_prefix):
-        relative_path = file_path[len(path_prefix):]
-      else:
-        relative_path = file_path
-      if not dirty:
-        relative_path = cleaner.clean_name(relative_path)
-      if track.get("Genre", "").lower() == "classical":
-        relative_path = "Classical/%s" % relative_path
-      elif not track.get("Compilation"):
-        relative_path = "Artists/%s" % relative_path
-
-      # Split the relative path into a tree of dictionaries
-      parent = symlink_tree
-      pieces = relative_path.split('/')
-      while pieces:
-        piece = pieces.pop(0)
-        # The leaf of the tree is a string that is the file path
-        child = dict() if pieces else file_path
-        parent = parent.setdefault(piece, child)
-
-  return symlink_tree
-
-def make_symlinks(top_dir, symlink_tree):
+      rel_path = link_path(track, file_path, path_prefix, cleaner, dirty)
+      staged.append((rel_path, file_path, size))
+      positions.setdefault(rel_path, (position, track))
+
+  STATS.count("tracks_missing", len(missing))
+  report_missing(missing)
+  plan = StagingPlan(staged, positions)
+  link_intro(plan)
+  return plan
+
+def link_path(track, file_path, path_prefix, cleaner, dirty=False):
+  """Return the path, relative to the staging directory, to link a track's file at."""
+  if file_path.startswith(path_prefix):
+    relative_path = file_path[len(path_prefix):]
+  else:
+    relative_path = file_path
+  if not dirty:
+    with STATS.phase("clean_name"):
+      relative_path = cleaner.clean_name(relative_path)
+  if track.get("Genre", "").lower() == "classical":
+    relative_path = "Classical/%s" % relative_path
+  elif not track.get("Compilation"):
+    relative_path = "Artists/%s" % relative_path
+  return relative_path
+
+def stage_symlinks(top_dir, plan, rebuild=False):
+  """Write the symlink farm of a StagingPlan under top_dir, for rsync to copy."""
+  with STATS.phase("symlinks"):
+    if rebuild:
+      delete_directory_contents(top_dir)
+      make_symlinks(top_dir, plan)
+    else:
+      reconcile_symlinks(top_dir, plan)
+
+def make_dirs(top_dir, plan):
+  """Create each directory of a StagingPlan under top_dir, once."""
+  for rel_path in plan.dirs():
+    os.makedirs(os.path.join(top_dir, rel_path), exist_ok=True)
+
+def make_symlinks(top_dir, plan):
   if not os.path.isdir(top_dir):
     os.makedirs(top_dir)
-  for item, child in sorted(symlink_tree.items()):
-    item_path = "%s/%s" % (top_dir, item)
-    if type(child) is dict:
-      make_symlinks(item_path, child)
-    else:
-      print("%s\n->%s" % (child, item_path))
-      os.symlink(child, item_path)
+  make_dirs(top_dir, plan)
+  for staged in plan:
+    item_path = "%s/%s" % (top_dir, staged.rel_path)
+    print("%s\n->%s" % (staged.src_path, item_path))
+    os.symlink(staged.src_path, item_path)
+    STATS.count("links_made")
+
+def reconcile_symlinks(top_dir, plan):
+  """
+  Update the symlinks under top_dir to match a StagingPlan. Only new links
+  are created and changed links retargeted; stale links, stray files and
+  empty directories are removed, and unchanged links are left alone.
+  """
+  print("Reconciling staging directory %s" % top_dir, file=sys.stderr)
+  wanted = plan.sources()
+  added = retargeted = removed = kept = 0
+  if not os.path.isdir(top_dir):
+    os.makedirs(top_dir)
+
+  existing = set()
+  for root, dirs, files in os.walk(top_dir, topdown=False):
+    for name in files + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+      path = os.path.join(root, name)
+      rel_path = os.path.relpath(path, top_dir)
+      target = wanted.get(rel_path)
+      if target is None or not os.path.islink(path):
+        print("-%s" % path)
+        os.remove(path)
+        removed += 1
+      elif os.readlink(path) != target:
+        print("%s\n~>%s" % (target, path))
+        tmp_path = os.path.join(root, ".%s.tmp" % name)
+        os.symlink(target, tmp_path)
+        os.replace(tmp_path, path)
+        existing.add(rel_path)
+        retargeted += 1
+      else:
+        existing.add(rel_path)
+        kept += 1
+    if root != top_dir and not os.listdir(root):
+      os.rmdir(root)
+
+  make_dirs(top_dir, plan)
+  for staged in plan:
+    if staged.rel_path in existing:
+      continue
+    item_path = os.path.join(top_dir, staged.rel_path)
+    print("%s\n->%s" % (staged.src_path, item_path))
+    os.symlink(staged.src_path, item_path)
+    added += 1
+  STATS.count("links_made", added + retargeted)
+
+  print("Staging links: %d added, %d retargeted, %d removed, %d kept" % (
+      added, retargeted, removed, kept), file=sys.stderr)
 
 def delete_directory_contents(top):
   print("Clearing staging directory %s" % top, file=sys.stderr)
@@ -110,17 +335,38 @@ def delete_directory_contents(top):
   if not os.path.isdir(top):
     os.makedirs(top)
 
-def link_intro(top_dir):
+def link_intro(plan):
   if not os.path.isfile(INTRO_MP3):
     print("Not linking missing intro file %s" % INTRO_MP3, file=sys.stderr)
     return
   print("Linking intro file %s" % INTRO_MP3, file=sys.stderr)
-  dest = os.path.join(top_dir, os.path.basename(INTRO_MP3))
-  if os.path.isfile(dest):
-    os.remove(dest)
-  os.symlink(INTRO_MP3, dest)
+  plan.add(os.path.basename(INTRO_MP3), INTRO_MP3, os.path.getsize(INTRO_MP3))
+
+def sync_files(src_dir, dest_dir, dry_run, engine="rsync", jobs=4, verify=False,
+               checksum=None, resume=False, staged=None, manifest=None):
+  """
+  Copy the staged files to dest_dir, returning True if nothing failed. The
+  native engine copies the files of a StagingPlan, if one is given, rather
+  than those linked from src_dir, and plans against manifest if it has
+  already been loaded. rsync copies from src_dir, then updates the
+  destination's manifest from the StagingPlan, so that the next space check
+  can trust it, or removes the manifest if it can't.
+  """
+  if engine == "native":
+    if dry_run:
+      print("Would sync to %s" % dest_dir, file=sys.stderr)
+    else:
+      print("Syncing to %s" % dest_dir, file=sys.stderr)
+    hashes = HashCache(checksum, jobs=jobs) if checksum else None
+    try:
+      results = native_sync.sync_directories(src_dir, dest_dir, dry_run, jobs=jobs,
+                                             verify=verify, hashes=hashes, resume=resume,
+                                             staged=staged, manifest=manifest)
+    finally:
+      if hashes:
+        hashes.close()
+    return all(result.ok for result in results)
 
-def sync_files(src_dir, dest_dir, dry_run):
   rsync = [
     "/usr/bin/rsync",
     "--verbose",
@@ -130,7 +376,7 @@ def sync_files(src_dir, dest_dir, dry_run):
     "--stats",
     "--size-only",
     "--delete",
-    "--exclude='.*'",
+    "--exclude=.*",
     src_dir + "/",
     dest_dir + "/",
   ]
@@ -139,7 +385,51 @@ def sync_files(src_dir, dest_dir, dry_run):
     rsync.insert(1, "-n")
   else:
     print("Syncing to %s" % dest_dir, file=sys.stderr)
-  call(rsync)
+  ok = call(rsync) == 0
+  if not dry_run:
+    record_rsync(dest_dir, staged if ok else None, manifest)
+  return ok
+
+def record_rsync(dest_dir, staged, manifest=None):
+  """
+  Update the manifest of a destination rsync has just synced to from
+  staged, or, without a StagingPlan, remove the manifest rsync has made
+  stale.
+  """
+  if manifest is None:
+    manifest = DestinationManifest(dest_dir)
+    manifest.load()
+  try:
+    if staged is not None:
+      native_sync.record_plan(manifest, staged)
+      manifest.save()
+    else:
+      os.remove(manifest.path)
+  except FileNotFoundError:
+    pass
+  except OSError as e:
+    print("[Error] Couldn't update the manifest %s: %s" % (manifest.path, e), file=sys.stderr)
+
+def fan_out_files(src_dir, dest_dirs, dry_run, jobs=4, verify=False, checksum=None,
+                  resume=False, staged=None, manifests=None):
+  """
+  Copy the staged files to each of dest_dirs with the native engine, reading
+  each of them once for all the destinations. manifests has those of the
+  destinations' manifests that have already been loaded. Returns True if
+  nothing failed.
+  """
+  import fanout_sync
+  if not dry_run:
+    print("Syncing to %s" % ", ".join(dest_dirs), file=sys.stderr)
+  hashes = HashCache(checksum, jobs=jobs) if checksum else None
+  try:
+    all_results = fanout_sync.fan_out(src_dir, dest_dirs, dry_run, jobs=jobs, verify=verify,
+                                      hashes=hashes, resume=resume, staged=staged,
+                                      manifests=manifests)
+  finally:
+    if hashes:
+      hashes.close()
+  return all(result.ok for results in all_results for result in results)
 
 if __name__ == "__main__":
   sys.exit(main())
@@ -0,0 +1,115 @@
+import contextlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from clean_filenames import CharacterTranslator, FilenameCleaner
+
+# A few Mandarin readings in the format of ccdict.txt.
+CCDICT = {
+  0x4E00: 'yi', 0x4E09: 'san', 0x4EBA: 'ren', 0x5927: 'da', 0x5929: 'tian',
+  0x738B: 'wang', 0x83F2: 'fei', 0x6211: 'wo', 0x4F60: 'ni', 0x597D: 'hao',
+}
+
+# Characters the names are made of: plain ASCII, the characters the
+# translation table knows, ones ccdict knows, unknown ones, including astral
+# code points, and the markers the table-driven path uses internally.
+ALPHABET = (
+  list("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789") * 4
+  + list("   ---___...,,''()&!?/") * 2
+  + [chr(code) for code in (0x3A, 0xC4, 0xD6, 0xDC, 0xE1, 0xE4, 0xE7, 0xE8, 0xE9, 0xEF, 0xF3,
+                            0xF4, 0xF6, 0xFC, 0xB0, 0xBF, 0xC6, 0xD8, 0xDF, 0xE6, 0xF8, 0x159,
+                            0x300, 0x301, 0x308, 0x30A, 0x327, 0x430, 0x436, 0x449, 0x44C,
+                            0x44F, 0x2013, 0x2014, 0x3068, 0x4E0B, 0xFF08, 0xFF09, 0xFF1A)]
+  + [chr(code) for code in CCDICT] * 3
+  + [chr(code) for code in (0x80, 0xA0, 0x416, 0x3042, 0x9F8D, 0xFFFD, 0x1F3B5, 0x1F600,
+                            0x20000, 0x10FFFF)]
+  + ['\x00', '\x01', '\x02']
+)
+
+def random_names(rng, count):
+  # Artist and album directories repeat, as they do in a library, so the
+  # component cache is exercised as well as filled.
+  dirs = [''.join(rng.choice(ALPHABET) for _ in range(rng.randint(1, 12)))
+          for _ in range(count // 20 + 1)]
+  for _ in range(count):
+    name = ''.join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 24)))
+    if rng.random() < 0.5:
+      name = "%s/%s/%s" % (rng.choice(dirs), rng.choice(dirs), name)
+    yield name
+
+def captured(function, *args):
+  """Return what function(*args) returns and what it writes to stderr."""
+  err = io.StringIO()
+  with contextlib.redirect_stderr(err):
+    result = function(*args)
+  return result, err.getvalue()
+
+
+class TranslateStrTest(unittest.TestCase):
+  """
+  The table-driven translate_str must give exactly what translating one
+  character at a time does, and report the same unknown characters.
+  """
+  @classmethod
+  def setUpClass(cls):
+    cls.ccdict_dir = tempfile.mkdtemp()
+    with open(os.path.join(cls.ccdict_dir, "ccdict.txt"), "w", encoding="latin-1") as f:
+      for code, pinyin in sorted(CCDICT.items()):
+        f.write("U+%04X.0\tfMandarin\t%s\n" % (code, pinyin))
+    # Compile the index now, so that doing so isn't reported by a test.
+    captured(CharacterTranslator(cls.ccdict_dir).lookup_char, chr(0x4E00))
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.ccdict_dir)
+
+  def assertSameTranslation(self, fast, slow, name):
+    self.assertEqual(captured(fast.translate_str, name),
+                     captured(slow.translate_str_by_char, name), repr(name))
+
+  def test_generated_names(self):
+    fast = CharacterTranslator(self.ccdict_dir)
+    slow = CharacterTranslator(self.ccdict_dir)
+    for name in random_names(random.Random(20240601), 20000):
+      self.assertSameTranslation(fast, slow, name)
+
+  def test_without_ccdict(self):
+    fast = CharacterTranslator()
+    slow = CharacterTranslator()
+    for name in random_names(random.Random(7), 5000):
+      self.assertSameTranslation(fast, slow, name)
+
+  def test_pinyin_separators(self):
+    fast = CharacterTranslator(self.ccdict_dir)
+    slow = CharacterTranslator(self.ccdict_dir)
+    for name in ("王菲", "王菲 Live", "王-菲", "王́菲",
+                 "a/王/菲", "王é", "一三人.mp3", "王"):
+      self.assertSameTranslation(fast, slow, name)
+    self.assertEqual(fast.translate_str("王菲 Live"), "wang-fei Live")
+
+  def test_unknown_characters_are_reported_every_time(self):
+    fast = CharacterTranslator(self.ccdict_dir)
+    for _ in range(3):
+      result, err = captured(fast.translate_str, "A/B \U0001F600")
+      self.assertEqual(result, "A/B (1F600)")
+      self.assertEqual(err, "Unknown character: '\U0001F600' (0x1F600)\nin A/B \U0001F600\n")
+
+
+class CleanNameTest(unittest.TestCase):
+  def test_generated_names(self):
+    fast = FilenameCleaner()
+    slow = FilenameCleaner()
+    slow.translator.translate_str = slow.translator.translate_str_by_char
+    rng = random.Random(42)
+    for name in random_names(rng, 5000):
+      name = os.path.basename(name) + rng.choice(("", ".mp3", ".m4a", ""))
+      self.assertEqual(captured(fast.clean_name, name), captured(slow.clean_name, name),
+                       repr(name))
+
+
+if __name__ == "__main__":
+  unittest.main()
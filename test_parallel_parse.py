@@ -0,0 +1,126 @@
+import contextlib
+import io
+import mmap
+import os
+import shutil
+import tempfile
+import unittest
+from xml.sax.saxutils import escape
+
+from itunes_playlist import iTunesLibrary
+import parallel_parse
+
+WORKERS = 3
+ARTISTS = ["Björk", "王菲", "AC/DC", "Sigur Rós", "The <key>1</key><dict> Band", "Мир & Co"]
+
+def write_library(path, num_tracks):
+  """
+  Write a small Library.xml whose tracks vary in length, so that the places
+  split_tracks aims for land inside track dicts. Returns the playlist names.
+  """
+  track_ids = [1000 + n for n in range(num_tracks)]
+  with open(path, "w", encoding="utf-8") as f:
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+            '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+            '<plist version="1.0">\n<dict>\n'
+            '\t<key>Major Version</key><integer>1</integer>\n'
+            '\t<key>Music Folder</key><string>file://localhost/Music/</string>\n'
+            '\t<key>Tracks</key>\n\t<dict>\n')
+    for n, track_id in enumerate(track_ids):
+      artist = ARTISTS[n % len(ARTISTS)]
+      name = "%02d %s" % (n, "Song " * (n % 7))
+      f.write('\t\t<key>%d</key>\n\t\t<dict>\n' % track_id)
+      for key, kind, value in (
+          ("Track ID", "integer", track_id),
+          ("Name", "string", name),
+          ("Artist", "string", artist),
+          ("Album", "string", "Album %d" % (n % 5)),
+          ("Genre", "string", ("Rock", "Classical")[n % 2]),
+          ("Size", "integer", 1000 + n),
+          ("Rating", "integer", 20 * (n % 6)),
+          ("Date Added", "date", "2015-01-%02dT10:00:00Z" % (1 + n % 28)),
+          ("Location", "string", "file://localhost/Music/%d.mp3" % track_id)):
+        f.write('\t\t\t<key>%s</key><%s>%s</%s>\n' % (key, kind, escape(str(value)), kind))
+      if n % 4 == 0:
+        f.write('\t\t\t<key>Compilation</key><true/>\n')
+      f.write('\t\t</dict>\n')
+    f.write('\t</dict>\n\t<key>Playlists</key>\n\t<array>\n')
+    playlists = [("Library", track_ids), ("Evens", track_ids[::2]),
+                 ("Last Few", track_ids[-5:]), ("Empty", [ ])]
+    for n, (playlist_name, items) in enumerate(playlists):
+      f.write('\t\t<dict>\n\t\t\t<key>Name</key><string>%s</string>\n'
+              '\t\t\t<key>Playlist ID</key><integer>%d</integer>\n' % (playlist_name, 100 + n))
+      if items:
+        f.write('\t\t\t<key>Playlist Items</key>\n\t\t\t<array>\n')
+        for track_id in items:
+          f.write('\t\t\t\t<dict>\n\t\t\t\t\t<key>Track ID</key>'
+                  '<integer>%d</integer>\n\t\t\t\t</dict>\n' % track_id)
+        f.write('\t\t\t</array>\n')
+      f.write('\t\t</dict>\n')
+    f.write('\t</array>\n</dict>\n</plist>\n')
+  return [playlist_name for playlist_name, _ in playlists]
+
+def load(*args, **kwargs):
+  with contextlib.redirect_stderr(io.StringIO()):
+    return iTunesLibrary(*args, **kwargs)
+
+def contents(library):
+  """What a library was parsed into, in a form that can be compared."""
+  return (library.music_folder,
+          dict((id, track.values()) for id, track in library.tracks.data.items()),
+          dict((name, dict(playlist.data)) for name, playlist in library.playlists.items()))
+
+
+class ParallelParseTest(unittest.TestCase):
+  """Parsing with workers must give exactly what the serial parse does."""
+  @classmethod
+  def setUpClass(cls):
+    cls.temp_dir = tempfile.mkdtemp()
+    cls.library_xml = os.path.join(cls.temp_dir, "Library.xml")
+    cls.playlist_names = write_library(cls.library_xml, 200)
+    cls.serial = load(cls.library_xml)
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls.temp_dir)
+
+  def test_chunks_split_at_track_boundaries(self):
+    with open(self.library_xml, 'rb') as f:
+      mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      start, end = parallel_parse.find_tracks_body(mm)
+      chunks = parallel_parse.split_tracks(mm, start, end, WORKERS * 4)
+      # The first place aimed for is inside a track dict, which must be kept
+      # whole in the next chunk.
+      step = (end - start) // (WORKERS * 4)
+      self.assertIsNone(parallel_parse.TRACK_START_RE.match(mm, start + step))
+      self.assertGreater(len(chunks), WORKERS)
+      self.assertEqual(chunks[0][0], start)
+      self.assertEqual(chunks[-1][1], end)
+      for (_, chunk_end), (chunk_start, _) in zip(chunks, chunks[1:]):
+        self.assertEqual(chunk_end, chunk_start)
+        self.assertIsNotNone(parallel_parse.TRACK_START_RE.match(mm, chunk_start))
+    finally:
+      mm.close()
+
+  def test_whole_library(self):
+    parallel = load(self.library_xml, workers=WORKERS)
+    self.assertEqual(len(parallel.tracks), 200)
+    self.assertEqual(contents(parallel), contents(self.serial))
+
+  def test_one_playlist(self):
+    for playlist_name in self.playlist_names:
+      parallel = load(self.library_xml, playlist_name, workers=WORKERS)
+      serial = load(self.library_xml, playlist_name)
+      self.assertEqual(contents(parallel), contents(serial), playlist_name)
+      # The same as the playlist and its tracks from the whole library.
+      playlist = self.serial.playlists[playlist_name]
+      self.assertEqual(dict(parallel.playlists[playlist_name].data), dict(playlist.data))
+      self.assertEqual(dict((id, track.values()) for id, track in parallel.tracks.data.items()),
+                       dict((id, self.serial.tracks[id].values())
+                            for id in playlist.track_ids))
+
+
+if __name__ == "__main__":
+  unittest.main()
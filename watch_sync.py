@@ -0,0 +1,165 @@
+import hashlib
+import os
+import sys
+import time
+
+from clean_filenames import FilenameCleaner
+from dest_manifest import MANIFEST_NAME
+from itunes_playlist import DEFAULT_LIBRARY_XML, iTunesLibrary
+from phase_stats import STATS
+import sync_jobs
+from sync_jobs import SharedCleaner
+
+POLL_SECONDS = 2.0
+DEBOUNCE_SECONDS = 5.0
+
+def file_state(path):
+  """Return what's watched of a file, or None if it doesn't exist."""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return st.st_mtime_ns, st.st_size
+
+def mount_point(path):
+  """Return the mount point of the filesystem that path is on."""
+  path = os.path.realpath(path)
+  while not os.path.ismount(path):
+    path = os.path.dirname(path)
+  return path
+
+def dest_state(path):
+  """
+  Return the device a destination is on, or None if it isn't there. This
+  changes when a device is mounted over an existing mount point, too. The
+  empty mount point a card leaves behind when it's unmounted doesn't count:
+  a destination is only there if it is on a filesystem mounted somewhere
+  other than the root, like /Volumes/CARD/Music, or has been synced to
+  before, and so has a manifest.
+  """
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  if (mount_point(path) == os.path.realpath(os.sep)
+      and not os.path.isfile(os.path.join(path, MANIFEST_NAME))):
+    return None
+  return st.st_dev
+
+def playlist_signature(playlist):
+  """A digest of a playlist's tracks and their fields, to tell whether it changed."""
+  h = hashlib.sha1()
+  for track in playlist:
+    h.update(repr(track.values()).encode("utf-8"))
+  return h.hexdigest()
+
+class LibraryWatcher(object):
+  """
+  Keeps the destinations of a set of SyncJobs up to date. The library file is
+  polled, and once it has stopped changing for the debounce time it is
+  reloaded, through the library cache, and only the jobs whose playlists
+  changed are staged and synced. A job is also synced whenever its
+  destination appears, or a different device is mounted there.
+  """
+  def __init__(self, jobs, library_xml, temp_dir, my_dir, args, device_concurrency=1,
+               poll=POLL_SECONDS, debounce=DEBOUNCE_SECONDS):
+    self.jobs = jobs
+    self.library_xml = library_xml
+    self.temp_dir = temp_dir
+    self.args = args
+    self.device_concurrency = device_concurrency
+    self.poll = poll
+    self.debounce = debounce
+    self.cleaner = SharedCleaner(FilenameCleaner(ccdict_path=my_dir))
+    self.signatures = { }
+    self.staged = set()
+
+  def run(self):
+    library_xml = self.library_xml or DEFAULT_LIBRARY_XML
+    library_state = None
+    changed_at = None
+    for job in self.jobs:
+      job.dest_state = dest_state(job.dest_dir) if job.dest_dir else None
+    print("Watching %s" % library_xml, file=sys.stderr)
+    while True:
+      state = file_state(library_xml)
+      now = time.monotonic()
+      if state != library_state:
+        # Sync straight away at startup, but wait for a burst of writes to end.
+        changed_at = now if library_state is not None else now - self.debounce
+        library_state = state
+      if changed_at is not None and state is not None and now - changed_at >= self.debounce:
+        changed_at = None
+        self.library_changed(library_xml)
+
+      appeared = [ ]
+      for job in self.jobs:
+        if not job.dest_dir:
+          continue
+        state = dest_state(job.dest_dir)
+        if state != job.dest_state:
+          job.dest_state = state
+          if state is not None and job.name in self.staged:
+            print("Destination %s appeared" % job.dest_dir, file=sys.stderr)
+            appeared.append(job)
+      if appeared:
+        self.sync(appeared)
+      time.sleep(self.poll)
+
+  def library_changed(self, library_xml):
+    try:
+      with STATS.phase("compute_symlink_paths"):
+        itunes = iTunesLibrary(library_xml, use_cache=not self.args.no_cache,
+                               workers=self.args.workers)
+    except Exception as e:
+      # Most likely the library was caught part way through being rewritten;
+      # it will be picked up again when it next changes.
+      print("[Error] Couldn't load %s: %s" % (library_xml, e), file=sys.stderr)
+      return
+    changed = [ ]
+    for job in self.jobs:
+      playlist = itunes.playlists.get(job.playlist)
+      if playlist is None:
+        print("[Error] No such playlist: '%s'" % job.playlist, file=sys.stderr)
+        continue
+      signature = playlist_signature(playlist)
+      if self.signatures.get(job.name) != signature:
+        self.signatures[job.name] = signature
+        changed.append(job)
+    if not changed:
+      print("Library changed, but none of the watched playlists did", file=sys.stderr)
+      return
+    print("Playlists changed: %s" % ", ".join(job.name for job in changed), file=sys.stderr)
+    sync_jobs.stage_jobs(changed, itunes, self.cleaner, self.temp_dir, self.args.resolve_jobs)
+    self.staged.update(job.name for job in changed)
+    for job in changed:
+      job.dest_state = dest_state(job.dest_dir) if job.dest_dir else None
+    self.sync([job for job in changed if job.dest_state is not None])
+
+  def sync(self, jobs):
+    if jobs and not sync_jobs.sync_all(jobs, self.device_concurrency):
+      print("[Error] Some syncs failed; they'll be retried when the library next changes",
+            file=sys.stderr)
+      for job in jobs:
+        self.signatures.pop(job.name, None)
+
+
+def watch(my_dir, args):
+  """Watch the jobs of args.job_file, or the one -p/-d job, until interrupted."""
+  if args.job_file:
+    try:
+      config, jobs = sync_jobs.load_job_file(args.job_file, args)
+    except (OSError, ValueError) as e:
+      print("[Error] Bad job file %s: %s" % (args.job_file, e), file=sys.stderr)
+      return 1
+  else:
+    config, jobs = { }, [sync_jobs.job_from_args(args)]
+  watcher = LibraryWatcher(jobs, config.get("library_xml", args.library_xml),
+                           config.get("temp_dir", args.temp_dir), my_dir, args,
+                           config.get("device_concurrency", 1),
+                           debounce=config.get("debounce", args.debounce))
+  try:
+    watcher.run()
+  except KeyboardInterrupt:
+    pass
+  return 0